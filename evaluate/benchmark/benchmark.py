@@ -0,0 +1,322 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, '..'))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, '..', 'validation'))
+
+import evaluate
+import tag_eraser
+from semarkup import parse_semarkup
+from scorer.scorer import SEMarkupScorer
+from scorer.taxonomy import Taxonomy
+from validate_semarkup import validate_semarkup
+from generate_semarkup import (
+    generate_corpus,
+    load_dict_from_json,
+    DEFAULT_TAXONOMY_FILE,
+    DEFAULT_LEMMA_WEIGHTS_FILE,
+    DEFAULT_FEATS_WEIGHTS_FILE
+)
+
+
+SCORER_METRIC_FUNCTIONS = evaluate.SCORER_METRIC_FUNCTIONS
+
+# Number of random semclass pairs used to benchmark calc_path_length.
+PATH_LENGTH_PAIRS = 100000
+
+
+@contextlib.contextmanager
+def silence():
+    """
+    Suppress stdout and stderr (progress bars, logs) of the benchmarked code.
+    """
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def measure(function: Callable[[], object], n_items: int, repeat: int) -> Dict[str, float]:
+    times = []
+    for _ in range(repeat):
+        with silence():
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    best_time = min(times)
+    return {
+        "items": n_items,
+        "best_time": best_time,
+        "mean_time": sum(times) / len(times),
+        "throughput": n_items / best_time if best_time > 0 else float("inf"),
+    }
+
+
+def count_lines(file_path: str) -> int:
+    with open(file_path, 'r') as file:
+        return sum(1 for _ in file)
+
+
+def load_sentences(file_path: str) -> list:
+    with open(file_path, 'r') as file:
+        return list(parse_semarkup(file, incr=True))
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=SCRIPT_DIR, capture_output=True, text=True, check=True
+        )
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_benchmarks(test_file_path: str,
+                     gold_file_path: str,
+                     work_dir: str,
+                     seed: int) -> List[Tuple[str, str, Callable[[], object], int]]:
+    """
+    Return a list of (name, unit, function, number of items processed by function) tuples.
+    """
+    lemma_weights = load_dict_from_json(DEFAULT_LEMMA_WEIGHTS_FILE)
+    feats_weights = load_dict_from_json(DEFAULT_FEATS_WEIGHTS_FILE)
+
+    with silence():
+        scorer = SEMarkupScorer(
+            DEFAULT_TAXONOMY_FILE,
+            semclasses_out_of_taxonomy={'_'},
+            lemma_weights=lemma_weights,
+            feats_weights=feats_weights
+        )
+    test_sentences = load_sentences(test_file_path)
+    gold_sentences = load_sentences(gold_file_path)
+    token_pairs = [
+        (test_token, gold_token)
+        for test_sentence, gold_sentence in zip(test_sentences, gold_sentences)
+        for test_token, gold_token in zip(test_sentence, gold_sentence)
+    ]
+    n_tokens = len(token_pairs)
+
+    rng = random.Random(seed)
+    taxonomy_semclasses = sorted(scorer.taxonomy.semclass_to_idx)
+    semclass_pairs = [
+        (rng.choice(taxonomy_semclasses), rng.choice(taxonomy_semclasses))
+        for _ in range(PATH_LENGTH_PAIRS)
+    ]
+
+    def parse_incr():
+        with open(gold_file_path, 'r') as file:
+            for _ in parse_semarkup(file, incr=True):
+                pass
+
+    def parse_list():
+        with open(gold_file_path, 'r') as file:
+            parse_semarkup(file, incr=False)
+
+    def calc_path_lengths():
+        for semclass1, semclass2 in semclass_pairs:
+            scorer.taxonomy.calc_path_length(semclass1, semclass2)
+
+    def make_metric_benchmark(metric_function: Callable) -> Callable[[], None]:
+        def run_metric():
+            for test_token, gold_token in token_pairs:
+                metric_function(test_token, gold_token)
+        return run_metric
+
+    def validate():
+        with open(gold_file_path, 'r') as file:
+            validate_semarkup(parse_semarkup(file, incr=True))
+
+    benchmarks = [
+        ("parse_incr", "tokens", parse_incr, n_tokens),
+        ("parse_list", "tokens", parse_list, n_tokens),
+        ("taxonomy", "rows", lambda: Taxonomy(DEFAULT_TAXONOMY_FILE), count_lines(DEFAULT_TAXONOMY_FILE) - 1),
+        ("calc_path_length", "pairs", calc_path_lengths, len(semclass_pairs)),
+    ]
+    for function_name in SCORER_METRIC_FUNCTIONS:
+        benchmarks.append(
+            (function_name, "tokens", make_metric_benchmark(getattr(scorer, function_name)), n_tokens)
+        )
+    benchmarks += [
+        ("score_sentences", "tokens", lambda: scorer.score_sentences(test_sentences, gold_sentences), n_tokens),
+        ("evaluate", "tokens", lambda: evaluate.main(
+            test_file_path,
+            gold_file_path,
+            DEFAULT_TAXONOMY_FILE,
+            DEFAULT_LEMMA_WEIGHTS_FILE,
+            DEFAULT_FEATS_WEIGHTS_FILE,
+            score_semantic_only=False
+        ), n_tokens),
+        ("tag_eraser", "tokens", lambda: tag_eraser.main(
+            gold_file_path, os.path.join(work_dir, "erased.conllu")
+        ), n_tokens),
+        ("validate_semarkup", "tokens", validate, n_tokens),
+    ]
+
+    try:
+        import evaluate_f1
+    except ImportError as e:
+        print(f"Skip evaluate_f1 benchmark: {e}")
+    else:
+        benchmarks.append(
+            ("evaluate_f1", "tokens", lambda: evaluate_f1.main(test_file_path, gold_file_path), n_tokens)
+        )
+
+    return benchmarks
+
+
+def print_results(results: Dict[str, Dict], baseline_results: Dict[str, Dict] = None) -> None:
+    header = f"{'Benchmark':<20}{'items':>10}{'unit':>8}{'best, s':>10}{'items/s':>14}"
+    if baseline_results is not None:
+        header += f"{'baseline/s':>14}{'speedup':>10}"
+    print(header)
+
+    for name, result in results.items():
+        line = f"{name:<20}{result['items']:>10}{result['unit']:>8}" \
+               f"{result['best_time']:>10.3f}{result['throughput']:>14.0f}"
+        if baseline_results is not None:
+            if name in baseline_results:
+                baseline_throughput = baseline_results[name]["throughput"]
+                line += f"{baseline_throughput:>14.0f}{result['throughput'] / baseline_throughput:>9.2f}x"
+            else:
+                line += f"{'-':>14}{'-':>10}"
+        print(line)
+
+
+def main(n_sentences: int,
+         seed: int,
+         repeat: int,
+         names: List[str] = None,
+         test_file_path: str = None,
+         gold_file_path: str = None,
+         output_file_path: str = None,
+         compare_file_path: str = None) -> Dict:
+
+    if test_file_path is not None and gold_file_path is None:
+        raise ValueError("Test file requires gold file it is aligned with.")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if gold_file_path is None:
+            gold_file_path = os.path.join(work_dir, "gold.conllu")
+            test_file_path = os.path.join(work_dir, "test.conllu")
+            print(f"Generate synthetic corpus of {n_sentences} sentences (seed={seed})...")
+            generate_corpus(gold_file_path, n_sentences, seed, test_file_path)
+        elif test_file_path is None:
+            test_file_path = gold_file_path
+
+        print("Prepare benchmarks...")
+        benchmarks = build_benchmarks(test_file_path, gold_file_path, work_dir, seed)
+
+        results = {}
+        for name, unit, function, n_items in benchmarks:
+            if names and name not in names:
+                continue
+            print(f"Run {name}...")
+            results[name] = {"unit": unit, **measure(function, n_items, repeat)}
+
+    report = {
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "n_sentences": n_sentences,
+        "seed": seed,
+        "repeat": repeat,
+        "results": results,
+    }
+
+    baseline_results = None
+    if compare_file_path is not None:
+        baseline_results = load_dict_from_json(compare_file_path)["results"]
+
+    print()
+    print_results(results, baseline_results)
+
+    if output_file_path is not None:
+        with open(output_file_path, 'w') as file:
+            json.dump(report, file, indent=4)
+        print(f"Results are saved to {output_file_path}.")
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Throughput benchmarks of SEMarkup evaluation stack.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        '-n_sentences',
+        type=int,
+        help='Number of sentences in synthetic corpus.',
+        default=2000
+    )
+    parser.add_argument(
+        '-seed',
+        type=int,
+        help='Random seed of synthetic corpus.',
+        default=0
+    )
+    parser.add_argument(
+        '-repeat',
+        type=int,
+        help='Number of runs of each benchmark. The best run is reported.',
+        default=3
+    )
+    parser.add_argument(
+        '-benchmarks',
+        type=str,
+        nargs='+',
+        help='Names of benchmarks to run (all by default).',
+        default=None
+    )
+    parser.add_argument(
+        '-gold_file',
+        type=str,
+        help='Use existing SEMarkup file instead of synthetic corpus.',
+        default=None
+    )
+    parser.add_argument(
+        '-test_file',
+        type=str,
+        help='Use existing SEMarkup file (aligned with gold_file) as test file, requires gold_file.\n'
+        'Gold file is scored against itself if not set.',
+        default=None
+    )
+    parser.add_argument(
+        '-output_file',
+        type=str,
+        help='JSON file to save results to.',
+        default=None
+    )
+    parser.add_argument(
+        '-compare_file',
+        type=str,
+        help='JSON file with results of a previous run (e.g. of another commit) to compare with.',
+        default=None
+    )
+    args = parser.parse_args()
+    if args.test_file is not None and args.gold_file is None:
+        parser.error("-test_file requires -gold_file.")
+
+    main(
+        args.n_sentences,
+        args.seed,
+        args.repeat,
+        args.benchmarks,
+        args.test_file,
+        args.gold_file,
+        args.output_file,
+        args.compare_file
+    )
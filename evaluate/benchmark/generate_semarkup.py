@@ -0,0 +1,252 @@
+import os
+import csv
+import json
+import random
+import argparse
+
+from typing import Dict, Iterator, List, Tuple
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TAXONOMY_FILE = os.path.join(SCRIPT_DIR, "..", "..", "tagsets", "semantic_hierarchy.csv")
+DEFAULT_LEMMA_WEIGHTS_FILE = os.path.join(SCRIPT_DIR, "..", "scorer", "weights_estimator", "weights", "lemma_weights.json")
+DEFAULT_FEATS_WEIGHTS_FILE = os.path.join(SCRIPT_DIR, "..", "scorer", "weights_estimator", "weights", "feats_weights.json")
+DEFAULT_VOCAB_FILE = os.path.join(SCRIPT_DIR, "..", "validation", "train_vocab.json")
+
+# SEMarkup token columns.
+ID, FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, SEMSLOT, SEMCLASS = range(10)
+
+CYRILLIC_SYLLABLES = [
+    "ба", "ве", "го", "да", "же", "зи", "ко", "ла", "ми", "но", "по", "ре", "са", "то", "ту",
+    "фе", "хо", "це", "чи", "ша", "ще", "ю", "я", "ё", "ор", "ан", "ет", "ин", "ск", "ст",
+]
+LEMMA_ENDINGS = ["", "а", "о", "ть", "ый", "ий", "ся"]
+
+
+def load_dict_from_json(json_file_path: str) -> Dict:
+    with open(json_file_path, "r") as file:
+        data = json.load(file)
+    return data
+
+
+def load_taxonomy_semclasses(taxonomy_file: str) -> List[str]:
+    with open(taxonomy_file, "r") as file:
+        names = [row["Name"] for row in csv.DictReader(file)]
+    # '_' is a masked (out-of-taxonomy) semclass, keep it once.
+    return sorted(set(names))
+
+
+class SemarkupGenerator:
+    """
+    Deterministic generator of synthetic SEMarkup sentences.
+
+    Semclasses are drawn from the taxonomy, POS tags and grammatical categories from the weight files,
+    deprels, semslots and grammemes (where available) from the ground-truth vocabulary.
+    Heads always form a valid single-rooted tree.
+    """
+    def __init__(self,
+                 semclasses: List[str],
+                 pos_tags: List[str],
+                 feats_sizes: Dict[str, int],
+                 vocab: Dict,
+                 seed: int = 0,
+                 min_length: int = 1,
+                 max_length: int = 40):
+        assert 1 <= min_length <= max_length
+
+        self.rng = random.Random(seed)
+        # Perturbations use their own random state, so gold sentences do not depend on whether test ones are made.
+        self.noise_rng = random.Random(f"noise-{seed}")
+        self.semclasses = semclasses
+        self.pos_tags = pos_tags
+        self.deprels = sorted(deprel for deprel in vocab["deprels"] if deprel not in ('_', 'root'))
+        self.semslots = sorted(vocab["semslots"])
+        self.grammemes = {}
+        for gram_cat, size in feats_sizes.items():
+            if gram_cat in vocab["feats"]:
+                self.grammemes[gram_cat] = sorted(vocab["feats"][gram_cat])
+            else:
+                self.grammemes[gram_cat] = [f"Gram{i}" for i in range(1, size + 1)]
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def generate_form(self) -> str:
+        form = ''.join(self.rng.choice(CYRILLIC_SYLLABLES) for _ in range(self.rng.randint(1, 4)))
+        if self.rng.random() < 0.1:
+            form = form.capitalize()
+        return form
+
+    def generate_heads(self, length: int) -> List[int]:
+        # Attach tokens one by one (in random order) to already attached ones.
+        order = list(range(1, length + 1))
+        self.rng.shuffle(order)
+        heads = [0] * (length + 1)
+        for i in range(1, length):
+            heads[order[i]] = order[self.rng.randrange(i)]
+        return heads[1:]
+
+    def generate_feats(self, rng: random.Random) -> str:
+        gram_cats = rng.sample(sorted(self.grammemes), rng.randint(0, min(5, len(self.grammemes))))
+        feats = [f"{gram_cat}={rng.choice(self.grammemes[gram_cat])}" for gram_cat in sorted(gram_cats)]
+        return '|'.join(feats) if feats else '_'
+
+    def generate_sentence(self) -> List[List[str]]:
+        length = self.rng.randint(self.min_length, self.max_length)
+        heads = self.generate_heads(length)
+
+        tokens = []
+        for i in range(length):
+            form = self.generate_form()
+            lemma = form.lower()[:max(1, len(form) - self.rng.randint(0, 2))] + self.rng.choice(LEMMA_ENDINGS)
+            tokens.append([
+                str(i + 1),
+                form,
+                lemma,
+                self.rng.choice(self.pos_tags),
+                '_',
+                self.generate_feats(self.rng),
+                str(heads[i]),
+                'root' if heads[i] == 0 else self.rng.choice(self.deprels),
+                self.rng.choice(self.semslots),
+                self.rng.choice(self.semclasses),
+            ])
+        return tokens
+
+    def generate(self, n_sentences: int) -> Iterator[Tuple[str, List[List[str]]]]:
+        for sent_index in range(n_sentences):
+            yield str(sent_index + 1), self.generate_sentence()
+
+    def perturb_sentence(self, tokens: List[List[str]], noise: float) -> List[List[str]]:
+        """
+        Make a "predicted" copy of a sentence, where each tag is replaced with a random one with probability noise.
+        Ids and forms are kept intact, so the copy can be scored against the original.
+        """
+        rng = self.noise_rng
+        perturbed = []
+        for token in tokens:
+            token = list(token)
+            if rng.random() < noise:
+                token[LEMMA] = token[FORM].lower()
+            if rng.random() < noise:
+                token[UPOS] = rng.choice(self.pos_tags)
+            if rng.random() < noise:
+                token[FEATS] = self.generate_feats(rng)
+            if rng.random() < noise:
+                token[HEAD] = str(rng.randint(0, len(tokens)))
+            if rng.random() < noise:
+                token[DEPREL] = rng.choice(self.deprels)
+            if rng.random() < noise:
+                token[SEMSLOT] = rng.choice(self.semslots)
+            if rng.random() < noise:
+                token[SEMCLASS] = rng.choice(self.semclasses)
+            perturbed.append(token)
+        return perturbed
+
+
+def serialize_sentence(sent_id: str, tokens: List[List[str]]) -> str:
+    lines = [f"# sent_id = {sent_id}"]
+    lines += ['\t'.join(token) for token in tokens]
+    return '\n'.join(lines) + '\n\n'
+
+
+def build_generator(seed: int,
+                    min_length: int = 1,
+                    max_length: int = 40,
+                    taxonomy_file: str = DEFAULT_TAXONOMY_FILE,
+                    lemma_weights_file: str = DEFAULT_LEMMA_WEIGHTS_FILE,
+                    feats_weights_file: str = DEFAULT_FEATS_WEIGHTS_FILE,
+                    vocab_file: str = DEFAULT_VOCAB_FILE) -> SemarkupGenerator:
+    semclasses = load_taxonomy_semclasses(taxonomy_file)
+    # '_' is not a real POS tag (it comes from multiword tokens of the weights source dataset).
+    pos_tags = sorted(pos for pos in load_dict_from_json(lemma_weights_file) if pos != '_')
+    feats_sizes = load_dict_from_json(feats_weights_file)
+    vocab = load_dict_from_json(vocab_file)
+    return SemarkupGenerator(semclasses, pos_tags, feats_sizes, vocab, seed, min_length, max_length)
+
+
+def generate_corpus(gold_file_path: str,
+                    n_sentences: int,
+                    seed: int = 0,
+                    test_file_path: str = None,
+                    noise: float = 0.3,
+                    min_length: int = 1,
+                    max_length: int = 40) -> int:
+    """
+    Generate gold SEMarkup file (and, optionally, a perturbed test file aligned with it).
+    Return the number of generated tokens.
+    """
+    generator = build_generator(seed, min_length, max_length)
+
+    n_tokens = 0
+    test_file = open(test_file_path, 'w') if test_file_path is not None else None
+    try:
+        with open(gold_file_path, 'w') as gold_file:
+            for sent_id, tokens in generator.generate(n_sentences):
+                gold_file.write(serialize_sentence(sent_id, tokens))
+                if test_file is not None:
+                    test_file.write(serialize_sentence(sent_id, generator.perturb_sentence(tokens, noise)))
+                n_tokens += len(tokens)
+    finally:
+        if test_file is not None:
+            test_file.close()
+
+    return n_tokens
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic SEMarkup corpus of arbitrary size.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'gold_file',
+        type=str,
+        help='Output SEMarkup file with synthetic "gold" tags.'
+    )
+    parser.add_argument(
+        'n_sentences',
+        type=int,
+        help='Number of sentences to generate.'
+    )
+    parser.add_argument(
+        '-test_file',
+        type=str,
+        help='Optional output SEMarkup file with perturbed tags, aligned with gold file.',
+        default=None
+    )
+    parser.add_argument(
+        '-noise',
+        type=float,
+        help='Probability of a tag to be perturbed in test file.',
+        default=0.3
+    )
+    parser.add_argument(
+        '-seed',
+        type=int,
+        help='Random seed. The same seed always produces the same corpus.',
+        default=0
+    )
+    parser.add_argument(
+        '-min_length',
+        type=int,
+        help='Minimal sentence length.',
+        default=1
+    )
+    parser.add_argument(
+        '-max_length',
+        type=int,
+        help='Maximal sentence length.',
+        default=40
+    )
+    args = parser.parse_args()
+
+    n_tokens = generate_corpus(
+        args.gold_file,
+        args.n_sentences,
+        args.seed,
+        args.test_file,
+        args.noise,
+        args.min_length,
+        args.max_length
+    )
+    print(f"Generated {args.n_sentences} sentences ({n_tokens} tokens).")
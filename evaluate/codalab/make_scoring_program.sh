@@ -10,5 +10,6 @@ cp score.py scoring_program
 # Copy actual evaluation scripts.
 cp ../evaluate.py scoring_program
 cp ../semarkup.py scoring_program
+cp ../profiler.py scoring_program
 cp -r ../scorer scoring_program
 
@@ -1,6 +1,4 @@
 #!/bin/bash
 
-pip install pandas numpy tqdm conllu more-itertools
-
+# Evaluation depends on the standard library only, so there is nothing to install.
 python3 program/score.py $1 $2
-
@@ -3,7 +3,8 @@ from sys import argv
 import glob
 import yaml
 
-from evaluate import main
+from evaluate import Evaluator
+from profiler import Profiler
 
 
 def ls(filename):
@@ -40,11 +41,14 @@ if __name__ == "__main__":
     lemma_weights_file = os.path.join(weights_path, 'lemma_weights.json')
     feats_weights_file = os.path.join(weights_path, 'feats_weights.json')
 
+    # Profile evaluation phases only, for per-function profiling slows scoring down.
+    profiler = Profiler(per_function=False)
+
     total, lemma, pos, feats, head, deprel, semslot, semclass = 0, 0, 0, 0, 0, 0, 0, 0
     try:
-        total, lemma, pos, feats, head, deprel, semslot, semclass = main(
-            test_file, gold_file, taxonomy, lemma_weights_file, feats_weights_file, score_semantic_only=False
-        )
+        evaluator = Evaluator(taxonomy, lemma_weights_file, feats_weights_file, profiler=profiler)
+        result = evaluator.evaluate_files(test_file, gold_file, score_semantic_only=False)
+        total, lemma, pos, feats, head, deprel, semslot, semclass = result.as_tuple()
 
     except Exception as inst:
         print(inst)
@@ -66,6 +70,16 @@ if __name__ == "__main__":
     except:
         score_file.write("Duration: 0\n")
 
+    # Extra fields with evaluation profile (not shown on the leaderboard).
+    profiler.dump(os.path.join(output_dir, 'profile.json'))
+    for phase_name, phase_stats in profiler.phases.items():
+        score_file.write(f"profile_{phase_name}_wall_time: {phase_stats.wall_time:0.6f}\n")
+        score_file.write(f"profile_{phase_name}_cpu_time: {phase_stats.cpu_time:0.6f}\n")
+    if "evaluate" in profiler.phases and profiler.phases["evaluate"].wall_time > 0:
+        evaluate_stats = profiler.phases["evaluate"]
+        score_file.write(f"profile_tokens_per_sec: {evaluate_stats.tokens / evaluate_stats.wall_time:0.2f}\n")
+    score_file.write(f"profile_peak_rss_mb: {profiler.to_dict()['peak_rss_mb'] or 0:0.2f}\n")
+
     html_file.close()
     score_file.close()
 
@@ -3,16 +3,37 @@ import sys
 import argparse
 import json
 
-import numpy as np
+from dataclasses import dataclass, asdict
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
 
-from typing import Dict, Tuple
-
-from scorer.scorer import SEMarkupScorer
-from semarkup import parse_semarkup
+from scorer.numeric import mean
+from scorer.scorer import SEMarkupScorer, SentenceScores
+from semarkup import parse_semarkup, Sentence
+from profiler import Profiler
 
 
 OUTPUT_PRECISION = 4
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TAXONOMY_FILE = os.path.normpath(os.path.join(SCRIPT_DIR, "../tagsets/semantic_hierarchy.csv"))
+DEFAULT_LEMMA_WEIGHTS_FILE = os.path.normpath(
+    os.path.join(SCRIPT_DIR, "scorer/weights_estimator/weights/lemma_weights.json")
+)
+DEFAULT_FEATS_WEIGHTS_FILE = os.path.normpath(
+    os.path.join(SCRIPT_DIR, "scorer/weights_estimator/weights/feats_weights.json")
+)
+
+# Per-token metric functions of SEMarkupScorer to be profiled.
+SCORER_METRIC_FUNCTIONS = [
+    "score_lemma",
+    "score_pos",
+    "score_feats",
+    "score_head",
+    "score_deprel",
+    "score_semslot",
+    "score_semclass",
+]
+
 
 def load_dict_from_json(json_file_path: str) -> Dict:
     with open(json_file_path, "r") as file:
@@ -20,46 +41,159 @@ def load_dict_from_json(json_file_path: str) -> Dict:
     return data
 
 
+class SentenceCounter:
+    """
+    Iterable wrapper counting sentences and tokens that pass through it.
+    """
+    def __init__(self, sentences: Iterable[Sentence]):
+        self.sentences = sentences
+        self.n_sentences = 0
+        self.n_tokens = 0
+
+    def __iter__(self) -> Iterator[Sentence]:
+        for sentence in self.sentences:
+            self.n_sentences += 1
+            self.n_tokens += len(sentence)
+            yield sentence
+
+
+@dataclass
+class EvaluationResult:
+    """
+    Scores averaged over all tokens of test sentences.
+    If diagnostics are requested, `sentences` holds per-sentence scores.
+    """
+    total: float
+    lemma: float
+    pos: float
+    feats: float
+    head: float
+    deprel: float
+    semslot: float
+    semclass: float
+    n_sentences: int
+    n_tokens: int
+    score_semantic_only: bool = False
+    sentences: Optional[List[SentenceScores]] = None
+
+    def as_tuple(self) -> Tuple[float]:
+        return self.total, self.lemma, self.pos, self.feats, self.head, self.deprel, self.semslot, self.semclass
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class Evaluator:
+    """
+    In-process evaluation API.
+
+    Weights and taxonomy are loaded once, so the same evaluator can score any number of test sentences
+    (e.g. several test files against the same preloaded gold sentences, see `semarkup.load_semarkup`).
+
+    Usage:
+        evaluator = Evaluator()
+        result = evaluator.evaluate_files("test.conllu", "gold.conllu")
+        print(result.total)
+
+    Misaligned test and gold raise scorer.errors.AlignmentError subclasses.
+
+    If profiler is given, it records timings of evaluation phases
+    ('weights', 'taxonomy', 'parse', 'score', 'reduce') and of scorer metric functions.
+    """
+    def __init__(self,
+                 taxonomy_file: str = DEFAULT_TAXONOMY_FILE,
+                 lemma_weights_file: str = DEFAULT_LEMMA_WEIGHTS_FILE,
+                 feats_weights_file: str = DEFAULT_FEATS_WEIGHTS_FILE,
+                 profiler: Optional[Profiler] = None):
+        if profiler is None:
+            # Dummy profiler, which records phases only.
+            profiler = Profiler(per_function=False)
+        self.profiler = profiler
+
+        with profiler.phase("weights"):
+            print(f"Load lemma weights from {lemma_weights_file}.")
+            lemma_weights = load_dict_from_json(lemma_weights_file)
+            print(f"Load feats weights from {feats_weights_file}.")
+            feats_weights = load_dict_from_json(feats_weights_file)
+
+        with profiler.phase("taxonomy"):
+            print(f"Load taxonomy from {taxonomy_file}.")
+            print("Build scorer...")
+            self.scorer = SEMarkupScorer(
+                taxonomy_file,
+                semclasses_out_of_taxonomy={'_'},
+                lemma_weights=lemma_weights,
+                feats_weights=feats_weights
+            )
+
+        # Instrument scorer instance (class stays intact).
+        for function_name in SCORER_METRIC_FUNCTIONS:
+            setattr(self.scorer, function_name, profiler.wrap_function(function_name, getattr(self.scorer, function_name)))
+        self.scorer.average_scores = profiler.wrap_phase("reduce", self.scorer.average_scores)
+
+    def evaluate(self,
+                 test_sentences: Iterable[Sentence],
+                 gold_sentences: Iterable[Sentence],
+                 score_semantic_only: bool = False,
+                 diagnostics: bool = False) -> EvaluationResult:
+        """
+        Score test sentences against gold ones.
+        Sentences can be parsed from files (see semarkup.parse_semarkup and semarkup.load_semarkup)
+        or built from columnar data (see semarkup.sentences_from_columns).
+        """
+        profiler = self.profiler
+        sentence_scores = []
+
+        with profiler.phase("evaluate") as evaluate_stats:
+            # Count sentences and tokens on the fly, for inputs may be lazy iterators.
+            counter = SentenceCounter(test_sentences)
+            lemma, pos, feats, head, deprel, semslot, semclass = self.scorer.score_sentences(
+                counter,
+                gold_sentences,
+                sentence_scores if diagnostics else None
+            )
+            evaluate_stats.tokens += counter.n_tokens
+        profiler.add_remainder_phase("score", "evaluate", ["parse", "reduce"])
+
+        # Average average scores into total score.
+        if score_semantic_only:
+            total = mean([head, semslot, semclass])
+        else:
+            total = mean([lemma, pos, feats, head, deprel, semslot, semclass])
+
+        return EvaluationResult(
+            total, lemma, pos, feats, head, deprel, semslot, semclass,
+            n_sentences=counter.n_sentences,
+            n_tokens=counter.n_tokens,
+            score_semantic_only=score_semantic_only,
+            sentences=sentence_scores if diagnostics else None
+        )
+
+    def evaluate_files(self,
+                       test_file_path: str,
+                       gold_file_path: str,
+                       score_semantic_only: bool = False,
+                       diagnostics: bool = False) -> EvaluationResult:
+        with open(test_file_path, 'r') as test_file, open(gold_file_path, 'r') as gold_file:
+            test_sentences = self.profiler.wrap_iterable("parse", parse_semarkup(test_file, incr=True))
+            gold_sentences = self.profiler.wrap_iterable("parse", parse_semarkup(gold_file, incr=True))
+            return self.evaluate(test_sentences, gold_sentences, score_semantic_only, diagnostics)
+
+
 def main(test_file_path: str,
          gold_file_path: str,
          taxonomy_file: str,
          lemma_weights_file: str,
          feats_weights_file: str,
-         score_semantic_only: bool) -> Tuple[float]:
-
-    print(f"Load taxonomy from {taxonomy_file}.")
-    print(f"Load lemma weights from {lemma_weights_file}.")
-    lemma_weights = load_dict_from_json(lemma_weights_file)
-    print(f"Load feats weights from {feats_weights_file}.")
-    feats_weights = load_dict_from_json(feats_weights_file)
-
-    print("Build scorer...")
-    scorer = SEMarkupScorer(
-        taxonomy_file,
-        semclasses_out_of_taxonomy={'_'},
-        lemma_weights=lemma_weights,
-        feats_weights=feats_weights
-    )
-
+         score_semantic_only: bool,
+         profiler: Optional[Profiler] = None) -> Tuple[float]:
+    """
+    Return (total, lemma, pos, feats, head, deprel, semslot, semclass) scores.
+    """
+    evaluator = Evaluator(taxonomy_file, lemma_weights_file, feats_weights_file, profiler)
     print("Evaluate...")
-    with open(test_file_path, 'r') as test_file, open(gold_file_path, 'r') as gold_file:
-        test_sentences = parse_semarkup(test_file, incr=True)
-        gold_sentences = parse_semarkup(gold_file, incr=True)
-        scores = scorer.score_sentences(test_sentences, gold_sentences)
-
-    # Exit on errors.
-    if scores is None:
-        print("Errors encountered, exit.")
-        return 0, 0, 0, 0, 0, 0, 0, 0
-
-    lemma, pos, feats, head, deprel, semslot, semclass = scores
-    # Average average scores into total score.
-    if score_semantic_only:
-        total = np.mean([head, semslot, semclass])
-    else:
-        total = np.mean([lemma, pos, feats, head, deprel, semslot, semclass])
-
-    return total, lemma, pos, feats, head, deprel, semslot, semclass
+    result = evaluator.evaluate_files(test_file_path, gold_file_path, score_semantic_only)
+    return result.as_tuple()
 
 
 if __name__ == "__main__":
@@ -78,27 +212,23 @@ if __name__ == "__main__":
         help="Gold file in SEMarkup format with true tags.\n"
         "For example, SEMarkup-2023-Evaluate/train.conllu."
     )
-    script_dir = os.path.dirname(__file__)
-    default_rel_taxonomy_path = "../tagsets/semantic_hierarchy.csv"
     parser.add_argument(
         '-taxonomy_file',
         type=str,
         help="File in CSV format with semantic class taxonomy.",
-        default=os.path.normpath(os.path.join(script_dir, default_rel_taxonomy_path))
+        default=DEFAULT_TAXONOMY_FILE
     )
-    default_rel_lemma_weights_path = "scorer/weights_estimator/weights/lemma_weights.json"
     parser.add_argument(
         '-lemma_weights_file',
         type=str,
         help="JSON file with 'POS' -> 'lemma weight for this POS' relations.",
-        default=os.path.normpath(os.path.join(script_dir, default_rel_lemma_weights_path))
+        default=DEFAULT_LEMMA_WEIGHTS_FILE
     )
-    default_rel_feats_weights_path = "scorer/weights_estimator/weights/feats_weights.json"
     parser.add_argument(
         '-feats_weights_file',
         type=str,
         help="JSON file with 'grammatical category' -> 'weight of this category' relations.",
-        default=os.path.normpath(os.path.join(script_dir, default_rel_feats_weights_path))
+        default=DEFAULT_FEATS_WEIGHTS_FILE
     )
 
     parser.add_argument(
@@ -108,15 +238,35 @@ if __name__ == "__main__":
         "Otherwise, scores all tags: "
         "'lemma', 'upos', 'feats', 'head', 'deprel', 'semslot', 'semclass'."
     )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        metavar='PROFILE_FILE',
+        help="JSON file to write profiling results to.\n"
+        "If set, script records wall time, CPU time, tokens/sec and peak memory\n"
+        "of each evaluation phase and of each scoring function.",
+        default=None
+    )
+    parser.add_argument(
+        '--profile_tracemalloc',
+        action='store_true',
+        help="A flag. If set along with --profile, peak memory of each phase is also traced with tracemalloc.\n"
+        "Note that tracing slows evaluation down considerably."
+    )
     args = parser.parse_args()
 
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler(per_function=True, trace_malloc=args.profile_tracemalloc)
+
     total, lemma, pos, feats, head, deprel, semslot, semclass = main(
         args.test_file,
         args.gold_file,
         args.taxonomy_file,
         args.lemma_weights_file,
         args.feats_weights_file,
-        args.score_semantic_only
+        args.score_semantic_only,
+        profiler
     )
 
     print()
@@ -133,3 +283,9 @@ if __name__ == "__main__":
     print(f"SemSlot score: {semslot:.{OUTPUT_PRECISION}f}")
     print(f"SemClass score: {semclass:.{OUTPUT_PRECISION}f}")
 
+    if profiler is not None:
+        profiler.dump(args.profile)
+        print()
+        print(f"=========================")
+        print(f"Profile (saved to {args.profile}):")
+        print(profiler.summary())
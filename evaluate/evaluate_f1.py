@@ -3,6 +3,8 @@ import argparse
 import numpy as np
 from sklearn.metrics import f1_score
 
+from typing import Tuple
+
 from semarkup import parse_semarkup
 
 
@@ -12,25 +14,8 @@ def map_str_to_int(str_array: list) -> list:
     return int_array
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description='SEMarkup-2023 evaluation script.',
-        formatter_class=argparse.RawTextHelpFormatter
-    )
-    parser.add_argument(
-        'test_file',
-        type=str,
-        help='Test file in SEMarkup format with predicted tags.'
-    )
-    parser.add_argument(
-        'gold_file',
-        type=str,
-        help="Gold file in SEMarkup format with true tags.\n"
-        "For example, SEMarkup-2023-Evaluate/train.conllu."
-    )
-    args = parser.parse_args()
-
-    with open(args.test_file, 'r') as test_file, open(args.gold_file, 'r') as gold_file:
+def main(test_file_path: str, gold_file_path: str) -> Tuple[float, float, float, float]:
+    with open(test_file_path, 'r') as test_file, open(gold_file_path, 'r') as gold_file:
         test_sentences = parse_semarkup(test_file, incr=False)
         gold_sentences = parse_semarkup(gold_file, incr=False)
 
@@ -56,8 +41,35 @@ if __name__ == "__main__":
     semclass_pred_int, semclass_true_int = semclass_concat[:len(semclass_pred)], semclass_concat[len(semclass_pred):]
     assert len(semclass_pred_int) == len(semclass_pred) and len(semclass_true_int) == len(semclass_true)
 
-    print(f"Semslot micro f1: {f1_score(semslot_true_int, semslot_pred_int, average='micro'):.3f}")
-    print(f"Semslot macro f1: {f1_score(semslot_true_int, semslot_pred_int, average='macro'):.3f}")
-    print(f"Semclass micro f1: {f1_score(semclass_true_int, semclass_pred_int, average='micro'):.3f}")
-    print(f"Semclass macro f1: {f1_score(semclass_true_int, semclass_pred_int, average='macro'):.3f}")
+    return (
+        f1_score(semslot_true_int, semslot_pred_int, average='micro'),
+        f1_score(semslot_true_int, semslot_pred_int, average='macro'),
+        f1_score(semclass_true_int, semclass_pred_int, average='micro'),
+        f1_score(semclass_true_int, semclass_pred_int, average='macro'),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='SEMarkup-2023 evaluation script.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'test_file',
+        type=str,
+        help='Test file in SEMarkup format with predicted tags.'
+    )
+    parser.add_argument(
+        'gold_file',
+        type=str,
+        help="Gold file in SEMarkup format with true tags.\n"
+        "For example, SEMarkup-2023-Evaluate/train.conllu."
+    )
+    args = parser.parse_args()
+
+    semslot_micro_f1, semslot_macro_f1, semclass_micro_f1, semclass_macro_f1 = main(args.test_file, args.gold_file)
 
+    print(f"Semslot micro f1: {semslot_micro_f1:.3f}")
+    print(f"Semslot macro f1: {semslot_macro_f1:.3f}")
+    print(f"Semclass micro f1: {semclass_micro_f1:.3f}")
+    print(f"Semclass macro f1: {semclass_macro_f1:.3f}")
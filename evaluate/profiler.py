@@ -0,0 +1,184 @@
+import sys
+import json
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # 'resource' is unix-only.
+    resource = None
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    """
+    Return peak resident set size of the current process in megabytes.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    if sys.platform == 'darwin':
+        return peak_rss / 1024 / 1024
+    return peak_rss / 1024
+
+
+class TimingStats:
+    """
+    Accumulated timings of a phase or a function.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.tokens = 0
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        # Peak memory is only recorded for phases.
+        # ru_maxrss is the peak of the whole process, so a phase records how much it raised the peak
+        # (the largest growth of its calls, 0 if it stayed below the peak of earlier phases).
+        self.peak_rss_growth_mb = None
+        self.peak_tracemalloc_mb = None
+
+    def to_dict(self) -> Dict:
+        stats = {
+            "calls": self.calls,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "calls_per_sec": self.calls / self.wall_time if self.wall_time > 0 else None,
+        }
+        if self.tokens:
+            stats["tokens"] = self.tokens
+            stats["tokens_per_sec"] = self.tokens / self.wall_time if self.wall_time > 0 else None
+        if self.peak_rss_growth_mb is not None:
+            stats["peak_rss_growth_mb"] = self.peak_rss_growth_mb
+        if self.peak_tracemalloc_mb is not None:
+            stats["peak_tracemalloc_mb"] = self.peak_tracemalloc_mb
+        return stats
+
+
+class Profiler:
+    """
+    Records wall time, CPU time, throughput and peak memory of evaluation phases and functions.
+    Peak RSS of the process is reported once, while phases record its growth (see TimingStats).
+
+    There are two kinds of records:
+    * phases (e.g. taxonomy loading), timed with `phase` context manager, `wrap_phase` or `wrap_iterable`,
+    * functions (e.g. 'score_lemma'), timed with `wrap_function`.
+    Function timings are only recorded if per_function is set, since they noticeably slow scoring down.
+    """
+    def __init__(self, per_function: bool = True, trace_malloc: bool = False):
+        self.per_function = per_function
+        self.trace_malloc = trace_malloc
+        self.phases: Dict[str, TimingStats] = {}
+        self.functions: Dict[str, TimingStats] = {}
+
+        if self.trace_malloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def phase(self, name: str, tokens: int = 0) -> Iterator[TimingStats]:
+        stats = self.phases.setdefault(name, TimingStats())
+        if self.trace_malloc:
+            tracemalloc.reset_peak()
+
+        peak_rss_start = get_peak_rss_mb()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield stats
+        finally:
+            stats.wall_time += time.perf_counter() - wall_start
+            stats.cpu_time += time.process_time() - cpu_start
+            stats.calls += 1
+            stats.tokens += tokens
+            if peak_rss_start is not None:
+                peak_rss_growth = get_peak_rss_mb() - peak_rss_start
+                stats.peak_rss_growth_mb = max(stats.peak_rss_growth_mb or 0., peak_rss_growth)
+            if self.trace_malloc:
+                stats.peak_tracemalloc_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+
+    def wrap_phase(self, name: str, function: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def wrap_function(self, name: str, function: Callable) -> Callable:
+        if not self.per_function:
+            return function
+
+        stats = self.functions.setdefault(name, TimingStats())
+        perf_counter, process_time = time.perf_counter, time.process_time
+
+        def wrapper(*args, **kwargs):
+            wall_start, cpu_start = perf_counter(), process_time()
+            result = function(*args, **kwargs)
+            stats.wall_time += perf_counter() - wall_start
+            stats.cpu_time += process_time() - cpu_start
+            stats.calls += 1
+            return result
+        return wrapper
+
+    def wrap_iterable(self, name: str, iterable: Iterable) -> Iterator:
+        """
+        Accumulate time spent on producing items of iterable (e.g. parsing sentences) into a phase.
+        Items' lengths are accumulated as tokens.
+        """
+        stats = self.phases.setdefault(name, TimingStats())
+        iterator = iter(iterable)
+        while True:
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                stats.wall_time += time.perf_counter() - wall_start
+                stats.cpu_time += time.process_time() - cpu_start
+            stats.calls += 1
+            stats.tokens += len(item)
+            yield item
+
+    def add_remainder_phase(self, name: str, total_phase: str, nested_phases: List[str]) -> None:
+        """
+        Add a phase that took the time of total_phase excluding nested_phases.
+        Useful when phases are interleaved, like incremental parsing and scoring.
+        Nested phases that have not been recorded are ignored.
+        """
+        total = self.phases[total_phase]
+        nested_phases = [nested for nested in nested_phases if nested in self.phases]
+        stats = self.phases.setdefault(name, TimingStats())
+        stats.calls = total.calls
+        stats.tokens = total.tokens
+        stats.wall_time = total.wall_time - sum(self.phases[nested].wall_time for nested in nested_phases)
+        stats.cpu_time = total.cpu_time - sum(self.phases[nested].cpu_time for nested in nested_phases)
+
+    def to_dict(self) -> Dict:
+        return {
+            "phases": {name: stats.to_dict() for name, stats in self.phases.items()},
+            "functions": {name: stats.to_dict() for name, stats in self.functions.items()},
+            "peak_rss_mb": get_peak_rss_mb(),
+        }
+
+    def dump(self, json_file: str) -> None:
+        with open(json_file, 'w') as file:
+            json.dump(self.to_dict(), file, indent=4)
+
+    def summary(self) -> str:
+        """
+        Human-readable table. Throughput is tokens/sec for phases and calls/sec for functions.
+        """
+        lines = [f"{'':<24}{'wall, s':>10}{'cpu, s':>10}{'per sec':>12}{'peak RSS +MB':>14}"]
+        records = [(name, stats, stats.tokens) for name, stats in self.phases.items()]
+        records += [(f"  {name}", stats, stats.calls) for name, stats in self.functions.items()]
+        for name, stats, count in records:
+            throughput = f"{count / stats.wall_time:.0f}" if count and stats.wall_time > 0 else "-"
+            peak_rss = f"{stats.peak_rss_growth_mb:.1f}" if stats.peak_rss_growth_mb is not None else "-"
+            lines.append(
+                f"{name:<24}{stats.wall_time:>10.3f}{stats.cpu_time:>10.3f}{throughput:>12}{peak_rss:>14}"
+            )
+        peak_rss_mb = get_peak_rss_mb()
+        if peak_rss_mb is not None:
+            lines.append(f"Peak RSS of the process: {peak_rss_mb:.1f} MB")
+        return '\n'.join(lines)
@@ -0,0 +1,63 @@
+from typing import Optional
+
+
+class EvaluationError(Exception):
+    """
+    Base class of errors that make evaluation impossible.
+    """
+
+
+class AlignmentError(EvaluationError):
+    """
+    Test and gold sentences are not aligned with each other.
+    """
+
+
+class SentenceCountMismatchError(AlignmentError):
+    def __init__(self, test_count: Optional[int], gold_count: Optional[int]):
+        # Counts are known for the shorter input only, the longer one has at least one more sentence.
+        self.test_count = test_count
+        self.gold_count = gold_count
+        if test_count is not None:
+            message = f"Test has {test_count} sentences, while gold has more."
+        else:
+            message = f"Gold has {gold_count} sentences, while test has more."
+        super().__init__(message)
+
+
+class SentenceIdMismatchError(AlignmentError):
+    def __init__(self, test_sent_id: str, gold_sent_id: str):
+        self.test_sent_id = test_sent_id
+        self.gold_sent_id = gold_sent_id
+        super().__init__(
+            f"Test and gold sentence id mismatch: test sent_id={test_sent_id}, gold sent_id={gold_sent_id}."
+        )
+
+
+class SentenceLengthMismatchError(AlignmentError):
+    def __init__(self, sent_id: str, test_length: int, gold_length: int):
+        self.sent_id = sent_id
+        self.test_length = test_length
+        self.gold_length = gold_length
+        super().__init__(
+            f"Error at sent_id={sent_id} : Sentences must have equal number of tokens "
+            f"(test has {test_length}, gold has {gold_length})."
+        )
+
+
+class TokenMismatchError(AlignmentError):
+    def __init__(self, sent_id: str, token_index: int, test_form: str, gold_form: str):
+        self.sent_id = sent_id
+        self.token_index = token_index
+        self.test_form = test_form
+        self.gold_form = gold_form
+        super().__init__(
+            f"Error at sent_id={sent_id} : Sentence tokens mismatched "
+            f"(token #{token_index + 1}: test form '{test_form}', gold form '{gold_form}')."
+        )
+
+
+class UnknownSemclassError(EvaluationError):
+    def __init__(self, semclass: str):
+        self.semclass = semclass
+        super().__init__(f"Unknown gold semclass encountered: {semclass}")
@@ -0,0 +1,64 @@
+from functools import reduce
+from operator import add
+
+from typing import Sequence
+
+
+# Summation block parameters of numpy (see numpy/core/src/umath/loops_utils.h.src).
+PAIRWISE_BLOCK_SIZE = 128
+PAIRWISE_UNROLL = 8
+
+# Sequences at least this long are summed with numpy (if installed), which is faster.
+# Shorter ones are summed in pure Python (~0.1s per million values),
+# since importing numpy and converting values to an array would cost more.
+NUMPY_MIN_SIZE = 2 ** 20
+
+
+def _pairwise_sum(values: Sequence[float], start: int, stop: int) -> float:
+    n = stop - start
+    if n < PAIRWISE_UNROLL:
+        result = 0.
+        for i in range(start, stop):
+            result += values[i]
+        return result
+
+    if n <= PAIRWISE_BLOCK_SIZE:
+        # Eight partial sums over interleaved elements, then reduced in a tree-like manner.
+        unrolled_stop = stop - n % PAIRWISE_UNROLL
+        r = [reduce(add, values[start + j:unrolled_stop:PAIRWISE_UNROLL]) for j in range(PAIRWISE_UNROLL)]
+        result = ((r[0] + r[1]) + (r[2] + r[3])) + ((r[4] + r[5]) + (r[6] + r[7]))
+        for i in range(unrolled_stop, stop):
+            result += values[i]
+        return result
+
+    middle = n // 2
+    middle -= middle % PAIRWISE_UNROLL
+    return _pairwise_sum(values, start, start + middle) + _pairwise_sum(values, start + middle, stop)
+
+
+def pairwise_sum(values: Sequence[float]) -> float:
+    """
+    Sum values exactly the way `numpy.sum` sums a float64 array (i.e. with pairwise summation),
+    so that scores do not depend on whether numpy is installed.
+    """
+    if len(values) >= NUMPY_MIN_SIZE:
+        try:
+            import numpy as np
+        except ImportError:
+            pass
+        else:
+            return float(np.sum(np.asarray(values, dtype=np.float64)))
+
+    if not isinstance(values, (list, tuple)):
+        values = list(values)
+    return float(_pairwise_sum(values, 0, len(values)))
+
+
+def mean(values: Sequence[float]) -> float:
+    """
+    The same as `numpy.mean`.
+    """
+    if len(values) == 0:
+        # numpy returns nan (with a warning) as well.
+        return float("nan")
+    return pairwise_sum(values) / len(values)
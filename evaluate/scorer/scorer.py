@@ -1,15 +1,82 @@
 import sys
-import numpy as np
 
-from tqdm import tqdm
+from dataclasses import dataclass, asdict
+from itertools import zip_longest
+from typing import Iterable, Iterator, List, Tuple, Dict, Optional
+
+from scorer.errors import (
+    SentenceCountMismatchError,
+    SentenceIdMismatchError,
+    SentenceLengthMismatchError,
+    TokenMismatchError,
+    UnknownSemclassError
+)
+from scorer.numeric import pairwise_sum, mean
+from scorer.taxonomy import Taxonomy
+from semarkup import Sentence, SemarkupToken
 
-# zip `strict` is only available starting Python 3.10.
-from more_itertools import zip_equal
 
-from typing import Iterable, List, Tuple, Dict, Optional
+# Marks the end of the shorter input in align_sentences.
+_SENTINEL = object()
+
+
+def align_sentences(test_sentences: Iterable[Sentence],
+                    gold_sentences: Iterable[Sentence]) -> Iterator[Tuple[Sentence, Sentence]]:
+    """
+    Iterate over (test, gold) sentence pairs, making sure the sentences match each other.
+    Raise AlignmentError subclasses otherwise.
+    """
+    for sentence_index, (test_sentence, gold_sentence) in enumerate(
+        zip_longest(test_sentences, gold_sentences, fillvalue=_SENTINEL)
+    ):
+        if test_sentence is _SENTINEL:
+            raise SentenceCountMismatchError(test_count=sentence_index, gold_count=None)
+        if gold_sentence is _SENTINEL:
+            raise SentenceCountMismatchError(test_count=None, gold_count=sentence_index)
+
+        if test_sentence.sent_id != gold_sentence.sent_id:
+            raise SentenceIdMismatchError(test_sentence.sent_id, gold_sentence.sent_id)
+
+        if len(test_sentence) != len(gold_sentence):
+            raise SentenceLengthMismatchError(test_sentence.sent_id, len(test_sentence), len(gold_sentence))
+
+        yield test_sentence, gold_sentence
 
-from scorer.taxonomy import Taxonomy
-from semarkup import Sentence, SemarkupToken
+
+def progress_bar(iterable: Iterable) -> Iterable:
+    """
+    Wrap iterable into tqdm progress bar, if tqdm is installed and output is interactive.
+    """
+    if not sys.stdout.isatty():
+        return iterable
+    try:
+        from tqdm import tqdm
+    except ImportError:
+        return iterable
+    return tqdm(iterable, file=sys.stdout)
+
+
+def ratio(numerator: float, denominator: float) -> float:
+    return numerator / denominator if denominator != 0 else float("nan")
+
+
+@dataclass
+class SentenceScores:
+    """
+    Scores of a single sentence, averaged over its tokens (nan for empty sentences).
+    """
+    sent_id: str
+    n_tokens: int
+    lemma: float
+    pos: float
+    feats: float
+    head: float
+    deprel: float
+    semslot: float
+    semclass: float
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
 
 
 class SEMarkupScorer:
@@ -38,13 +105,13 @@ class SEMarkupScorer:
         return score
 
     def score_feats(self, test: SemarkupToken, gold: SemarkupToken) -> float:
-        correct_feats_weighted_sum = np.sum([
+        correct_feats_weighted_sum = pairwise_sum([
             (self.feats_weights[gram_cat] if self.feats_weights is not None else 1)
             * (gold.feats[gram_cat] == test.feats[gram_cat])
             for gram_cat in gold.feats
             if gram_cat in test.feats
         ])
-        gold_feats_weighted_sum = np.sum([
+        gold_feats_weighted_sum = pairwise_sum([
             (self.feats_weights[gram_cat] if self.feats_weights is not None else 1)
             for gram_cat in gold.feats
         ])
@@ -91,8 +158,8 @@ class SEMarkupScorer:
         if gold.semclass in self.semclasses_out_of_taxonomy:
             return test.semclass == gold.semclass
 
-        assert self.taxonomy.has_semclass(gold.semclass), \
-            f"Unknown gold semclass encountered: {gold.semclass}"
+        if not self.taxonomy.has_semclass(gold.semclass):
+            raise UnknownSemclassError(gold.semclass)
         if not self.taxonomy.has_semclass(test.semclass):
             return 0.
 
@@ -107,9 +174,15 @@ class SEMarkupScorer:
 
     def score_sentences(self,
                         test_sentences: Iterable[Sentence],
-                        gold_sentences: Iterable[Sentence]) -> Tuple[float]:
+                        gold_sentences: Iterable[Sentence],
+                        sentence_scores: List[SentenceScores] = None) -> Tuple[float]:
+        """
+        Return scores averaged over all tokens of all sentences.
+        If sentence_scores list is given, per-sentence scores are appended to it.
+        Raise EvaluationError subclasses if sentences cannot be scored (e.g. are misaligned).
+        """
         # Grammatical scores.
-        # Use 'list' and 'np.sum' instead of 'int' and '+=' for numerical stability.
+        # Use 'list' and 'pairwise_sum' instead of 'int' and '+=' for numerical stability.
         lemma_scores = []
         pos_scores = []
         feats_scores = []
@@ -134,17 +207,13 @@ class SEMarkupScorer:
         # and a lower score otherwise.
         lemma_gold_scores = []
 
-        for test_sentence, gold_sentence in tqdm(zip_equal(test_sentences, gold_sentences), file=sys.stdout):
-            assert test_sentence.sent_id == gold_sentence.sent_id, \
-                f"Test and gold sentence id mismatch at test_sentence.sent_id={test_sentence.sent_id}."
-
-            assert len(test_sentence) == len(gold_sentence), \
-                f"Error at sent_id={test_sentence.sent_id} : Sentences must have equal number of tokens."
+        for test_sentence, gold_sentence in progress_bar(align_sentences(test_sentences, gold_sentences)):
+            sentence_start = len(lemma_scores)
 
-            for test_token, gold_token in zip_equal(test_sentence, gold_sentence):
+            for token_index, (test_token, gold_token) in enumerate(zip(test_sentence, gold_sentence)):
 
-                assert test_token.form == gold_token.form, \
-                    f"Error at sent_id={test_sentence.sent_id} : Sentence tokens mismatched."
+                if test_token.form != gold_token.form:
+                    raise TokenMismatchError(test_sentence.sent_id, token_index, test_token.form, gold_token.form)
 
                 # Score test_token.
                 lemma_score = self.score_lemma(test_token, gold_token)
@@ -170,15 +239,50 @@ class SEMarkupScorer:
                 # Accumulate gold scores.
                 lemma_gold_scores.append(lemma_gold_score)
 
+            if sentence_scores is not None:
+                sentence_slice = slice(sentence_start, len(lemma_scores))
+                sentence_scores.append(SentenceScores(
+                    sent_id=gold_sentence.sent_id,
+                    n_tokens=len(gold_sentence),
+                    lemma=ratio(pairwise_sum(lemma_scores[sentence_slice]),
+                                pairwise_sum(lemma_gold_scores[sentence_slice])),
+                    pos=mean(pos_scores[sentence_slice]),
+                    feats=mean(feats_scores[sentence_slice]),
+                    head=mean(head_scores[sentence_slice]),
+                    deprel=mean(deprel_scores[sentence_slice]),
+                    semslot=mean(semslot_scores[sentence_slice]),
+                    semclass=mean(semclass_scores[sentence_slice])
+                ))
+
+        return self.average_scores(
+            lemma_scores,
+            lemma_gold_scores,
+            pos_scores,
+            feats_scores,
+            head_scores,
+            deprel_scores,
+            semslot_scores,
+            semclass_scores
+        )
+
+    def average_scores(self,
+                       lemma_scores: List[float],
+                       lemma_gold_scores: List[float],
+                       pos_scores: List[float],
+                       feats_scores: List[float],
+                       head_scores: List[float],
+                       deprel_scores: List[float],
+                       semslot_scores: List[float],
+                       semclass_scores: List[float]) -> Tuple[float]:
         # Average per-token scores over all tokens in all sentences.
         # Note that we cannot just average lemma_scores, for they are weighted.
-        lemma_avg_score = np.sum(lemma_scores) / np.sum(lemma_gold_scores)
-        pos_avg_score = np.mean(pos_scores)
-        feats_avg_score = np.mean(feats_scores)
-        head_avg_score = np.mean(head_scores)
-        deprel_avg_score = np.mean(deprel_scores)
-        semslot_avg_score = np.mean(semslot_scores)
-        semclass_avg_score = np.mean(semclass_scores)
+        lemma_avg_score = pairwise_sum(lemma_scores) / pairwise_sum(lemma_gold_scores)
+        pos_avg_score = mean(pos_scores)
+        feats_avg_score = mean(feats_scores)
+        head_avg_score = mean(head_scores)
+        deprel_avg_score = mean(deprel_scores)
+        semslot_avg_score = mean(semslot_scores)
+        semclass_avg_score = mean(semclass_scores)
 
         assert 0. <= lemma_avg_score <= 1.
         assert 0. <= pos_avg_score <= 1.
@@ -1,89 +1,80 @@
-import pandas as pd
+import csv
 from collections import Counter
 
-from typing import Tuple, List, Dict, Any
+from typing import Tuple, List, Dict
 
 from scorer.lca import find_lca
 
 
-# Common functions.
-def is_unique(series: pd.Series) -> bool:
-    return len(series.unique()) == len(series)
-
-def enumerate_column(df: pd.DataFrame, column_name: str) -> Dict[int, Any]:
-    return {index: value for index, value in enumerate(df[column_name])}
-
-def enumerate_column_inv(df: pd.DataFrame, column_name: str) -> Dict[int, Any]:
-    # Ensure column has unique values.
-    assert is_unique(df[column_name])
-    return {value: index for index, value in enumerate(df[column_name])}
+# Taxonomy CSV columns.
+ID, PARENT_ID, DEPTH, NAME = range(4)
 
 
 class Taxonomy:
     """
     Taxonomy of semantic classes.
+
+    Only named semantic classes and their ancestors are ever visited when measuring distances,
+    so just this part of the taxonomy (about a hundred times smaller than the whole one) is kept in memory.
+    `parents` and `depths` are indexed by contiguous node indexes of that part.
     """
     SEMCLASS_TYPE_ID = 0
 
     def __init__(self, taxonomy_file: str):
-        taxonomy_df = Taxonomy.load(taxonomy_file)
-        self.parents = Taxonomy.extract_parents(taxonomy_df)
-        self.depths = Taxonomy.extract_depths(taxonomy_df)
+        rows = Taxonomy.load(taxonomy_file)
         # Semclass tricks.
-        semclass_counter = Counter(taxonomy_df["Name"])
+        semclass_counter = Counter(row[NAME] for row in rows)
         for i, (semclass, count) in enumerate(semclass_counter.items()):
             # All taxonomy semclasses (except the most frequent one) must be unique.
             if i != 0:
                 assert count == 1
-        masked_semclass = semclass_counter.most_common(1)[0]
-        self.semclass_to_idx = {value: index
-                                for index, value in enumerate(taxonomy_df["Name"])
-                                if value not in masked_semclass}
+        masked_semclass = semclass_counter.most_common(1)[0][0]
+        semclass_rows = [row for row in rows if row[NAME] != masked_semclass]
+        self.parents, self.depths, self.semclass_to_idx = Taxonomy.extract_semclass_forest(rows, semclass_rows)
 
     @staticmethod
-    def load(taxonomy_file_csv: str) -> pd.DataFrame:
-        taxonomy = pd.read_csv(
-            taxonomy_file_csv,
-            dtype={
-                'ID': int,
-                'ParentID': 'Int64',
-                'Depth': int,
-                'Name': str,
-            }
-        )
-        return taxonomy
-
-    @staticmethod
-    def extract_parents(taxonomy: pd.DataFrame) -> List[int]:
-        # Enumerate nodes in a contiguous manner from 0 to max(taxonomy.index)
-        node_id_to_idx = enumerate_column_inv(taxonomy, "ID")
-        node_id_to_parent_id = taxonomy.set_index("ID")['ParentID'].to_dict()
-        node_idx_to_parent_idx = {
-            node_id_to_idx[node_id]: (node_id_to_idx[parent_id] if not pd.isna(parent_id) else -1)
-            for node_id, parent_id in node_id_to_parent_id.items()
-        }
-
-        # Continuous array of parents, i.e. parents[i] = {parent of node with index i}.
-        parents = [0] * len(taxonomy)
-
-        for node_idx in range(len(taxonomy)):
-            parents[node_idx] = node_idx_to_parent_idx[node_idx]
-
-        return parents
+    def load(taxonomy_file_csv: str) -> List[List[str]]:
+        """
+        Return raw (ID, ParentID, Depth, Name) rows of taxonomy table.
+        """
+        with open(taxonomy_file_csv, 'r', newline='') as file:
+            reader = csv.reader(file)
+            header = next(reader)
+            assert header == ["ID", "ParentID", "Depth", "Name"], f"Unexpected taxonomy columns: {header}"
+            rows = list(reader)
+        return rows
 
     @staticmethod
-    def extract_depths(taxonomy: pd.DataFrame) -> List[int]:
-        # Enumerate nodes in a contiguous manner from 0 to max(taxonomy.index)
-        node_idx_to_depth = enumerate_column(taxonomy, "Depth")
-
-        # Continuous array of depths, i.e. depths[i] = {depth of node with index i}.
-        depths = [0] * len(taxonomy)
-
-        for node_idx in range(len(taxonomy)):
-            depths[node_idx] = node_idx_to_depth[node_idx]
+    def extract_semclass_forest(rows: List[List[str]],
+                                semclass_rows: List[List[str]]) -> Tuple[List[int], List[int], Dict[str, int]]:
+        """
+        Extract semclasses along with all their ancestors.
+        Return continuous arrays of parents and depths
+        (i.e. parents[i] = {parent of node with index i}, -1 for roots, depths[i] = {depth of node with index i})
+        and semclass -> node index mapping.
+        """
+        node_id_to_row = {row[ID]: row for row in rows}
+        # Ensure IDs are unique.
+        assert len(node_id_to_row) == len(rows)
+
+        # Enumerate nodes in a contiguous manner, ancestors are enumerated after their descendants.
+        node_id_to_idx = {}
+        for row in semclass_rows:
+            node_id = row[ID]
+            while node_id != '' and node_id not in node_id_to_idx:
+                node_id_to_idx[node_id] = len(node_id_to_idx)
+                node_id = node_id_to_row[node_id][PARENT_ID]
+
+        parents = [0] * len(node_id_to_idx)
+        depths = [0] * len(node_id_to_idx)
+        for node_id, node_idx in node_id_to_idx.items():
+            parent_id = node_id_to_row[node_id][PARENT_ID]
+            parents[node_idx] = node_id_to_idx[parent_id] if parent_id != '' else -1
+            depths[node_idx] = int(node_id_to_row[node_id][DEPTH])
             assert 0 <= depths[node_idx]
 
-        return depths
+        semclass_to_idx = {row[NAME]: node_id_to_idx[row[ID]] for row in semclass_rows}
+        return parents, depths, semclass_to_idx
 
     def has_semclass(self, semclass: str) -> bool:
         return semclass in self.semclass_to_idx
@@ -1,13 +1,14 @@
 import argparse
 import json
+import math
+import os
 import re
 
-import conllu
+from collections import Counter
+from multiprocessing import Pool
 
-import numpy as np
-
-from conllu.models import TokenList, Token
-from typing import Iterable, List, Tuple, Dict, Optional, TextIO
+from conllu.parser import parse_dict_value
+from typing import Iterable, List, Tuple, Dict, Optional
 
 from tqdm import tqdm
 
@@ -36,29 +37,125 @@ IMMUTABLE_POS = {
 }
 IMMUTABLE_POS_LEMMA_WEIGHT = 0.3
 
+# Size of a chunk (in bytes) a single worker processes at a time.
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+# The same column separator conllu uses.
+COLUMNS_SEPARATOR = re.compile(r"\t| {2,}")
+UPOS_COLUMN = CONLLU_FIELDS.index("upos")
+FEATS_COLUMN = CONLLU_FIELDS.index("feats")
+
 
 def dump_dict_to_json(data: Dict, json_file: str) -> None:
     with open(json_file, 'w') as file:
         json.dump(data, file, indent=4)
 
 
-def collect_tagsets(sentences: Iterable[TokenList]) -> Tuple[set, Dict[str, set]]:
-    pos_set = set()
-    feats_set = {}
+class TagsetStats:
+    """
+    POS and grammemes frequencies collected from a part of a CoNLL-U dataset.
+    Partial stats are mergeable, so a dataset can be processed in independent chunks.
+    """
+    def __init__(self):
+        self.pos_counts = Counter()
+        # Grammatical category -> grammeme -> count.
+        self.feats_counts = {}
+
+    def add_token(self, pos: str, feats: Optional[Dict[str, str]]) -> None:
+        self.pos_counts[pos] += 1
+
+        if feats is not None:
+            for gram_cat, grammeme in feats.items():
+                if gram_cat not in self.feats_counts:
+                    self.feats_counts[gram_cat] = Counter()
+                self.feats_counts[gram_cat][grammeme] += 1
+
+    def merge(self, other: 'TagsetStats') -> 'TagsetStats':
+        """
+        Merge other stats into these ones (inplace).
+        Merging chunks in file order keeps categories in order of their first occurrence.
+        """
+        self.pos_counts.update(other.pos_counts)
+        for gram_cat, grammemes_counts in other.feats_counts.items():
+            if gram_cat not in self.feats_counts:
+                self.feats_counts[gram_cat] = Counter()
+            self.feats_counts[gram_cat].update(grammemes_counts)
+        return self
+
+    @property
+    def pos_set(self) -> set:
+        return set(self.pos_counts)
+
+    @property
+    def feats_set(self) -> Dict[str, set]:
+        return {gram_cat: set(grammemes_counts) for gram_cat, grammemes_counts in self.feats_counts.items()}
+
+
+def split_into_chunks(file_path: str, chunk_size: int) -> List[Tuple[str, int, int]]:
+    """
+    Split CoNLL-U file into (file_path, begin, end) byte ranges of approximately chunk_size bytes.
+    Ranges are aligned to sentences' boundaries (i.e. empty lines), so they can be parsed independently.
+    """
+    file_size = os.path.getsize(file_path)
+
+    chunks = []
+    with open(file_path, 'rb') as file:
+        begin = 0
+        while begin < file_size:
+            # Move forward to the start of the next line, so that the tail of a line
+            # (e.g. a bare newline) is not mistaken for an empty one.
+            file.seek(min(begin + chunk_size, file_size) - 1)
+            file.readline()
+            # Then to the end of the current sentence.
+            for line in file:
+                if line.strip() == b'':
+                    break
+            end = min(file.tell(), file_size)
+            chunks.append((file_path, begin, end))
+            begin = end
+
+    return chunks
+
+
+def collect_chunk_stats(chunk: Tuple[str, int, int]) -> TagsetStats:
+    """
+    Collect tagset stats from a chunk of CoNLL-U file.
+    Only 'upos' and 'feats' columns are parsed (the same way conllu does).
+    """
+    file_path, begin, end = chunk
+
+    with open(file_path, 'rb') as file:
+        file.seek(begin)
+        text = file.read(end - begin).decode('utf-8')
+
+    stats = TagsetStats()
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        columns = COLUMNS_SEPARATOR.split(line)
+        feats = parse_dict_value(columns[FEATS_COLUMN]) if FEATS_COLUMN < len(columns) else None
+        stats.add_token(columns[UPOS_COLUMN], feats)
 
-    for sentence in tqdm(sentences):
-        for token in sentence:
-            pos = token["upos"]
-            pos_set.add(pos)
+    return stats
 
-            feats = token["feats"]
-            if feats is not None:
-                for gram_cat, grammeme in feats.items():
-                    if gram_cat not in feats_set:
-                        feats_set[gram_cat] = set()
-                    feats_set[gram_cat].add(grammeme)
 
-    return pos_set, feats_set
+def collect_tagset_stats(file_paths: Iterable[str], num_workers: int, chunk_size: int) -> TagsetStats:
+    chunks = []
+    for file_path in file_paths:
+        chunks += split_into_chunks(file_path, chunk_size)
+
+    stats = TagsetStats()
+    if num_workers <= 1:
+        for chunk in tqdm(chunks):
+            stats.merge(collect_chunk_stats(chunk))
+    else:
+        with Pool(num_workers) as pool:
+            # imap (unlike imap_unordered) keeps chunks order, so the result is deterministic.
+            for chunk_stats in tqdm(pool.imap(collect_chunk_stats, chunks), total=len(chunks)):
+                stats.merge(chunk_stats)
+
+    return stats
 
 
 def set_lemma_weights(pos_set: set,
@@ -95,17 +192,49 @@ def estimate_feats_weights(feats_set: Dict[str, set]):
     return feats_weights
 
 
-def main(tagset_file_path: str, lemma_weights_file_path: str, feats_weights_file_path: str):
-    with open(tagset_file_path, 'r') as tagset_file:
-        sentences = conllu.parse_incr(tagset_file, fields=CONLLU_FIELDS)
-        pos_set, feats_set = collect_tagsets(sentences)
+def estimate_feats_entropy_weights(feats_counts: Dict[str, Counter]) -> Dict[str, float]:
+    """
+    Frequency-based alternative to estimate_feats_weights.
+    Weight of grammatical category is its perplexity, i.e. 2 to the power of grammemes' entropy.
+    It is the "effective" size of a category: equal to its size if grammemes are uniformly distributed,
+    and smaller if some grammemes are rare (hence are not that hard to guess).
+    """
+    feats_weights = {}
+    for gram_cat, grammemes_counts in feats_counts.items():
+        total = sum(grammemes_counts.values())
+        entropy = -sum(
+            count / total * math.log2(count / total)
+            for count in grammemes_counts.values()
+        )
+        feats_weights[gram_cat] = 2 ** entropy
+
+    return feats_weights
+
+
+def estimate_pos_frequencies(pos_counts: Counter) -> Dict[str, float]:
+    total = sum(pos_counts.values())
+    return {pos: count / total for pos, count in pos_counts.most_common()}
+
+
+def main(tagset_file_paths: List[str],
+         lemma_weights_file_path: str,
+         feats_weights_file_path: str,
+         feats_entropy_weights_file_path: str = None,
+         pos_frequencies_file_path: str = None,
+         num_workers: int = 1,
+         chunk_size: int = DEFAULT_CHUNK_SIZE):
+    stats = collect_tagset_stats(tagset_file_paths, num_workers, chunk_size)
 
-    lemma_weights = set_lemma_weights(pos_set, IMMUTABLE_POS, IMMUTABLE_POS_LEMMA_WEIGHT)
-    feats_weights = estimate_feats_weights(feats_set)
+    lemma_weights = set_lemma_weights(stats.pos_set, IMMUTABLE_POS, IMMUTABLE_POS_LEMMA_WEIGHT)
+    feats_weights = estimate_feats_weights(stats.feats_set)
 
     print("Dump weights.")
     dump_dict_to_json(lemma_weights, lemma_weights_file_path)
     dump_dict_to_json(feats_weights, feats_weights_file_path)
+    if feats_entropy_weights_file_path is not None:
+        dump_dict_to_json(estimate_feats_entropy_weights(stats.feats_counts), feats_entropy_weights_file_path)
+    if pos_frequencies_file_path is not None:
+        dump_dict_to_json(estimate_pos_frequencies(stats.pos_counts), pos_frequencies_file_path)
     print("Done.")
 
 
@@ -114,9 +243,10 @@ if __name__ == "__main__":
         description="This script estimates lemma- and feats- weights based on their frequencies in a tagset."
     )
     parser.add_argument(
-        'tagset_file',
+        'tagset_files',
         type=str,
-        help='Input tagset file in CONLL-U format.'
+        nargs='+',
+        help='Input tagset file(s) in CONLL-U format.'
     )
     parser.add_argument(
         'lemma_weights_file',
@@ -128,7 +258,39 @@ if __name__ == "__main__":
         type=str,
         help='Output JSON file with feats weights estimated based .'
     )
+    parser.add_argument(
+        '-feats_entropy_weights_file',
+        type=str,
+        help='Optional output JSON file with entropy-based feats weights.',
+        default=None
+    )
+    parser.add_argument(
+        '-pos_frequencies_file',
+        type=str,
+        help='Optional output JSON file with relative frequencies of POS tags.',
+        default=None
+    )
+    parser.add_argument(
+        '-num_workers',
+        type=int,
+        help='Number of worker processes. Defaults to the number of CPUs.',
+        default=os.cpu_count()
+    )
+    parser.add_argument(
+        '-chunk_size',
+        type=int,
+        help='Approximate size (in bytes) of a dataset chunk processed by a worker at a time.',
+        default=DEFAULT_CHUNK_SIZE
+    )
     args = parser.parse_args()
 
-    main(args.tagset_file, args.lemma_weights_file, args.feats_weights_file)
+    main(
+        args.tagset_files,
+        args.lemma_weights_file,
+        args.feats_weights_file,
+        args.feats_entropy_weights_file,
+        args.pos_frequencies_file,
+        args.num_workers,
+        args.chunk_size
+    )
 
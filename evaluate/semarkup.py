@@ -1,13 +1,33 @@
-import conllu
+import re
 
-import collections
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, TextIO, Tuple, Union
 
-from typing import Iterator, Iterable, TextIO, List, Union
-from conllu.models import TokenList
+
+SEMARKUP_FIELDS = [
+    "id",
+    "form",
+    "lemma",
+    "upos",
+    "xpos",
+    "feats",
+    "head",
+    "deprel",
+    "semslot",
+    "semclass"
+]
+
+# Column separator and value formats, the same conllu uses.
+COLUMNS_SEPARATOR = re.compile(r"\t| {2,}")
+INTEGER = re.compile(r"0|(\-?[1-9][0-9]*)")
+ID_SINGLE = re.compile(r"(?:0|[1-9][0-9]*)")
+ID_RANGE = re.compile(r"[1-9][0-9]*\-[1-9][0-9]*")
+ID_DOT_ID = re.compile(r"[0-9][0-9]*\.[1-9][0-9]*")
 
 
 class SemarkupToken:
-    def __init__(self, conllu_token: conllu.models.Token):
+    __slots__ = ("id", "form", "lemma", "upos", "pos", "xpos", "feats", "head", "deprel", "semslot", "semclass")
+
+    def __init__(self, conllu_token: Mapping[str, Any]):
         self.id = conllu_token["id"]
         self.form = conllu_token["form"]
         self.lemma = conllu_token["lemma"]
@@ -22,58 +42,247 @@ class SemarkupToken:
 
 
 class Sentence:
-    def __init__(self, sentence: TokenList):
-        self.sentence = sentence
-        self.sent_id = sentence.metadata['sent_id']
+    """
+    Parsed SEMarkup sentence, i.e. a list of tokens along with metadata (e.g. sent_id).
+    """
+    def __init__(self, tokens: List[SemarkupToken], metadata: Dict[str, Optional[str]], text: str = None):
+        self.tokens = tokens
+        self.metadata = metadata
+        self.sent_id = metadata['sent_id']
+        # Raw SEMarkup text of the sentence (if any), used for serialization.
+        self.text = text
+
+    @classmethod
+    def from_token_list(cls, sentence) -> "Sentence":
+        """
+        Build sentence from conllu.models.TokenList.
+        """
+        return cls([SemarkupToken(token) for token in sentence], sentence.metadata, sentence.serialize())
 
     def __getitem__(self, index: int) -> SemarkupToken:
-        return SemarkupToken(self.sentence[index])
+        return self.tokens[index]
 
     def __len__(self) -> int:
-        return len(self.sentence)
+        return len(self.tokens)
+
+    def __iter__(self) -> Iterator[SemarkupToken]:
+        return iter(self.tokens)
 
     def serialize(self) -> str:
-        return self.sentence.serialize()
+        # Serialize the way conllu does. It is only used in error messages, so conllu is imported lazily.
+        import conllu
+        text = self.text if self.text is not None else format_sentence(self)
+        return conllu.parse(text, fields=SEMARKUP_FIELDS)[0].serialize()
+
+
+# Values parsing. Functions follow conllu.parser ones, but raise ValueError on invalid values.
+def parse_nullable_value(value: str) -> Optional[str]:
+    if not value or value == "_":
+        return None
+    return value
+
+def parse_id_value(value: str) -> Optional[Union[int, Tuple[int, str, int]]]:
+    if not value or value == '_':
+        return None
+
+    if ID_SINGLE.fullmatch(value):
+        return int(value)
+    elif ID_RANGE.fullmatch(value):
+        from_str, to_str = value.split("-")
+        from_, to = int(from_str), int(to_str)
+        if to >= from_:
+            return (from_, "-", to)
+    elif ID_DOT_ID.fullmatch(value):
+        return (int(value.split(".")[0]), ".", int(value.split(".")[1]))
+
+    raise ValueError(f"'{value}' is not a valid ID.")
+
+def parse_int_value(value: str) -> Optional[int]:
+    if value == '_':
+        return None
+    if INTEGER.fullmatch(value):
+        return int(value)
+    raise ValueError(f"'{value}' is not a valid integer value.")
+
+def parse_dict_value(value: str) -> Optional[Dict[str, Optional[str]]]:
+    if parse_nullable_value(value) is None:
+        return None
+
+    return {
+        part.split("=")[0]: parse_nullable_value(part.split("=")[1]) if "=" in part else ""
+        for part in value.split("|") if parse_nullable_value(part.split("=")[0]) is not None
+    }
+
+# Parsers of non-string SEMarkup fields, other fields are kept as is.
+FIELD_PARSERS = {
+    "id": parse_id_value,
+    "xpos": parse_nullable_value,
+    "feats": parse_dict_value,
+    "head": parse_int_value,
+}
+
+def parse_comment_line(line: str, metadata: Dict[str, Optional[str]]) -> None:
+    key_maybe_value = line[1:].split('=', 1)
+    key = key_maybe_value[0].strip()
+    value = None if len(key_maybe_value) == 1 else key_maybe_value[1].strip()
+
+    # Lines without value are skipped, except for paragraph and document boundaries.
+    if key in ("newpar", "newdoc") or (key and value):
+        metadata[key] = value
 
+def parse_token_line(line: str) -> SemarkupToken:
+    columns = COLUMNS_SEPARATOR.split(line)
+    if len(columns) < len(SEMARKUP_FIELDS):
+        raise ValueError(f"Invalid line format, SEMarkup line must have {len(SEMARKUP_FIELDS)} columns:\n{line}")
 
-class SentenceIterator(collections.abc.Iterator):
-    def __init__(self, conllu_sentences: Iterable[TokenList]):
-        self.conllu_sentences = conllu_sentences
+    token = SemarkupToken.__new__(SemarkupToken)
+    token.id = parse_id_value(columns[0])
+    token.form = columns[1]
+    token.lemma = columns[2]
+    token.upos = token.pos = columns[3]
+    token.xpos = parse_nullable_value(columns[4])
+    feats = parse_dict_value(columns[5])
+    token.feats = feats if feats is not None else {}
+    token.head = parse_int_value(columns[6])
+    token.deprel = columns[7]
+    token.semslot = columns[8]
+    token.semclass = columns[9]
+    return token
 
-    def __next__(self) -> Sentence:
-        return Sentence(next(self.conllu_sentences))
+def parse_sentence(lines: List[str]) -> Sentence:
+    tokens = []
+    metadata = {}
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            parse_comment_line(line, metadata)
+        else:
+            tokens.append(parse_token_line(line))
+    return Sentence(tokens, metadata, ''.join(lines))
 
+def parse_sentences(file: TextIO) -> Iterator[Sentence]:
+    """
+    Parse SEMarkup file incrementally, sentence by sentence (sentences are separated with blank lines).
+    """
+    lines = []
+    for line in file:
+        if line.strip() == "":
+            if lines:
+                yield parse_sentence(lines)
+                lines = []
+        else:
+            lines.append(line)
+    if lines:
+        yield parse_sentence(lines)
 
-def parse_semarkup(file: TextIO, incr: bool) -> Union[SentenceIterator, List[SemarkupToken]]:
-    semarkup_fields = [
-        "id",
-        "form",
-        "lemma",
-        "upos",
-        "xpos",
-        "feats",
-        "head",
-        "deprel",
-        "semslot",
-        "semclass"
-    ]
 
+def format_value(value: Any) -> str:
+    if value is None or value == {}:
+        return '_'
+    if isinstance(value, tuple):
+        # Multiword or empty node id.
+        return ''.join(map(str, value))
+    if isinstance(value, dict):
+        return '|'.join(f"{key}={gram}" if gram != "" else key for key, gram in value.items())
+    return str(value)
+
+def format_sentence(sentence: Sentence) -> str:
+    """
+    Format sentence as SEMarkup text.
+    """
+    lines = [f"# {key} = {value}" if value is not None else f"# {key}" for key, value in sentence.metadata.items()]
+    for token in sentence:
+        lines.append('\t'.join(format_value(getattr(token, field)) for field in SEMARKUP_FIELDS))
+    return '\n'.join(lines) + '\n\n'
+
+
+def sentences_from_columns(columns: Mapping[str, Sequence[Sequence[Any]]],
+                           sent_ids: Sequence[str] = None) -> List[Sentence]:
+    """
+    Build sentences from columnar data, i.e. SEMarkup field name -> per-sentence lists of values, e.g.
+    {"form": [["Мама", "мыла", "раму"], ...], "head": [[2, 0, 2], ...], ...}.
+
+    Values are either strings (the way they are written in SEMarkup files) or already parsed ones
+    (e.g. integer heads and dictionaries of feats). "form" column is required,
+    ids are enumerated from 1 if "id" column is missing, other missing columns are filled with '_'.
+    Sentence ids are enumerated from 1 if sent_ids are not given.
+    """
+    if "form" not in columns:
+        raise ValueError("'form' column is required.")
+    unknown_fields = set(columns) - set(SEMARKUP_FIELDS)
+    if unknown_fields:
+        raise ValueError(f"Unknown columns: {sorted(unknown_fields)}.")
+
+    n_sentences = len(columns["form"])
+    for field, column in columns.items():
+        if len(column) != n_sentences:
+            raise ValueError(f"Column '{field}' has {len(column)} sentences, while 'form' has {n_sentences}.")
+    if sent_ids is None:
+        sent_ids = [str(sentence_index + 1) for sentence_index in range(n_sentences)]
+    elif len(sent_ids) != n_sentences:
+        raise ValueError(f"There are {len(sent_ids)} sentence ids for {n_sentences} sentences.")
+
+    sentences = []
+    for sentence_index, sent_id in enumerate(sent_ids):
+        n_tokens = len(columns["form"][sentence_index])
+        sentence_columns = {}
+        for field in SEMARKUP_FIELDS:
+            if field in columns:
+                values = columns[field][sentence_index]
+                if len(values) != n_tokens:
+                    raise ValueError(
+                        f"Column '{field}' of sentence {sent_id} has {len(values)} values, while it has {n_tokens} tokens."
+                    )
+            elif field == "id":
+                values = range(1, n_tokens + 1)
+            else:
+                values = ['_'] * n_tokens
+
+            field_parser = FIELD_PARSERS.get(field)
+            if field_parser is not None:
+                values = [field_parser(value) if isinstance(value, str) else value for value in values]
+            sentence_columns[field] = values
+
+        tokens = [
+            SemarkupToken({field: sentence_columns[field][token_index] for field in SEMARKUP_FIELDS})
+            for token_index in range(n_tokens)
+        ]
+        sentences.append(Sentence(tokens, {"sent_id": sent_id}))
+
+    return sentences
+
+
+def load_semarkup(file_path: str) -> List[Sentence]:
+    """
+    Parse the whole SEMarkup file into a list of Sentences, e.g. to score several test files against it.
+    """
+    with open(file_path, 'r') as file:
+        return list(parse_sentences(file))
+
+
+def parse_semarkup(file: TextIO, incr: bool) -> Union[Iterator[Sentence], List]:
+    """
+    If incr is set, return an iterator over parsed Sentences (only standard library is used).
+    Otherwise, return a list of mutable conllu.models.TokenList's (requires conllu).
+    """
     assert not file.closed
 
     if incr:
-        # Return SentenceIterator
-        sentences = SentenceIterator(conllu.parse_incr(file, fields=semarkup_fields))
+        # Return iterator
+        sentences = parse_sentences(file)
     else:
         # Return list
-        sentences = conllu.parse(file.read(), fields=semarkup_fields)
+        import conllu
+        sentences = conllu.parse(file.read(), fields=SEMARKUP_FIELDS)
 
     return sentences
 
 
-def write_semarkup(file_path: str, sentences: List[TokenList]) -> None:
+def write_semarkup(file_path: str, sentences: List) -> None:
     sentences_serialized = []
     for sentence in sentences:
         sentences_serialized.append(sentence.serialize())
     with open(file_path, 'w') as file:
         file.write(''.join(sentences_serialized))
-
@@ -1,17 +1,16 @@
-import os
+import io
 import sys
 import argparse
-import subprocess
-import re
-import tempfile
 import random
 import copy
 
-from typing import List, Tuple
+from typing import List
 from conllu.models import TokenList
 
 sys.path.insert(0,'..')
-from semarkup import parse_semarkup, write_semarkup
+from semarkup import parse_semarkup, load_semarkup, Sentence
+from evaluate import Evaluator
+from scorer.errors import SentenceCountMismatchError, SentenceLengthMismatchError
 
 
 def make_trash_tags(sentences: List[TokenList]) -> List[TokenList]:
@@ -79,38 +78,28 @@ def make_random_tags(sentences: List[TokenList]) -> List[TokenList]:
     return random_tag_sentences
 
 
-def run_test(sentences, evaluate_args):
-    tmpfile = tempfile.NamedTemporaryFile(delete=False)
-    write_semarkup(tmpfile.name, sentences)
+def run_test(sentences: List[TokenList], evaluator: Evaluator, gold_sentences: List[Sentence]) -> List[float]:
+    # Serialize and parse test sentences back, so that they are scored exactly the way a test file would be.
+    test_text = ''.join(sentence.serialize() for sentence in sentences)
+    test_sentences = parse_semarkup(io.StringIO(test_text), incr=True)
 
-    evaluate_args[2] = tmpfile.name
-    print(f"Command to be run: {evaluate_args}")
-    result = subprocess.run(evaluate_args, capture_output=True)
-
-    tmpfile.close()
-    os.unlink(tmpfile.name)
-
-    out = result.stdout.decode('utf-8')
+    result = evaluator.evaluate(test_sentences, gold_sentences)
     print()
     print("Test output:")
-    print(out)
-
-    err = result.stderr.decode('utf-8')
-    if len(err) != 0:
-        print(err)
-        assert False
-
-    scores = []
-    scores += re.findall("Total score: ([0|1]\.[0-9]*)", out)
-    scores += re.findall("Lemmatization score: ([0|1]\.[0-9]*)", out)
-    scores += re.findall("POS score: ([0|1]\.[0-9]*)", out)
-    scores += re.findall("Feats score: ([0|1]\.[0-9]*)", out)
-    scores += re.findall("LAS: ([0|1]\.[0-9]*)", out)
-    scores += re.findall("UAS: ([0|1]\.[0-9]*)", out)
-    scores += re.findall("SemSlot score: ([0|1]\.[0-9]*)", out)
-    scores += re.findall("SemClass score: ([0|1]\.[0-9]*)", out)
-    assert len(scores) == 8
-    return list(map(float, scores))
+    print(result.as_tuple())
+    return list(result.as_tuple())
+
+
+def expect_error(error_type: type, sentences: List[TokenList], evaluator: Evaluator, gold_sentences: List[Sentence]) -> bool:
+    try:
+        run_test(sentences, evaluator, gold_sentences)
+    except error_type as e:
+        print(f"Exception successfuly caught: {e}")
+        return True
+    # Must not reach this place.
+    print("TEST FAILED:")
+    print(f"{error_type.__name__} expected, but none was found.")
+    return False
 
 
 def main(gold_file_path: str) -> None:
@@ -118,18 +107,14 @@ def main(gold_file_path: str) -> None:
     print("Load sentences...")
     with open(gold_file_path, "r") as file:
         sentences = parse_semarkup(file, incr=False)
-
-    evaluate_args = [
-        'python3',
-        '../evaluate.py',
-        'here goes tmp file',
-        gold_file_path,
-    ]
+    # Gold sentences and taxonomy are loaded once and reused by all tests.
+    gold_sentences = load_semarkup(gold_file_path)
+    evaluator = Evaluator()
 
     print()
     print("========== Gold tags test (1/5) ==========")
     print()
-    scores = run_test(sentences, evaluate_args)
+    scores = run_test(sentences, evaluator, gold_sentences)
     for score in scores:
         assert score == 1.0
     print("Passed.")
@@ -138,7 +123,7 @@ def main(gold_file_path: str) -> None:
     print("========== Trash tags test (2/5) ==========")
     print()
     trash_tag_sentences = make_trash_tags(sentences)
-    scores = run_test(trash_tag_sentences, evaluate_args)
+    scores = run_test(trash_tag_sentences, evaluator, gold_sentences)
     for score in scores:
         assert score == 0.0
     print("Passed.")
@@ -146,36 +131,18 @@ def main(gold_file_path: str) -> None:
     print()
     print("========== Sentence count mismatch test (3/5) ==========")
     print()
-    # 1
-    is_passed = True
-    try:
-        run_test(sentences[:-1], evaluate_args)
-        # Must not reach this place.
-        is_passed = False
-    except Exception as e:
-        print(f"Exception successfuly caught.")
-    if not is_passed:
-        print("TEST FAILED:")
-        print("Exception expected, but none was found.")
+    if not expect_error(SentenceCountMismatchError, sentences[:-1], evaluator, gold_sentences):
         return
     print("Passed.")
 
     print()
     print("========== Sentence length mismatch test (4/5) ==========")
     print()
-    is_passed = True
-    try:
-        short_sentences = [
-            TokenList(sentence[:-1], sentence.metadata)
-            for sentence in sentences
-        ]
-        run_test(short_sentences, evaluate_args)
-        is_passed = False
-    except Exception as e:
-        print(f"Exception successfuly caught.")
-    if not is_passed:
-        print("TEST FAILED:")
-        print("Exception expected, but none was found.")
+    short_sentences = [
+        TokenList(sentence[:-1], sentence.metadata)
+        for sentence in sentences
+    ]
+    if not expect_error(SentenceLengthMismatchError, short_sentences, evaluator, gold_sentences):
         return
     print("Passed.")
 
@@ -183,7 +150,9 @@ def main(gold_file_path: str) -> None:
     print("========== Random tags test (5/5) ==========")
     print()
     random_tag_sentences = make_random_tags(sentences)
-    scores = run_test(random_tag_sentences, evaluate_args)
+    scores = run_test(random_tag_sentences, evaluator, gold_sentences)
+    for score in scores:
+        assert 0.0 <= score <= 1.0
 
     print("TESTS PASSED.")
 
@@ -0,0 +1,115 @@
+import logging
+import random
+
+from overrides import override
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.data import Instance
+from allennlp.data.samplers import BatchSampler
+
+
+logger = logging.getLogger(__name__)
+
+
+@BatchSampler.register("token_budget_sampler")
+class TokenBudgetBatchSampler(BatchSampler):
+    """
+    Groups sentences of similar length together and limits batches by the number of (padded) tokens
+    rather than by the number of sentences, so that little time and memory are spent on padding.
+
+    Sentence length is the number of words (not subword tokens), since dependency classifier scores
+    are padded to the longest sentence in words.
+
+    Parameters
+    ----------
+    max_tokens : int
+        Budget of a batch.
+    budget : str, optional (default = "tokens")
+        How batch size is measured:
+        * "tokens" - batch_size * max_length, i.e. the size of token-level tensors (embeddings, tags);
+        * "quadratic" - batch_size * max_length^2, i.e. the size of arc and rel scores of dependency classifier,
+          which prevails for long sentences.
+    padding_noise : float, optional (default = 0.1)
+        Sentences are sorted by lengths with a random noise of at most padding_noise * length,
+        so that batches are not the same from epoch to epoch.
+    max_batch_size : int, optional (default = None)
+        Maximum number of sentences in a batch (no limit by default).
+    shuffle : bool, optional (default = True)
+        Whether to shuffle batches. If False, no noise is added, i.e. batches are always the same
+        (use it for validation).
+
+    Noise changes the number of batches, so batches of the next epoch are made once the number is asked for
+    (e.g. by a learning rate scheduler) and the same batches are returned then, so that the number is exact.
+    """
+
+    def __init__(self,
+                 max_tokens: int,
+                 budget: str = "tokens",
+                 padding_noise: float = 0.1,
+                 max_batch_size: int = None,
+                 shuffle: bool = True):
+        if budget not in ("tokens", "quadratic"):
+            raise ConfigurationError(f"Unknown budget: {budget}. Use 'tokens' or 'quadratic'.")
+        self.max_tokens = max_tokens
+        self.budget = budget
+        self.padding_noise = padding_noise if shuffle else 0.0
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        # Lengths of instances and batches made for them, but not returned yet.
+        self._pending_batches: Optional[Tuple[List[int], List[List[int]]]] = None
+
+    @override
+    def get_batch_indices(self, instances: Sequence[Instance]) -> Iterable[List[int]]:
+        # Instances are passed as a new list each epoch, so the pending batches are matched by lengths.
+        batches = self._get_pending_batches(self._get_lengths(instances))
+        self._pending_batches = None
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    @override
+    def get_num_batches(self, instances: Sequence[Instance]) -> int:
+        return len(self._get_pending_batches(self._get_lengths(instances)))
+
+    @staticmethod
+    def _get_lengths(instances: Sequence[Instance]) -> List[int]:
+        return [len(instance["words"]) for instance in instances]
+
+    def _get_pending_batches(self, lengths: List[int]) -> List[List[int]]:
+        if self._pending_batches is None or self._pending_batches[0] != lengths:
+            self._pending_batches = (lengths, self._make_batches(lengths, self.padding_noise))
+        return self._pending_batches[1]
+
+    def _make_batches(self, lengths: List[int], padding_noise: float) -> List[List[int]]:
+        noisy_lengths = [
+            length + random.uniform(-length * padding_noise, length * padding_noise) if padding_noise > 0 else length
+            for length in lengths
+        ]
+        order = sorted(range(len(lengths)), key=lambda index: noisy_lengths[index])
+
+        batches = []
+        batch = []
+        batch_max_length = 0
+        for index in order:
+            length = lengths[index]
+            if self._cost(length, 1) > self.max_tokens:
+                logger.warning(
+                    f"Sentence of length {length} exceeds batch budget ({self.max_tokens} {self.budget}) alone."
+                )
+            max_length = max(batch_max_length, length)
+            is_full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (is_full or self._cost(max_length, len(batch) + 1) > self.max_tokens):
+                batches.append(batch)
+                batch = []
+                max_length = length
+            batch.append(index)
+            batch_max_length = max_length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _cost(self, max_length: int, batch_size: int) -> int:
+        if self.budget == "quadratic":
+            return batch_size * max_length ** 2
+        return batch_size * max_length
@@ -0,0 +1,189 @@
+"""
+Benchmark of fp32 vs int8 (see quantization.py) models on CPU: archive size, latency,
+throughput and evaluate.py scores on the same file.
+
+Usage:
+    python -m src.benchmark_quantization serialization_dir/model.tar.gz val.conllu -output_file quantization.json
+quantizes the model into a temporary archive (use -quantized_model to pass an already exported one),
+labels val.conllu with both models and scores predictions against it.
+"""
+
+import io
+import os
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+from typing import Dict
+
+import torch
+
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive
+from allennlp.predictors import Predictor
+
+from .bulk_predict import bulk_predict
+from .quantization import export_quantized_archive
+from .official_metrics import import_evaluate_module
+
+
+def load_predictor(model_file: str) -> Predictor:
+    return Predictor.from_archive(load_archive(model_file), "morpho_syntax_semantic_predictor")
+
+
+def state_dict_size(model: torch.nn.Module) -> int:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def measure_latency(predictor: Predictor, file_path: str, n_sentences: int) -> Dict[str, float]:
+    """
+    Latency of single sentence prediction (in milliseconds) over the first n_sentences of the file.
+    """
+    reader = predictor._dataset_reader
+    times = []
+    for sentence_index, sentence in enumerate(reader.read_sentences(file_path)):
+        if sentence_index >= n_sentences:
+            break
+        instance = reader.text_to_instance(sentence.words, metadata=sentence.metadata)
+        start = time.perf_counter()
+        predictor.predict_batch_instance_raw([instance])
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "latency_p50_ms": times[len(times) // 2],
+        "latency_p90_ms": times[int(len(times) * 0.9)],
+    }
+
+
+def benchmark_model(model_file: str, gold_file: str, output_file: str, evaluator: "Evaluator", repeat: int, latency_sentences: int) -> Dict:
+    predictor = load_predictor(model_file)
+    result = {
+        "model_file": model_file,
+        "archive_size": os.path.getsize(model_file),
+        "weights_size": state_dict_size(predictor._model),
+    }
+    result.update(measure_latency(predictor, gold_file, latency_sentences))
+
+    best_time = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n_sentences = bulk_predict(predictor, gold_file, output_file, batch_size=1024)
+        best_time = min(best_time, time.perf_counter() - start)
+    result["sentences_per_second"] = n_sentences / best_time
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        scores = evaluator.evaluate_files(output_file, gold_file)
+    result["n_tokens"] = scores.n_tokens
+    result["tokens_per_second"] = scores.n_tokens / best_time
+    result["scores"] = dict(zip(
+        ["Total", "Lemma", "POS", "Feats", "Head", "Deprel", "SemSlot", "SemClass"],
+        scores.as_tuple()
+    ))
+    return result
+
+
+def print_results(results: Dict[str, Dict]) -> None:
+    rows = [
+        ("archive size, MB", lambda result: f"{result['archive_size'] / 2**20:.2f}"),
+        ("weights size, MB", lambda result: f"{result['weights_size'] / 2**20:.2f}"),
+        ("latency p50, ms", lambda result: f"{result['latency_p50_ms']:.1f}"),
+        ("latency p90, ms", lambda result: f"{result['latency_p90_ms']:.1f}"),
+        ("sentences/s", lambda result: f"{result['sentences_per_second']:.1f}"),
+        ("tokens/s", lambda result: f"{result['tokens_per_second']:.0f}"),
+    ]
+    rows += [
+        (score_name, lambda result, score_name=score_name: f"{result['scores'][score_name]:.4f}")
+        for score_name in results["fp32"]["scores"]
+    ]
+    print(f"{'':<20}" + ''.join(f"{name:>12}" for name in results))
+    for row_name, format_value in rows:
+        print(f"{row_name:<20}" + ''.join(f"{format_value(result):>12}" for result in results.values()))
+
+
+def main(model_file: str, gold_file: str, quantized_model_file: str, output_file: str, repeat: int, latency_sentences: int) -> Dict:
+    # Register all the models, readers and predictors of the package.
+    import_module_and_submodules(__package__)
+
+    # Evaluation scripts are imported here rather than at module level, since they are not
+    # dependencies of the parser (and all the package modules are imported by allennlp).
+    Evaluator = import_evaluate_module("evaluate").Evaluator
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        evaluator = Evaluator()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        if quantized_model_file is None:
+            quantized_model_file = os.path.join(work_dir, "model-int8.tar.gz")
+            print("Quantize model...")
+            export_quantized_archive(model_file, quantized_model_file)
+
+        for name, file in [("fp32", model_file), ("int8", quantized_model_file)]:
+            print(f"Benchmark {name} model...")
+            predictions_file = os.path.join(work_dir, f"{name}.conllu")
+            results[name] = benchmark_model(file, gold_file, predictions_file, evaluator, repeat, latency_sentences)
+
+    report = {
+        "gold_file": gold_file,
+        "torch": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "results": results,
+    }
+
+    print()
+    print_results(results)
+
+    if output_file is not None:
+        with open(output_file, 'w') as file:
+            json.dump(report, file, indent=4)
+        print(f"Results are saved to {output_file}.")
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Compare fp32 and int8 quantized models: size, latency, throughput and scores.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'model_file',
+        type=str,
+        help='Model archive (model.tar.gz).'
+    )
+    parser.add_argument(
+        'gold_file',
+        type=str,
+        help='Gold file in SEMarkup format. It is labeled by both models, and predictions are scored against it.'
+    )
+    parser.add_argument(
+        '-quantized_model',
+        type=str,
+        help='Quantized model archive (see quantization.py). The model is quantized on the fly if not set.',
+        default=None
+    )
+    parser.add_argument(
+        '-output_file',
+        type=str,
+        help='JSON file to save results to.',
+        default=None
+    )
+    parser.add_argument(
+        '-repeat',
+        type=int,
+        help='Number of throughput runs. The best run is reported.',
+        default=3
+    )
+    parser.add_argument(
+        '-latency_sentences',
+        type=int,
+        help='Number of sentences to measure single sentence latency on.',
+        default=200
+    )
+    args = parser.parse_args()
+
+    main(args.model_file, args.gold_file, args.quantized_model, args.output_file, args.repeat, args.latency_sentences)
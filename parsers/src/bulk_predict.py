@@ -0,0 +1,114 @@
+"""
+Bulk prediction: label a large SEMarkup file with a trained model.
+
+Unlike `allennlp predict`, sentences are streamed from the input file, batches are passed
+to the predictor directly (without JSON-lines round trips), and predictions are serialized
+into a buffered output file, so memory usage is bounded by the batch size.
+
+Usage:
+    python -m src.bulk_predict serialization_dir/model.tar.gz test.conllu predictions.conllu -batch_size 1024
+"""
+
+import sys
+import time
+import argparse
+
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive
+from allennlp.predictors import Predictor
+
+from .predictor import MorphoSyntaxSemanticPredictor
+from .serialization import OUTPUT_BUFFER_SIZE, batched, serialize_prediction
+
+
+def bulk_predict(predictor: MorphoSyntaxSemanticPredictor,
+                 input_file: str,
+                 output_file: str,
+                 batch_size: int) -> int:
+    """
+    Predict tags of input_file sentences and write them into output_file.
+    Each batch of batch_size sentences is sorted by length and split into sub-batches by the predictor.
+    Return the number of sentences.
+    """
+    reader = predictor._dataset_reader
+    # Input tags are erased, so instances are made of words only (no labels means no loss computation as well).
+    instances = (
+        reader.text_to_instance(sentence.words, metadata=sentence.metadata)
+        for sentence in reader.read_sentences(input_file)
+    )
+
+    n_sentences = 0
+    with open(output_file, 'w', buffering=OUTPUT_BUFFER_SIZE) as file:
+        for batch in batched(instances, batch_size):
+            outputs = predictor.predict_batch_instance_raw(batch)
+            file.write(''.join(map(serialize_prediction, outputs)))
+            n_sentences += len(batch)
+    return n_sentences
+
+
+def main(model_file: str, input_file: str, output_file: str, batch_size: int, max_batch_size: int, cuda_device: int, overrides: str) -> None:
+    # Register all the models, readers and predictors of the package.
+    import_module_and_submodules(__package__)
+    archive = load_archive(model_file, cuda_device=cuda_device, overrides=overrides)
+    predictor = Predictor.from_archive(
+        archive,
+        "morpho_syntax_semantic_predictor",
+        extra_args={"max_batch_size": max_batch_size}
+    )
+
+    start = time.perf_counter()
+    n_sentences = bulk_predict(predictor, input_file, output_file, batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"Predicted {n_sentences} sentences in {elapsed:.1f}s ({n_sentences / elapsed:.1f} sentences/s).", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Label a (tag-erased) SEMarkup file with a trained model.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'model_file',
+        type=str,
+        help='Model archive (model.tar.gz).'
+    )
+    parser.add_argument(
+        'input_file',
+        type=str,
+        help='File in SEMarkup format to be labeled.'
+    )
+    parser.add_argument(
+        'output_file',
+        type=str,
+        help='File to write predictions to.'
+    )
+    parser.add_argument(
+        '-batch_size',
+        type=int,
+        default=1024,
+        help='Number of sentences read at once. Each batch is sorted by length and split into sub-batches of similar-length sentences.\n'
+        'Default is 1024.'
+    )
+    parser.add_argument(
+        '-max_batch_size',
+        type=int,
+        default=32,
+        help='Maximum number of sentences in a sub-batch the model runs on.\n'
+        'Default is 32.'
+    )
+    parser.add_argument(
+        '-cuda_device',
+        type=int,
+        default=-1,
+        help='Id of GPU to use (-1 for CPU).\n'
+        'Default is -1.'
+    )
+    parser.add_argument(
+        '-overrides',
+        type=str,
+        default="",
+        help='JSON overrides of the model configuration, e.g. \'{"model.depencency_classifier.decoding": "eisner"}\'.'
+    )
+    args = parser.parse_args()
+
+    main(args.model_file, args.input_file, args.output_file, args.batch_size, args.max_batch_size, args.cuda_device, args.overrides)
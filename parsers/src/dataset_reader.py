@@ -1,13 +1,56 @@
-from typing import Iterable, List, Dict, Optional
+import os
+
+from typing import BinaryIO, Iterable, Iterator, List, Dict, Optional, Tuple
 
 import conllu
 
-from allennlp.data import DatasetReader, Instance
+from allennlp.data import DatasetReader, Instance, Vocabulary
 from allennlp.data.fields import TextField, SequenceLabelField, MetadataField
 from allennlp.data.token_indexers import SingleIdTokenIndexer, TokenIndexer
 from allennlp.data.tokenizers import Token
 
-from .lemmatize_helper import predict_lemma_rule
+from .lemmatize_helper import predict_lemma_rule, load_lemma_rule_cache, save_lemma_rule_cache, LEMMA_RULE_CACHE
+from .serialization import parse_sentence
+from .instance_cache import InstanceCache, IndexedTextField, precompute_indexed_tokens, VOCABULARY_INDEPENDENT_INDEXERS
+
+
+# Label fields of an instance (their names are also vocabulary namespaces), in the order they are added.
+LABEL_FIELDS = ["lemma_rule_labels", "pos_feats_labels", "head_labels", "deprel_labels", "semslot_labels", "semclass_labels"]
+
+
+def _find_sentence_boundary(file: BinaryIO, position: int, file_size: int) -> int:
+    """
+    Find the offset of the first empty line (i.e. sentences separator) that starts at or after position.
+    Return file_size if there is none.
+    """
+    if position <= 0:
+        return 0
+    if position >= file_size:
+        return file_size
+    # Move to the first line start at or after position.
+    file.seek(position - 1)
+    file.readline()
+    while True:
+        line_start = file.tell()
+        line = file.readline()
+        if not line:
+            return file_size
+        if line.strip() == b"":
+            return line_start
+
+
+def _read_lines(file: BinaryIO, start: int, end: int) -> Iterator[str]:
+    """
+    Read lines of file[start:end] (with universal newlines, like a file opened in text mode).
+    """
+    file.seek(start)
+    position = start
+    while position < end:
+        line = file.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line.decode().rstrip('\r\n') + '\n'
 
 
 class Sentence:
@@ -66,22 +109,78 @@ class ComprenoUDDatasetReader(DatasetReader):
     See https://guide.allennlp.org/reading-data#2 for guidance.
     """
 
-    def __init__(self, token_indexers: Dict[str, TokenIndexer] = {"tokens": SingleIdTokenIndexer()}):
-        super().__init__()
+    def __init__(self,
+                 token_indexers: Dict[str, TokenIndexer] = {"tokens": SingleIdTokenIndexer()},
+                 lemma_rule_cache: str = None,
+                 cache_directory: str = None):
+        # Sharding between distributed processes and data loader workers is done in _read.
+        super().__init__(manual_distributed_sharding=True, manual_multiprocess_sharding=True)
         self.token_indexers = token_indexers
+        # File to store (word, lemma) -> lemmatization rule cache in, so that it is reused by other runs.
+        self.lemma_rule_cache = lemma_rule_cache
+        # Directory to cache read instances in (see instance_cache.py), so that other runs don't parse and index them again.
+        self.cache_directory = cache_directory
+        # Vocabulary-independent indexers don't need a real vocabulary, so a scratch one is used for indexing when caching.
+        self._scratch_vocab = Vocabulary()
 
     def _read(self, file_path: str) -> Iterable[Instance]:
-        with open(file_path, "r") as f:
-            texts = f.read()
-
-        sentences = conllu.parse(
-            texts,
-            fields=["id", "form", "lemma", "upos", "xpos", "feats", "head", "deprel", "semslot", "semclass"],
-            field_parsers={"feats": lambda line, i: line[i]}
-        )
-
-        for sentence in map(Sentence, sentences):
-            yield self.text_to_instance(
+        if self.lemma_rule_cache is not None:
+            load_lemma_rule_cache(self.lemma_rule_cache)
+            cache_size = len(LEMMA_RULE_CACHE)
+
+        shard_index, num_shards = self._get_shard()
+
+        if self.cache_directory is None:
+            records = self._read_records(file_path, shard_index, num_shards)
+        else:
+            cache = InstanceCache(self.cache_directory, file_path, self.token_indexers)
+            shard_cache = cache.for_shard(shard_index, num_shards)
+            if cache.exists():
+                # Records of the shard are read by their offsets.
+                records = cache.read(range(shard_index, len(cache), num_shards))
+            elif shard_cache.exists():
+                records = shard_cache.read()
+            else:
+                records = shard_cache.write(
+                    map(self._add_indexed_tokens, self._read_records(file_path, shard_index, num_shards))
+                )
+
+        for record in records:
+            yield self._record_to_instance(record)
+
+        if self.lemma_rule_cache is not None and len(LEMMA_RULE_CACHE) != cache_size:
+            save_lemma_rule_cache(self.lemma_rule_cache)
+
+    def _get_shard(self) -> Tuple[int, int]:
+        """
+        Return index of the shard to be read by this process (or worker) and the total number of shards.
+        """
+        shard_index, num_shards = 0, 1
+        distributed_info = self.get_distributed_info()
+        if distributed_info is not None:
+            shard_index, num_shards = distributed_info.global_rank, distributed_info.world_size
+        worker_info = self.get_worker_info()
+        if worker_info is not None:
+            shard_index = shard_index * worker_info.num_workers + worker_info.id
+            num_shards *= worker_info.num_workers
+        return shard_index, num_shards
+
+    def read_sentences(self, file_path: str, shard_index: int = 0, num_shards: int = 1) -> Iterable[Sentence]:
+        """
+        Lazily read sentences of a shard of the file.
+        The file is split into num_shards byte ranges of equal size, and a shard contains sentences
+        starting in its range, so that it is read without parsing the other sentences.
+        """
+        file_size = os.path.getsize(file_path)
+        with open(file_path, "rb") as f:
+            start = _find_sentence_boundary(f, file_size * shard_index // num_shards, file_size)
+            end = _find_sentence_boundary(f, file_size * (shard_index + 1) // num_shards, file_size)
+            for sentence_text in conllu.parse_sentences(_read_lines(f, start, end)):
+                yield Sentence(parse_sentence(sentence_text))
+
+    def _read_records(self, file_path: str, shard_index: int = 0, num_shards: int = 1) -> Iterable[Dict]:
+        for sentence in self.read_sentences(file_path, shard_index, num_shards):
+            yield self._make_record(
                 sentence.words,
                 sentence.lemmas,
                 sentence.upos_tags,
@@ -104,35 +203,74 @@ class ComprenoUDDatasetReader(DatasetReader):
                          semclasses: List[str] = None,
                          metadata: Dict = None
                          ) -> Instance:
-
-        text_field = TextField(list(map(Token, words)), self.token_indexers)
-
-        fields = {}
-
-        fields['words'] = text_field
+        record = self._make_record(words, lemmas, upos_tags, feats_tags, heads, deprels, semslots, semclasses, metadata)
+        return self._record_to_instance(record)
+
+    @staticmethod
+    def _make_record(words: List[str],
+                     lemmas: List[str] = None,
+                     upos_tags: List[str] = None,
+                     feats_tags: List[str] = None,
+                     heads: List[int] = None,
+                     deprels: List[str] = None,
+                     semslots: List[str] = None,
+                     semclasses: List[str] = None,
+                     metadata: Dict = None
+                     ) -> Dict:
+        """
+        Make a record of an instance, i.e. words and labels (not indexed yet).
+        """
+        record = {'words': words}
 
         if lemmas is not None:
-            lemma_rules = [str(predict_lemma_rule(word, lemma)) for word, lemma in zip(words, lemmas)]
-            fields['lemma_rule_labels'] = SequenceLabelField(lemma_rules, text_field, 'lemma_rule_labels')
+            record['lemma_rule_labels'] = [str(predict_lemma_rule(word, lemma)) for word, lemma in zip(words, lemmas)]
 
         if upos_tags is not None and feats_tags is not None:
-            joint_pos_feats = [f"{upos_tag}#{feats_tag}" for upos_tag, feats_tag in zip(upos_tags, feats_tags)]
-            fields['pos_feats_labels'] = SequenceLabelField(joint_pos_feats, text_field, 'pos_feats_labels')
+            record['pos_feats_labels'] = [f"{upos_tag}#{feats_tag}" for upos_tag, feats_tag in zip(upos_tags, feats_tags)]
 
         if heads is not None:
-            fields['head_labels'] = SequenceLabelField(heads, text_field, 'head_labels')
+            record['head_labels'] = heads
 
         if deprels is not None:
-            fields['deprel_labels'] = SequenceLabelField(deprels, text_field, 'deprel_labels')
+            record['deprel_labels'] = deprels
 
         if semslots is not None:
-            fields['semslot_labels'] = SequenceLabelField(semslots, text_field, 'semslot_labels')
+            record['semslot_labels'] = semslots
 
         if semclasses is not None:
-            fields['semclass_labels'] = SequenceLabelField(semclasses, text_field, 'semclass_labels')
+            record['semclass_labels'] = semclasses
 
         if metadata is not None:
-            fields['metadata'] = MetadataField(metadata)
+            record['metadata'] = metadata
+
+        return record
+
+    def _add_indexed_tokens(self, record: Dict) -> Dict:
+        if any(isinstance(indexer, VOCABULARY_INDEPENDENT_INDEXERS) for indexer in self.token_indexers.values()):
+            tokens = list(map(Token, record['words']))
+            record['indexed_tokens'] = precompute_indexed_tokens(tokens, self.token_indexers, self._scratch_vocab)
+        return record
+
+    def _record_to_instance(self, record: Dict) -> Instance:
+        # Token indexers are set in apply_token_indexers, so that they are not sent between data loader processes.
+        tokens = list(map(Token, record['words']))
+        if 'indexed_tokens' in record:
+            text_field = IndexedTextField(tokens, None, record['indexed_tokens'])
+        else:
+            text_field = TextField(tokens)
+
+        fields = {}
+
+        fields['words'] = text_field
+
+        for label_field in LABEL_FIELDS:
+            if label_field in record:
+                fields[label_field] = SequenceLabelField(record[label_field], text_field, label_field)
+
+        if 'metadata' in record:
+            fields['metadata'] = MetadataField(record['metadata'])
 
         return Instance(fields)
 
+    def apply_token_indexers(self, instance: Instance) -> None:
+        instance["words"].token_indexers = self.token_indexers
@@ -1,22 +1,24 @@
 from overrides import override
 from copy import deepcopy
+from multiprocessing import Pool
+import weakref
 
 from typing import Dict, Tuple
 
-import numpy as np
-
 import torch
 from torch import nn
 from torch import Tensor
 import torch.nn.functional as F
 
+from allennlp.common.checks import ConfigurationError
 from allennlp.data import Vocabulary
 from allennlp.models import Model
 from allennlp.nn.activations import Activation
 from allennlp.modules.matrix_attention.bilinear_matrix_attention import BilinearMatrixAttention
 from allennlp.training.metrics import AttachmentScores
-from allennlp.nn.chu_liu_edmonds import decode_mst
-from allennlp.nn.util import replace_masked_values, get_range_vector, get_device_of, move_to_device
+from allennlp.nn.util import replace_masked_values, get_range_vector, get_device_of
+
+from .tree_decoding import decode_mst_batch, decode_eisner_batch
 
 
 @Model.register('dependency_classifier')
@@ -36,9 +38,27 @@ class DependencyClassifier(Model):
                  hid_dim: int,
                  n_rel_classes: int,
                  activation: str,
-                 dropout: float):
+                 dropout: float,
+                 decoding: str = "mst",
+                 mst_num_workers: int = 0,
+                 mst_pool_min_length: int = 64,
+                 lean_rel_scores: bool = False):
         super().__init__(vocab)
 
+        if decoding not in ("mst", "eisner"):
+            raise ConfigurationError(f"Unknown decoding: {decoding}. Use 'mst' or 'eisner'.")
+        # Inference-time tree decoding algorithm:
+        # * "mst" - (non-projective) Chu-Liu-Edmonds,
+        # * "eisner" - (projective) Eisner, batched.
+        self.decoding = decoding
+        # Sentences of at least mst_pool_min_length tokens are decoded in mst_num_workers processes
+        # (0 means no worker processes).
+        self.mst_num_workers = mst_num_workers
+        self.mst_pool_min_length = mst_pool_min_length
+        self._mst_pool = None
+        # Compute rel scores towards predicted (and gold) heads only, which takes O(seq_len) memory instead of O(seq_len^2).
+        self.lean_rel_scores = lean_rel_scores
+
         mlp = nn.Sequential(
             nn.Dropout(dropout),
             nn.Linear(in_dim, hid_dim),
@@ -60,29 +80,47 @@ class DependencyClassifier(Model):
                 embeddings: Tensor, # [batch_size, seq_len, embedding_dim]
                 arc_labels: Tensor, # [batch_size, seq_len]
                 rel_labels: Tensor, # [batch_size, seq_len]
-                mask: Tensor        # [batch_size, seq_len]
+                mask: Tensor,       # [batch_size, seq_len]
+                projections: Dict[str, Tensor] = None # Precomputed activated input projections (see fused_projection.py)
                 ) -> Dict[str, Tensor]:
 
         # [batch_size, seq_len, hid_dim]
-        h_arc_head = self.arc_head_mlp(embeddings)
-        h_arc_dep = self.arc_dep_mlp(embeddings)
-        h_rel_head = self.rel_head_mlp(embeddings)
-        h_rel_dep = self.rel_dep_mlp(embeddings)
+        h_arc_head = self._mlp(self.arc_head_mlp, embeddings, projections, "arc_head")
+        h_arc_dep = self._mlp(self.arc_dep_mlp, embeddings, projections, "arc_dep")
+        h_rel_head = self._mlp(self.rel_head_mlp, embeddings, projections, "rel_head")
+        h_rel_dep = self._mlp(self.rel_dep_mlp, embeddings, projections, "rel_dep")
 
         # [batch_size, seq_len, seq_len]
         s_arc = self.arc_attention(h_arc_head, h_arc_dep)
         # Replace masked values along the 3rd dimension with -inf.
         s_arc = replace_masked_values(s_arc, mask[:, None, :], replace_with=-float("inf"))
-        # [batch_size, seq_len, seq_len, num_labels]
-        s_rel = self.rel_attention(h_rel_head, h_rel_dep).permute(0, 2, 3, 1)
 
-        predicted_arcs, predicted_rels = self.decode(s_arc, s_rel, mask)
+        # [batch_size, seq_len]
+        predicted_arcs = self.decode(s_arc, mask)
+
+        if self.lean_rel_scores:
+            # Score rels towards predicted heads only.
+            s_rel = None
+            # [batch_size, seq_len]
+            predicted_rels = self._rel_scores(h_rel_head, h_rel_dep, predicted_arcs).argmax(-1)
+        else:
+            # [batch_size, seq_len, seq_len, num_labels]
+            s_rel = self.rel_attention(h_rel_head, h_rel_dep).permute(0, 2, 3, 1)
+            # [batch_size, seq_len]
+            predicted_rels = self._gather_rel_scores(s_rel, predicted_arcs).argmax(-1)
 
         if arc_labels is not None and rel_labels is not None:
             # Now both predicted_arcs and arc_labels have internal format.
             arc_labels = self._conllu_to_internal_arc_format(arc_labels)
 
-            arc_loss, rel_loss = self.loss(s_arc, s_rel, arc_labels, rel_labels, mask)
+            # Select rel scores towards the correct heads.
+            # [batch_size, seq_len, num_labels]
+            if self.lean_rel_scores:
+                s_rel_gold = self._rel_scores(h_rel_head, h_rel_dep, arc_labels)
+            else:
+                s_rel_gold = self._gather_rel_scores(s_rel, arc_labels)
+
+            arc_loss, rel_loss = self.loss(s_arc, s_rel_gold, arc_labels, rel_labels, mask)
             self.metric(predicted_arcs, predicted_rels, arc_labels, rel_labels, mask)
         else:
             arc_loss, rel_loss = torch.tensor(0.), torch.tensor(0.)
@@ -99,112 +137,48 @@ class DependencyClassifier(Model):
 
     def decode(self,
                s_arc: Tensor, # [batch_size, seq_len, seq_len]
-               s_rel: Tensor, # [batch_size, seq_len, seq_len, num_labels]
                mask: Tensor   # [batch_size, seq_len]
-               ) -> Tuple[Tensor, Tensor]:
-
+               ) -> Tensor:
+        """
+        Predict arcs (heads).
+        """
         if self.training:
-            return self.greedy_decode(s_arc, s_rel)
+            return self.greedy_decode(s_arc)
+        elif self.decoding == "eisner":
+            return self.eisner_decode(s_arc, mask)
         else:
-            return self.mst_decode(s_arc, s_rel, mask)
+            return self.mst_decode(s_arc, mask)
 
     def greedy_decode(self,
                       s_arc: Tensor, # [batch_size, seq_len, seq_len]
-                      s_rel: Tensor, # [batch_size, seq_len, seq_len, num_labels]
-                      ) -> Tuple[Tensor, Tensor]:
-
-        batch_size, _, _ = s_arc.shape
+                      ) -> Tensor:
 
         # Select the most probable arcs.
         # [batch_size, seq_len]
-        predicted_arcs = s_arc.argmax(-1)
-
-        # Select the most probable rels for each arc.
-        # [batch_size, seq_len, seq_len]
-        predicted_rels = s_rel.argmax(-1)
-
-        # Select rels towards predicted arcs.
-        # [batch_size, seq_len]
-        predicted_rels = predicted_rels.gather(-1, predicted_arcs[:, :, None]).squeeze(-1)
-
-        return predicted_arcs, predicted_rels
+        return s_arc.argmax(-1)
 
     def mst_decode(self,
                    s_arc: Tensor, # [batch_size, seq_len, seq_len]
-                   s_rel: Tensor, # [batch_size, seq_len, seq_len, num_labels]
                    mask: Tensor   # [batch_size, seq_len]
-                   ) -> Tuple[Tensor, Tensor]:
-        batch_size, seq_len, _ = s_arc.shape
-
-        assert get_device_of(s_arc) == get_device_of(s_rel)
-        device = get_device_of(s_arc)
-        s_arc = s_arc.cpu()
-        s_rel = s_rel.cpu()
-
-        # It is the most tricky part of dependency classifier.
-        # If you want to get into it, first visit
-        # https://docs.allennlp.org/main/api/nn/chu_liu_edmonds
-        # It is not that detailed, so you better look into the source.
-
-        # First, normalize values, as decode_mst expects values to be non-negative.
-        s_arc_probs = nn.functional.softmax(s_arc, dim=-1)
-
-        # Next, recall the hack: we use diagonal to store ROOT relation, so
-        #
-        # s_arc[i,j] = "Probability that j is the head of i" if i != j else "Probability that i is ROOT".
-        #
-        # However, allennlp's decode_mst defines 'energy' matrix as follows:
-        #
-        # energy[i,j] = "Score that i is the head of j",
-        #
-        # which means we have to transpose s_arc at first, so that:
-        #
-        # s_arc[i,j] = "Score that i is the head of j" if i != j else "Score that i is ROOT".
-        #
-        s_arc_probs_inv = s_arc_probs.transpose(1, 2)
-
-        # Also note that decode_mst can't handle loops, as it zeroes diagonal out.
-        # So, s_arc now:
-        #
-        # s_arc[i,j] = "Score that i is the head of j".
-        #
-        # However, decode_mst can produce a tree where root node
-        # has a parent, since it knows nothing about root yet.
-        # That is, we have to chose the latter explicitly.
-        # [batch_size]
-        root_idxs = s_arc_probs_inv.diagonal(dim1=1, dim2=2).argmax(dim=-1)
-
-        predicted_arcs = []
-        for batch_idx, root_idx in enumerate(root_idxs):
-            # Now zero s_arc[i, root_idx] = "Probability that i is the head of root_idx" out.
-            energy = s_arc_probs_inv[batch_idx]
-            energy[:, root_idx] = 0.0
-            # Finally, we are ready to call decode_mst,
-            # Note s_arc don't know anything about labels, so we set has_labels=False.
-            lengths = mask[batch_idx].sum()
-            heads, _ = decode_mst(energy, lengths, has_labels=False)
-
-            # Some vertices may be isolated. Pick heads greedily in this case.
-            heads[heads <= 0] = s_arc[batch_idx].argmax(-1)[heads <= 0]
-            predicted_arcs.append(heads)
-
-        # [batch_size, seq_len]
-        predicted_arcs = torch.from_numpy(np.stack(predicted_arcs)).to(torch.int64)
-
-        # ...and predict relations.
-        predicted_rels = s_rel.argmax(-1)
-        # Select rels towards predicted arcs.
-        # [batch_size, seq_len]
-        predicted_rels = predicted_rels.gather(-1, predicted_arcs[:, :, None]).squeeze(-1)
-
-        predicted_arcs = move_to_device(predicted_arcs, device)
-        predicted_rels = move_to_device(predicted_rels, device)
+                   ) -> Tensor:
+        """
+        Decode maximum spanning trees (see tree_decoding.decode_mst_batch).
+        """
+        get_pool = self._get_mst_pool if self.mst_num_workers > 0 else None
+        return decode_mst_batch(s_arc, mask, get_pool, self.mst_pool_min_length)
 
-        return predicted_arcs, predicted_rels
+    def eisner_decode(self,
+                      s_arc: Tensor, # [batch_size, seq_len, seq_len]
+                      mask: Tensor   # [batch_size, seq_len]
+                      ) -> Tensor:
+        """
+        Decode the highest scoring projective tree with a single root for all sentences at once.
+        """
+        return decode_eisner_batch(s_arc, mask)
 
     def loss(self,
              s_arc: Tensor,       # [batch_size, seq_len, seq_len]
-             s_rel: Tensor,       # [batch_size, seq_len, seq_len, num_labels]
+             s_rel: Tensor,       # [batch_size, seq_len, num_labels], rel scores towards the correct heads
              target_arcs: Tensor, # [batch_size, seq_len]
              target_rels: Tensor, # [batch_size, seq_len]
              mask: Tensor         # [batch_size, seq_len]
@@ -215,11 +189,8 @@ class DependencyClassifier(Model):
         # [mask.sum()]
         target_arcs = target_arcs[mask]
 
-        # [mask.sum(), seq_len, num_labels]
-        s_rel = s_rel[mask]
-        # Select the predicted logits towards the correct heads.
         # [mask.sum(), num_labels]
-        s_rel = s_rel[torch.arange(len(target_arcs)), target_arcs]
+        s_rel = s_rel[mask]
         # [mask.sum()]
         target_rels = target_rels[mask]
 
@@ -232,8 +203,65 @@ class DependencyClassifier(Model):
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         return self.metric.get_metric(reset)
 
+    def input_projections(self) -> Dict[str, Tuple[nn.Linear, nn.Module]]:
+        return {
+            "arc_head": (self.arc_head_mlp[1], self.arc_head_mlp[2]),
+            "arc_dep": (self.arc_dep_mlp[1], self.arc_dep_mlp[2]),
+            "rel_head": (self.rel_head_mlp[1], self.rel_head_mlp[2]),
+            "rel_dep": (self.rel_dep_mlp[1], self.rel_dep_mlp[2]),
+        }
+
     ### Private methods ###
 
+    @staticmethod
+    def _mlp(mlp: nn.Sequential, embeddings: Tensor, projections: Dict[str, Tensor], name: str) -> Tensor:
+        if projections is None:
+            return mlp(embeddings)
+        # Activated input projection is precomputed, and dropouts are no-ops at inference.
+        return projections[name]
+
+    @staticmethod
+    def _gather_rel_scores(s_rel: Tensor, arcs: Tensor) -> Tensor:
+        """
+        Select rel scores towards given arcs, i.e. s_rel[b, i, arcs[b, i]].
+        """
+        # [batch_size, seq_len, 1, num_labels]
+        index = arcs[:, :, None, None].expand(-1, -1, 1, s_rel.shape[-1])
+        # [batch_size, seq_len, num_labels]
+        return s_rel.gather(2, index).squeeze(2)
+
+    def _rel_scores(self, h_rel_head: Tensor, h_rel_dep: Tensor, arcs: Tensor) -> Tensor:
+        """
+        Compute rel scores towards given arcs only, i.e. the same values as
+        rel_attention(h_rel_head, h_rel_dep)[b, :, i, arcs[b, i]], but without [batch_size, seq_len, seq_len, num_labels] tensor.
+        """
+        # Follow BilinearMatrixAttention.forward.
+        attention = self.rel_attention
+        if attention._use_input_biases:
+            h_rel_head = torch.cat([h_rel_head, h_rel_head.new_ones(h_rel_head.shape[:-1] + (1,))], -1)
+            h_rel_dep = torch.cat([h_rel_dep, h_rel_dep.new_ones(h_rel_dep.shape[:-1] + (1,))], -1)
+        # Select vectors towards arcs.
+        # [batch_size, seq_len, hid_dim]
+        h_rel_dep = h_rel_dep.gather(1, arcs[:, :, None].expand(-1, -1, h_rel_dep.shape[-1]))
+        # [batch_size, seq_len, num_labels]
+        s_rel = torch.einsum('bih,lhd,bid->bil', h_rel_head, attention._weight_matrix, h_rel_dep)
+        return attention._activation(s_rel + attention._bias)
+
+    def _get_mst_pool(self) -> Pool:
+        # The pool is created on first use only, so that models that never decode long sentences
+        # (or are trained only) do not spawn processes.
+        if self._mst_pool is None:
+            self._mst_pool = Pool(self.mst_num_workers)
+            # Stop workers along with the model (or at exit at the latest).
+            weakref.finalize(self, self._mst_pool.terminate)
+        return self._mst_pool
+
+    def __getstate__(self):
+        # Worker pool can't be pickled (or deep-copied).
+        state = self.__dict__.copy()
+        state["_mst_pool"] = None
+        return state
+
     @staticmethod
     def _conllu_to_internal_arc_format(arcs: Tensor) -> Tensor:
         """
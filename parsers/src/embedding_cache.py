@@ -0,0 +1,163 @@
+"""
+On-disk cache of frozen embedder outputs.
+
+When the embedder is frozen (e.g. `"train_parameters": false`, or the first epoch with gradual unfreezing),
+every epoch computes the same embeddings of the same sentences again. The cache stores per-sentence
+embeddings, so that the embedder runs once per sentence and later epochs (or other runs with the same embedder,
+e.g. sweeps over classifiers hyperparameters) read embeddings from the cache instead.
+
+A store is a directory named after the fingerprint of embedder weights, so stale embeddings are never read.
+It consists of two files:
+* embeddings.data - float32 embeddings of words, sentence after sentence, memory-mapped for reading;
+* embeddings.index - (sentence key, first row, number of rows) records.
+The index record is appended after the embeddings, so a sentence is cached if its record exists.
+"""
+
+import os
+import struct
+import hashlib
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import torch
+from torch import nn
+
+
+# sha1 of sentence words, first row of sentence embeddings, number of rows (words).
+INDEX_RECORD = struct.Struct("<20sQI")
+
+
+def sentence_key(words: List[str]) -> bytes:
+    return hashlib.sha1('\t'.join(words).encode()).digest()
+
+
+def embedder_fingerprint(embedder: nn.Module) -> str:
+    """
+    Hash of embedder type and weights.
+    """
+    sha1 = hashlib.sha1(f"{type(embedder).__module__}.{type(embedder).__qualname__}".encode())
+    for name, tensor in embedder.state_dict().items():
+        sha1.update(name.encode())
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Embeddings of sentences computed by a particular embedder.
+    """
+
+    def __init__(self, directory: str, embedding_dim: int):
+        os.makedirs(directory, exist_ok=True)
+        self.embedding_dim = embedding_dim
+        self.data_path = os.path.join(directory, "embeddings.data")
+        self.index_path = os.path.join(directory, "embeddings.index")
+        self._row_size = embedding_dim * np.dtype(np.float32).itemsize
+        # Sentence key -> (first row, number of rows).
+        self._index: Dict[bytes, Tuple[int, int]] = {}
+        self._data: Optional[np.ndarray] = None
+        self._read_index()
+
+    def _read_index(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+        n_data_rows = os.path.getsize(self.data_path) // self._row_size if os.path.exists(self.data_path) else 0
+        with open(self.index_path, 'rb') as file:
+            index_bytes = file.read()
+        # A record may be incomplete if a run was interrupted while writing it.
+        n_records = len(index_bytes) // INDEX_RECORD.size
+        for key, first_row, n_rows in INDEX_RECORD.iter_unpack(index_bytes[:n_records * INDEX_RECORD.size]):
+            if first_row + n_rows <= n_data_rows:
+                self._index[key] = (first_row, n_rows)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: bytes) -> bool:
+        return key in self._index
+
+    def get(self, key: bytes) -> np.ndarray:
+        """
+        Return [n_words, embedding_dim] embeddings of a cached sentence.
+        """
+        first_row, n_rows = self._index[key]
+        if self._data is None or self._data.shape[0] < first_row + n_rows:
+            # The data file has grown since it was mapped, so map it again.
+            self._data = np.memmap(self.data_path, dtype=np.float32, mode='r').reshape(-1, self.embedding_dim)
+        return self._data[first_row:first_row + n_rows]
+
+    def add(self, keys: List[bytes], embeddings: List[np.ndarray]) -> None:
+        """
+        Append embeddings of sentences to the store.
+        """
+        records = {}
+        with open(self.data_path, 'ab') as file:
+            # Drop partially written rows of an interrupted run, if any.
+            first_row = file.tell() // self._row_size
+            file.truncate(first_row * self._row_size)
+            for key, sentence_embeddings in zip(keys, embeddings):
+                if key in self._index or key in records:
+                    continue
+                file.write(np.ascontiguousarray(sentence_embeddings, dtype=np.float32).tobytes())
+                records[key] = (first_row, len(sentence_embeddings))
+                first_row += len(sentence_embeddings)
+        with open(self.index_path, 'ab') as file:
+            for key, (first_row, n_rows) in records.items():
+                file.write(INDEX_RECORD.pack(key, first_row, n_rows))
+                self._index[key] = (first_row, n_rows)
+
+
+class EmbeddingCache:
+    """
+    Cached embedder: embeddings of sentences are computed once and read from the store afterwards.
+    Embeddings are computed in evaluation mode (i.e. without embedder dropout).
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._store: Optional[EmbeddingStore] = None
+
+    def reset(self) -> None:
+        """
+        Forget the store, as embedder weights may change.
+        """
+        self._store = None
+
+    def _get_store(self, embedder: nn.Module) -> EmbeddingStore:
+        if self._store is None:
+            store_directory = os.path.join(self.directory, embedder_fingerprint(embedder))
+            self._store = EmbeddingStore(store_directory, embedder.get_output_dim())
+        return self._store
+
+    def embed(self, embedder: nn.Module, tokens: Dict[str, torch.Tensor], sentences_words: List[List[str]]) -> torch.Tensor:
+        """
+        Return [batch_size, seq_len, embedding_dim] embeddings of a batch (padding embeddings are zeros).
+        Only sentences that are not in the store yet are passed through the embedder.
+        """
+        store = self._get_store(embedder)
+        keys = [sentence_key(words) for words in sentences_words]
+        device = next(iter(tokens.values())).device
+
+        missing = [i for i, key in enumerate(keys) if key not in store]
+        if missing:
+            missing_index = torch.tensor(missing, device=device)
+            was_training = embedder.training
+            embedder.eval()
+            with torch.no_grad():
+                missing_embeddings = embedder(**{name: tensor[missing_index] for name, tensor in tokens.items()})
+            embedder.train(was_training)
+            missing_embeddings = missing_embeddings.cpu().numpy()
+            store.add(
+                [keys[i] for i in missing],
+                [missing_embeddings[j, :len(sentences_words[i])] for j, i in enumerate(missing)]
+            )
+
+        batch_size = len(keys)
+        seq_len = max(len(words) for words in sentences_words)
+        embeddings = np.zeros((batch_size, seq_len, store.embedding_dim), dtype=np.float32)
+        for i, key in enumerate(keys):
+            sentence_embeddings = store.get(key)
+            embeddings[i, :len(sentence_embeddings)] = sentence_embeddings
+        return torch.from_numpy(embeddings).to(device)
@@ -0,0 +1,303 @@
+"""
+Export of a trained model into a self-contained bundle for the standalone runtime (see runtime.py).
+
+The network is traced into TorchScript, so the bundle is run with torch alone:
+* encoder.pt - embedder and classifiers: tag predictions, top-k lemma rules (if a lemma dictionary is used),
+  arc scores and relation representations;
+* rel_scorer.pt - relation predictions towards the decoded heads;
+* bundle.json - token indexer configuration (and vocabulary), label tables (lemma rules, pos, feats, deprels,
+  semslots, semclasses), tree decoding algorithm and lemma dictionary settings;
+* tokenizer/ - transformer tokenizer files (for transformer-based models);
+* lemmas.bin - compiled lemma dictionary (see lemma_dictionary.py), if the model uses one.
+
+Tree decoding and lemma dictionary lookups are not traced, since they are done on cpu with python code anyway.
+The runtime does them with the same code as the model.
+
+Usage:
+    python -m src.export serialization_dir/model.tar.gz serialization_dir/bundle
+"""
+
+import os
+import json
+import argparse
+
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+from torch import Tensor
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.common.util import import_module_and_submodules
+from allennlp.data import Batch, Instance, Vocabulary
+from allennlp.data.token_indexers import SingleIdTokenIndexer, PretrainedTransformerMismatchedIndexer, TokenIndexer
+from allennlp.data.vocabulary import DEFAULT_OOV_TOKEN
+from allennlp.models.archival import load_archive
+from allennlp.modules.token_embedders import PretrainedTransformerMismatchedEmbedder
+from allennlp.nn.util import get_text_field_mask, replace_masked_values
+
+from .parser import MorphoSyntaxSemanticParser
+from .lemma_dictionary import compile_lemma_dictionary
+
+
+BUNDLE_VERSION = 1
+BUNDLE_CONFIG_NAME = "bundle.json"
+ENCODER_NAME = "encoder.pt"
+REL_SCORER_NAME = "rel_scorer.pt"
+TOKENIZER_DIR_NAME = "tokenizer"
+LEMMA_DICTIONARY_NAME = "lemmas.bin"
+
+# Sentences the modules are traced on. They differ in length, so that traces include padding.
+EXAMPLE_SENTENCES = [
+    ["Мама", "мыла", "раму", "."],
+    ["Съешь", "же", "ещё", "этих", "мягких", "французских", "булок", ",", "да", "выпей", "чаю", "."],
+]
+
+
+def _pool_wordpieces(embeddings: Tensor, offsets: Tensor, sub_token_mode: str) -> Tensor:
+    """
+    Pool wordpiece embeddings into word embeddings, the same way PretrainedTransformerMismatchedEmbedder does.
+    Unlike allennlp.nn.util.batched_span_select, the maximum span width is not converted to python int,
+    so that it is not traced as a constant.
+    """
+    batch_size, seq_len, embedding_dim = embeddings.shape
+    # [batch_size, n_words, 1]
+    span_starts, span_ends = offsets.split(1, dim=-1)
+    span_widths = span_ends - span_starts
+    # [1, 1, max_span_width]
+    span_range = torch.arange(span_widths.max() + 1, device=embeddings.device).view(1, 1, -1)
+    # [batch_size, n_words, max_span_width]
+    span_mask = span_range <= span_widths
+    raw_span_indices = span_starts + span_range
+    span_mask = span_mask & (raw_span_indices < seq_len) & (0 <= raw_span_indices)
+    span_indices = raw_span_indices * span_mask
+
+    # [batch_size, n_words, max_span_width, embedding_dim]
+    batch_shift = torch.arange(batch_size, device=embeddings.device).view(-1, 1, 1) * seq_len
+    span_embeddings = embeddings.reshape(-1, embedding_dim).index_select(0, (span_indices + batch_shift).view(-1))
+    span_embeddings = span_embeddings.view(span_indices.shape + (embedding_dim,))
+    span_mask = span_mask.unsqueeze(-1)
+    span_embeddings = span_embeddings * span_mask
+
+    if sub_token_mode == "first":
+        return span_embeddings[:, :, 0, :]
+    # Average of sub-token embeddings ("avg" mode).
+    span_embeddings_sum = span_embeddings.sum(2)
+    span_embeddings_len = span_mask.sum(2)
+    word_embeddings = span_embeddings_sum / torch.clamp_min(span_embeddings_len, 1)
+    return word_embeddings.masked_fill((span_embeddings_len == 0).expand(word_embeddings.shape), 0)
+
+
+class TracedEncoder(nn.Module):
+    """
+    Parser's network up to tree decoding.
+    Inputs are indexed tokens (in input_names order), outputs are a dict of tensors.
+    """
+
+    def __init__(self, model: MorphoSyntaxSemanticParser, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def embed(self, tokens: Dict[str, Tensor]) -> Tensor:
+        embedder = self.model.embedder
+        if isinstance(embedder, PretrainedTransformerMismatchedEmbedder):
+            # Type ids of single sentences are constant, so the embedder's branch on their values is traced as it should be.
+            embeddings = embedder._matched_embedder(tokens["token_ids"], tokens["wordpiece_mask"], type_ids=tokens.get("type_ids"))
+            return _pool_wordpieces(embeddings, tokens["offsets"], embedder.sub_token_mode)
+        return embedder(**tokens)
+
+    def forward(self, *inputs: Tensor) -> Dict[str, Tensor]:
+        tokens = dict(zip(self.input_names, inputs))
+        # [batch_size, seq_len, embedding_dim]
+        embeddings = self.embed(tokens)
+        # [batch_size, seq_len]
+        mask = get_text_field_mask({"tokens": tokens})
+
+        outputs = {"mask": mask}
+
+        lemma_rule_classifier = self.model.lemma_rule_classifier
+        lemma_rule_logits = lemma_rule_classifier.classifier(embeddings)
+        outputs["lemma_rule_preds"] = lemma_rule_logits.argmax(-1)
+        if lemma_rule_classifier.dictionary:
+            # Candidates of dictionary correction (see LemmaClassifier._correct_predictions).
+            probs = nn.functional.softmax(lemma_rule_logits, dim=-1)
+            outputs["lemma_rule_top"] = torch.topk(probs, k=lemma_rule_classifier.topk, dim=-1).indices
+
+        outputs["pos_feats_preds"] = self.model.pos_feats_classifier.classifier(embeddings).argmax(-1)
+        outputs["semslot_preds"] = self.model.semslot_classifier.classifier(embeddings).argmax(-1)
+        outputs["semclass_preds"] = self.model.semclass_classifier.classifier(embeddings).argmax(-1)
+
+        # Follow DependencyClassifier.forward.
+        dependency_classifier = self.model.dependency_classifier
+        h_arc_head = dependency_classifier.arc_head_mlp(embeddings)
+        h_arc_dep = dependency_classifier.arc_dep_mlp(embeddings)
+        s_arc = dependency_classifier.arc_attention(h_arc_head, h_arc_dep)
+        outputs["s_arc"] = replace_masked_values(s_arc, mask[:, None, :], replace_with=-float("inf"))
+        outputs["h_rel_head"] = dependency_classifier.rel_head_mlp(embeddings)
+        outputs["h_rel_dep"] = dependency_classifier.rel_dep_mlp(embeddings)
+        return outputs
+
+
+class TracedRelScorer(nn.Module):
+    """
+    Relation predictions towards given arcs (in internal format, see DependencyClassifier).
+    """
+
+    def __init__(self, model: MorphoSyntaxSemanticParser):
+        super().__init__()
+        self.dependency_classifier = model.dependency_classifier
+
+    def forward(self, h_rel_head: Tensor, h_rel_dep: Tensor, arcs: Tensor) -> Tensor:
+        dependency_classifier = self.dependency_classifier
+        if dependency_classifier.lean_rel_scores:
+            s_rel = dependency_classifier._rel_scores(h_rel_head, h_rel_dep, arcs)
+        else:
+            s_rel = dependency_classifier.rel_attention(h_rel_head, h_rel_dep).permute(0, 2, 3, 1)
+            s_rel = dependency_classifier._gather_rel_scores(s_rel, arcs)
+        return s_rel.argmax(-1)
+
+
+def _indexer_config(indexer: TokenIndexer, vocab: Vocabulary, bundle_dir: str) -> Dict:
+    """
+    Describe token indexer for the runtime, which indexes words without allennlp.
+    """
+    if isinstance(indexer, SingleIdTokenIndexer):
+        if indexer._start_tokens or indexer._end_tokens or indexer._feature_name != "text":
+            raise ConfigurationError("Only plain single_id token indexers (no start/end tokens, text feature) are exported.")
+        index_to_token = vocab.get_index_to_token_vocabulary(indexer.namespace)
+        return {
+            "type": "single_id",
+            "lowercase_tokens": indexer.lowercase_tokens,
+            "vocabulary": [index_to_token[index] for index in range(len(index_to_token))],
+            "oov_index": vocab.get_token_index(vocab._oov_token, indexer.namespace),
+        }
+
+    if isinstance(indexer, PretrainedTransformerMismatchedIndexer):
+        if indexer._matched_indexer._max_length is not None:
+            raise ConfigurationError("Transformer indexers with max_length are not exported.")
+        tokenizer = indexer._allennlp_tokenizer
+        indexer._tokenizer.save_pretrained(os.path.join(bundle_dir, TOKENIZER_DIR_NAME))
+        return {
+            "type": "pretrained_transformer_mismatched",
+            "tokenizer": TOKENIZER_DIR_NAME,
+            "start_tokens": [[token.text_id, token.type_id] for token in tokenizer.single_sequence_start_tokens],
+            "end_tokens": [[token.text_id, token.type_id] for token in tokenizer.single_sequence_end_tokens],
+            "type_id": tokenizer.single_sequence_token_type_id,
+            "pad_token_id": indexer._tokenizer.pad_token_id or 0,
+        }
+
+    raise ConfigurationError(f"Token indexer {type(indexer).__name__} is not supported by export.")
+
+
+def _label_tables(vocab: Vocabulary) -> Dict[str, List]:
+    """
+    Labels of each namespace ordered by their indexes. Unknown (OOV) labels are None for lemma rules and '_' otherwise,
+    as in MorphoSyntaxSemanticParser decoding tables.
+    """
+    def labels(namespace: str, oov_value=None) -> List:
+        index_to_label = vocab.get_index_to_token_vocabulary(namespace)
+        return [
+            index_to_label[index] if index_to_label[index] != DEFAULT_OOV_TOKEN else oov_value
+            for index in range(len(index_to_label))
+        ]
+
+    pos_feats = labels("pos_feats_labels")
+    return {
+        "lemma_rule": labels("lemma_rule_labels", oov_value=None),
+        "pos": [label.split('#')[0] if label is not None else '_' for label in pos_feats],
+        "feats": [label.split('#')[1] if label is not None else '_' for label in pos_feats],
+        "deprel": labels("deprel_labels", oov_value='_'),
+        "semslot": labels("semslot_labels", oov_value='_'),
+        "semclass": labels("semclass_labels", oov_value='_'),
+    }
+
+
+def _example_inputs(reader, model: MorphoSyntaxSemanticParser) -> Tuple[List[str], Tuple[Tensor, ...]]:
+    """
+    Index example sentences the same way the predictor does.
+    """
+    instances: List[Instance] = []
+    for words in EXAMPLE_SENTENCES:
+        instance = reader.text_to_instance(words)
+        reader.apply_token_indexers(instance)
+        instances.append(instance)
+    batch = Batch(instances)
+    batch.index_instances(model.vocab)
+    tokens = batch.as_tensor_dict()["words"]["tokens"]
+    input_names = sorted(tokens)
+    return input_names, tuple(tokens[name] for name in input_names)
+
+
+def export_bundle(archive_file: str, bundle_dir: str, overrides: str = "") -> None:
+    archive = load_archive(archive_file, overrides=overrides)
+    model = archive.model
+    model.eval()
+    reader = archive.dataset_reader
+
+    if list(reader.token_indexers) != ["tokens"]:
+        raise ConfigurationError("Only models with a single token indexer named 'tokens' are exported.")
+
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    config = {
+        "version": BUNDLE_VERSION,
+        "indexer": _indexer_config(reader.token_indexers["tokens"], model.vocab, bundle_dir),
+        "labels": _label_tables(model.vocab),
+        "decoding": model.dependency_classifier.decoding,
+        "lemma_topk": None,
+        "lemma_dictionary": None,
+    }
+
+    lemma_rule_classifier = model.lemma_rule_classifier
+    if lemma_rule_classifier.dictionary:
+        config["lemma_topk"] = lemma_rule_classifier.topk
+        config["lemma_dictionary"] = LEMMA_DICTIONARY_NAME
+        compile_lemma_dictionary(lemma_rule_classifier.dictionary, os.path.join(bundle_dir, LEMMA_DICTIONARY_NAME))
+
+    input_names, example_inputs = _example_inputs(reader, model)
+    config["inputs"] = input_names
+
+    with torch.no_grad():
+        encoder = TracedEncoder(model, input_names)
+        traced_encoder = torch.jit.trace(encoder, example_inputs, strict=False, check_trace=False)
+        outputs = encoder(*example_inputs)
+
+        # Trace relation scorer on greedy arcs.
+        rel_scorer_inputs = (outputs["h_rel_head"], outputs["h_rel_dep"], outputs["s_arc"].argmax(-1))
+        traced_rel_scorer = torch.jit.trace(TracedRelScorer(model), rel_scorer_inputs, check_trace=False)
+
+    traced_encoder.save(os.path.join(bundle_dir, ENCODER_NAME))
+    traced_rel_scorer.save(os.path.join(bundle_dir, REL_SCORER_NAME))
+
+    with open(os.path.join(bundle_dir, BUNDLE_CONFIG_NAME), 'w') as file:
+        json.dump(config, file, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Export a model archive into a TorchScript bundle for the standalone runtime (see runtime.py).',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'model_file',
+        type=str,
+        help='Model archive (model.tar.gz).'
+    )
+    parser.add_argument(
+        'bundle_dir',
+        type=str,
+        help='Directory to save the bundle to (bundle files are overwritten, if exist).'
+    )
+    parser.add_argument(
+        '-overrides',
+        type=str,
+        default="",
+        help='JSON overrides of the model configuration, e.g. \'{"model.depencency_classifier.decoding": "eisner"}\'.'
+    )
+    args = parser.parse_args()
+
+    # Register all the models of the package.
+    import_module_and_submodules(__package__)
+    export_bundle(args.model_file, args.bundle_dir, args.overrides)
+    print(f"Bundle is saved to {args.bundle_dir}.")
@@ -1,8 +1,7 @@
 from overrides import override
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
-import re
-import string
+import numpy as np
 
 import torch
 from torch import nn
@@ -13,7 +12,8 @@ from allennlp.models import Model
 from allennlp.nn.activations import Activation
 from allennlp.training.metrics import CategoricalAccuracy
 
-from .lemmatize_helper import LemmaRule, predict_lemma_from_rule, normalize, DEFAULT_LEMMA_RULE
+from .lemmatize_helper import LemmaRule, predict_lemma_from_rule, normalize, is_correctable, DEFAULT_LEMMA_RULE
+from .lemma_dictionary import read_lemmas, load_lemma_dictionary
 
 
 @Model.register('feed_forward_classifier')
@@ -44,9 +44,10 @@ class FeedForwardClassifier(Model):
     def forward(self,
                 embeddings: Tensor,
                 labels: Tensor = None,
-                mask: Tensor = None
+                mask: Tensor = None,
+                projections: Dict[str, Tensor] = None
                 ) -> Dict[str, Tensor]:
-        logits = self.classifier(embeddings)
+        logits = self.logits(embeddings, projections)
         preds = logits.argmax(-1)
 
         loss = torch.tensor(0.)
@@ -56,6 +57,15 @@ class FeedForwardClassifier(Model):
 
         return {'logits': logits, 'preds': preds, 'loss': loss}
 
+    def logits(self, embeddings: Tensor, projections: Dict[str, Tensor] = None) -> Tensor:
+        if projections is None:
+            return self.classifier(embeddings)
+        # Activated input projection is precomputed (see fused_projection.py), and dropouts are no-ops at inference.
+        return self.classifier[-1](projections["classifier"])
+
+    def input_projections(self) -> Dict[str, Tuple[nn.Linear, nn.Module]]:
+        return {"classifier": (self.classifier[1], self.classifier[2])}
+
     def loss(self, logits: Tensor, target: Tensor, mask: Tensor) -> Tensor:
         return self.criterion(logits[mask], target[mask])
 
@@ -70,7 +80,8 @@ class LemmaClassifier(FeedForwardClassifier):
     FeedForwardClassifier specialization for lemma classification.
     """
 
-    PUNCTUATION = set(string.punctuation)
+    # Memo of dictionary lookups is cleared once it grows this large.
+    MAX_CACHE_SIZE = 1_000_000
 
     def __init__(self,
                  vocab: Vocabulary,
@@ -80,19 +91,18 @@ class LemmaClassifier(FeedForwardClassifier):
                  activation: str,
                  dropout: float,
                  dictionaries: List[Dict[str, str]] = [],
+                 compiled_dictionary: str = None,
                  topk: int = None):
 
         super().__init__(vocab, in_dim, hid_dim, n_classes, activation, dropout)
 
-        self.dictionary = set()
-        for dictionary_info in dictionaries:
-            dictionary_path = dictionary_info["path"]
-            lemma_match_pattern = dictionary_info["lemma_match_pattern"]
-            with open(dictionary_path, 'r') as f:
-                txt = f.read()
-                lemmas = re.findall(lemma_match_pattern, txt, re.MULTILINE)
-                lemmas = set(map(normalize, lemmas))
-            self.dictionary |= lemmas
+        # Set of normalized lemmas.
+        # If compiled_dictionary path is given, dictionaries are compiled into it once and memory-mapped afterwards
+        # (see lemma_dictionary.py), otherwise they are read into memory.
+        if compiled_dictionary is not None:
+            self.dictionary = load_lemma_dictionary(compiled_dictionary, dictionaries)
+        else:
+            self.dictionary = read_lemmas(dictionaries)
 
         # If dictionary is given, topk must be set as well and vise versa.
         if self.dictionary:
@@ -101,59 +111,81 @@ class LemmaClassifier(FeedForwardClassifier):
             assert(topk is None)
         self.topk = topk
 
+        # Lemma rules parsed in advance (None for "unknown rule"), indexed by lemma rule id.
+        self._lemma_rules = [
+            LemmaRule.from_str(lemma_rule_str) if lemma_rule_str != DEFAULT_OOV_TOKEN else None
+            for lemma_rule_str in self._get_lemma_rule_labels(vocab)
+        ] if self.dictionary else []
+        # (word, lemma rule id) -> whether the lemma is in the dictionary.
+        self._is_in_dictionary_cache = {}
+
+    @staticmethod
+    def _get_lemma_rule_labels(vocab: Vocabulary) -> List[str]:
+        index_to_token = vocab.get_index_to_token_vocabulary("lemma_rule_labels")
+        return [index_to_token[index] for index in range(len(index_to_token))]
+
     @override
     def forward(self,
                 embeddings: Tensor,
                 labels: Tensor = None,
                 mask: Tensor = None,
-                metadata: Dict = None
+                metadata: Dict = None,
+                projections: Dict[str, Tensor] = None
                 ) -> Dict[str, Tensor]:
 
-        output = super().forward(embeddings, labels, mask)
+        output = super().forward(embeddings, labels, mask, projections)
         logits, preds, loss = output['logits'], output['preds'], output['loss']
 
         # During the inference try to avoid malformed lemmas using external dictionary (if provided).
         if not self.training and self.dictionary:
-            # Find top most confident lemma rules for each token.
-            probs = torch.nn.functional.softmax(logits, dim=-1)
-            top_rules = torch.topk(probs, k=self.topk, dim=-1).indices.cpu().numpy()
-
-            for i in range(len(metadata)):
-                tokens = metadata[i]
-                tokens_top_rules = top_rules[i]
-
-                for j in range(len(tokens)):
-                    token = str(tokens[j])
-                    token_top_rules = tokens_top_rules[j]
-
-                    # Lemmatizer usually does well with titles (e.g. 'Вася')
-                    # and different kind of dates (like '70-е')
-                    # so don't correct the predictions in that case.
-                    is_punctuation = lambda word: word in LemmaClassifier.PUNCTUATION
-                    is_title = lambda word: word[0].isupper()
-                    contains_digit = lambda word: any(char.isdigit() for char in word)
-                    if is_punctuation(token) or is_title(token) or contains_digit(token):
-                        continue
-
-                    # Find the most probable correct lemma for the word.
-                    better_lemma_found = False
-                    for lemma_rule_id in token_top_rules:
-                        lemma_rule_str = self.vocab.get_token_from_index(lemma_rule_id, "lemma_rule_labels")
-
-                        # If the current most confident lemma rule is "unknown rule",
-                        # then lemmatizer has no idea how to lemmatize the token, so interrupt lookup.
-                        if lemma_rule_str == DEFAULT_OOV_TOKEN:
-                            continue
-
-                        lemma_rule = LemmaRule.from_str(lemma_rule_str)
-                        lemma = predict_lemma_from_rule(token, lemma_rule)
-                        if normalize(lemma) in self.dictionary:
-                            better_lemma_found = True
-                            break
-
-                    # Update predictions with the better lemma.
-                    if better_lemma_found:
-                        preds[i][j] = lemma_rule_id
+            preds = self._correct_predictions(logits, preds, metadata)
 
         return {'preds': preds, 'loss': loss}
 
+    def _correct_predictions(self, logits: Tensor, preds: Tensor, metadata: List) -> Tensor:
+        """
+        Replace predicted lemma rules with the most probable of top-k rules that produce a lemma from the dictionary.
+        """
+        # Find top most confident lemma rules for each token.
+        probs = torch.nn.functional.softmax(logits, dim=-1)
+        # [batch_size, seq_len, topk]
+        top_rules = torch.topk(probs, k=self.topk, dim=-1).indices
+
+        # Find the first (i.e. the most probable) of top-k candidate lemmas that is in the dictionary.
+        # [batch_size, seq_len, topk]
+        is_found = np.zeros(top_rules.shape, dtype=bool)
+        cache = self._is_in_dictionary_cache
+        for i, (tokens, tokens_top_rules) in enumerate(zip(metadata, top_rules.tolist())):
+            for j, (token, token_top_rules) in enumerate(zip(tokens, tokens_top_rules)):
+                form = token["form"]
+                if not is_correctable(form):
+                    continue
+                for k, lemma_rule_id in enumerate(token_top_rules):
+                    # Inlined cache lookup, as it is the hottest place.
+                    in_dictionary = cache.get((form, lemma_rule_id))
+                    if in_dictionary is None:
+                        in_dictionary = self._is_in_dictionary(form, lemma_rule_id)
+                    if in_dictionary:
+                        is_found[i, j, k] = True
+                        break
+        is_found = torch.from_numpy(is_found).to(preds.device)
+
+        # Update predictions with the better lemmas.
+        # [batch_size, seq_len]
+        better_preds = top_rules.gather(-1, is_found.int().argmax(-1, keepdim=True)).squeeze(-1)
+        return torch.where(is_found.any(-1), better_preds, preds)
+
+    def _is_in_dictionary(self, word: str, lemma_rule_id: int) -> bool:
+        """
+        Whether the lemma the rule produces for the word is in the dictionary (memoized).
+        """
+        key = (word, lemma_rule_id)
+        in_dictionary = self._is_in_dictionary_cache.get(key)
+        if in_dictionary is None:
+            lemma_rule = self._lemma_rules[lemma_rule_id]
+            # If the rule is "unknown rule", then lemmatizer has no idea how to lemmatize the token.
+            in_dictionary = lemma_rule is not None and normalize(predict_lemma_from_rule(word, lemma_rule)) in self.dictionary
+            if len(self._is_in_dictionary_cache) >= self.MAX_CACHE_SIZE:
+                self._is_in_dictionary_cache.clear()
+            self._is_in_dictionary_cache[key] = in_dictionary
+        return in_dictionary
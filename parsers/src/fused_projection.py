@@ -0,0 +1,90 @@
+"""
+Inference-time fusion of classifiers' input projections.
+
+Every classifier of the parser starts with a Linear layer and an activation over the same embeddings (lemma, pos and feats,
+semslot and semclass classifiers, and four MLPs of the dependency classifier). At inference, these eight layers are computed
+with a single matmul of their concatenated weights (and a single activation, if all classifiers use the same one),
+and the result is split between classifiers, which is faster than eight separate matmuls (especially for small batches).
+"""
+
+from copy import copy
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+from torch import Tensor
+import torch.nn.functional as F
+
+
+class FusedProjections:
+    """
+    Input projections (first Linear layers followed by activations) of several classifiers computed as a single layer.
+
+    Classifiers must implement `input_projections()`, which returns their (Linear layer, activation) pairs by name,
+    and accept the activated projections of embeddings as `projections` argument of `forward`.
+
+    Concatenated weights are not parameters of the model (so they are neither trained nor saved): they are built
+    on first use and rebuilt whenever weights of any projection change (e.g. after an optimizer step,
+    load_state_dict or moving the model to another device).
+    """
+
+    def __init__(self, classifiers: Dict[str, nn.Module]):
+        # (classifier name, projection name, Linear layer, activation).
+        self.layers: List[Tuple[str, str, nn.Linear, nn.Module]] = [
+            (classifier_name, projection_name, linear, activation)
+            for classifier_name, classifier in classifiers.items()
+            for projection_name, (linear, activation) in classifier.input_projections().items()
+        ]
+        self._split_sizes = [linear.out_features for _, _, linear, _ in self.layers]
+        # Elementwise activation of strided slices is slow, so the same activation is applied to the whole output at once.
+        activations = [activation for _, _, _, activation in self.layers]
+        self._shared_activation = copy(activations[0]) if len(set(map(repr, activations))) == 1 else None
+        # The output of the fused layer is not needed afterwards, so activate it in place (if the activation supports it)
+        # to save a large allocation.
+        if hasattr(self._shared_activation, "inplace"):
+            self._shared_activation.inplace = True
+        self._weight = None
+        self._bias = None
+        self._weights_version = None
+
+    @staticmethod
+    def can_fuse(classifiers: Dict[str, nn.Module]) -> bool:
+        """
+        Whether all input projections are plain Linear layers with biases (e.g. not quantized ones).
+        """
+        return all(
+            type(linear) is nn.Linear and linear.bias is not None
+            for classifier in classifiers.values()
+            for linear, _ in classifier.input_projections().values()
+        )
+
+    def _get_weights_version(self) -> tuple:
+        # In-place updates bump tensor version, while moving to another device changes data pointer.
+        return tuple(
+            (parameter.data_ptr(), parameter._version)
+            for _, _, linear, _ in self.layers
+            for parameter in (linear.weight, linear.bias)
+        )
+
+    def __call__(self, embeddings: Tensor) -> Dict[str, Dict[str, Tensor]]:
+        """
+        Return activated projections of embeddings:
+        {classifier name: {projection name: [batch_size, seq_len, out_features]}}.
+        """
+        weights_version = self._get_weights_version()
+        if weights_version != self._weights_version:
+            with torch.no_grad():
+                self._weight = torch.cat([linear.weight for _, _, linear, _ in self.layers])
+                self._bias = torch.cat([linear.bias for _, _, linear, _ in self.layers])
+            self._weights_version = weights_version
+
+        outputs = F.linear(embeddings, self._weight, self._bias)
+        if self._shared_activation is not None:
+            outputs = self._shared_activation(outputs)
+
+        projections = {classifier_name: {} for classifier_name, _, _, _ in self.layers}
+        for (classifier_name, projection_name, _, activation), output in zip(self.layers, outputs.split(self._split_sizes, dim=-1)):
+            if self._shared_activation is None:
+                output = activation(output)
+            projections[classifier_name][projection_name] = output
+        return projections
@@ -0,0 +1,221 @@
+"""
+On-disk cache of dataset instances.
+
+Instances are stored as records: words, labels (lemma rules, joint pos&feats tags, etc.), metadata and
+indexed tokens of token indexers that do not depend on vocabulary (e.g. transformer wordpiece ids and offsets).
+Labels are stored as strings, since their ids depend on the vocabulary, which is built after reading.
+
+A cache consists of two files:
+* <key>.data - pickled records, one after another,
+* <key>.index - offsets of the records in the data file (uint64 each).
+The index is written last, so a cache is complete if its index exists.
+Offsets allow reading a subset of records (e.g. a shard of the dataset) without loading the others.
+A shard of the dataset may also be cached on its own, if the whole dataset is never read by a single process.
+The key is a hash of the dataset file contents, token indexers configuration and the cache format version.
+"""
+
+import os
+import json
+import pickle
+import copyreg
+import hashlib
+from array import array
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from conllu.models import TokenList
+
+from allennlp.data import Vocabulary
+from allennlp.data.fields import TextField
+from allennlp.data.token_indexers import TokenIndexer, PretrainedTransformerIndexer, PretrainedTransformerMismatchedIndexer
+from allennlp.data.token_indexers.token_indexer import IndexedTokenList
+from allennlp.data.tokenizers import Tokenizer, Token
+from allennlp.version import VERSION as ALLENNLP_VERSION
+
+from .lemmatize_helper import LEMMA_RULE_CACHE_VERSION
+
+
+# Increase it whenever records format (or the way labels are made) changes.
+CACHE_VERSION = 1
+
+# Token indexers, which output does not depend on vocabulary, so indexed tokens can be cached.
+VOCABULARY_INDEPENDENT_INDEXERS = (PretrainedTransformerIndexer, PretrainedTransformerMismatchedIndexer)
+
+# Indexers' attributes that are state rather than configuration.
+INDEXER_STATE_ATTRIBUTES = {"_added_to_vocabulary"}
+
+
+class IndexedTextField(TextField):
+    """
+    TextField with indexed tokens of some indexers computed in advance (e.g. loaded from cache).
+    Tokens of the other indexers are indexed as usual.
+    """
+    __slots__ = ["_precomputed_indexed_tokens"]
+
+    def __init__(self,
+                 tokens: List[Token],
+                 token_indexers: Dict[str, TokenIndexer],
+                 precomputed_indexed_tokens: Dict[str, IndexedTokenList]):
+        super().__init__(tokens, token_indexers)
+        self._precomputed_indexed_tokens = precomputed_indexed_tokens
+
+    def index(self, vocab: Vocabulary):
+        self._indexed_tokens = {}
+        for indexer_name, indexer in self.token_indexers.items():
+            if indexer_name in self._precomputed_indexed_tokens:
+                # Transformer indexers copy transformer vocabulary into allennlp one on indexing, so do it as well.
+                matched_indexer = getattr(indexer, "_matched_indexer", indexer)
+                matched_indexer._add_encoding_to_vocabulary_if_needed(vocab)
+                self._indexed_tokens[indexer_name] = self._precomputed_indexed_tokens[indexer_name]
+            else:
+                self._indexed_tokens[indexer_name] = indexer.tokens_to_indices(self.tokens, vocab)
+
+
+def precompute_indexed_tokens(tokens: List[Token],
+                              token_indexers: Dict[str, TokenIndexer],
+                              vocab: Vocabulary) -> Dict[str, IndexedTokenList]:
+    """
+    Index tokens with vocabulary-independent indexers (vocab is a scratch vocabulary then).
+    """
+    return {
+        indexer_name: indexer.tokens_to_indices(tokens, vocab)
+        for indexer_name, indexer in token_indexers.items()
+        if isinstance(indexer, VOCABULARY_INDEPENDENT_INDEXERS)
+    }
+
+
+def _reduce_token_list(tokens: TokenList):
+    return TokenList, (list(tokens), tokens.metadata)
+
+
+# Default TokenList unpickling extends the list before its metadata is restored, which fails.
+# Sentences are pickled as instances metadata both into the cache and between data loader workers.
+copyreg.pickle(TokenList, _reduce_token_list)
+
+
+def _describe(obj: Any) -> Dict[str, Any]:
+    """
+    Describe token indexer (or tokenizer) configuration with its simple attributes
+    (e.g. model name, namespace, max length), recursively.
+    """
+    description = {"type": f"{type(obj).__module__}.{type(obj).__qualname__}"}
+    for name, value in sorted(vars(obj).items()):
+        if name in INDEXER_STATE_ATTRIBUTES:
+            continue
+        if isinstance(value, (TokenIndexer, Tokenizer)):
+            description[name] = _describe(value)
+        elif isinstance(value, (str, int, float, bool, type(None), list, tuple, dict)):
+            description[name] = value
+    return description
+
+
+def indexers_fingerprint(token_indexers: Dict[str, TokenIndexer]) -> str:
+    description = {name: _describe(indexer) for name, indexer in sorted(token_indexers.items())}
+    return json.dumps(description, sort_keys=True, default=str)
+
+
+def file_hash(file_path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def cache_key(file_path: str, token_indexers: Dict[str, TokenIndexer]) -> str:
+    key = '\n'.join([
+        f"cache version {CACHE_VERSION}",
+        f"lemma rules version {LEMMA_RULE_CACHE_VERSION}",
+        f"allennlp {ALLENNLP_VERSION}",
+        file_hash(file_path),
+        indexers_fingerprint(token_indexers),
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class InstanceCache:
+    """
+    Records cache of a dataset file.
+    """
+
+    def __init__(self,
+                 cache_directory: str,
+                 file_path: str,
+                 token_indexers: Dict[str, TokenIndexer],
+                 shard_index: int = 0,
+                 num_shards: int = 1,
+                 key: str = None):
+        # The key hashes the whole file, so caches of the same file share it (see for_shard).
+        if key is None:
+            key = cache_key(file_path, token_indexers)
+        self._file_path = file_path
+        self._token_indexers = token_indexers
+        self._key = key
+        base_name = f"{os.path.basename(file_path)}.{key}"
+        if num_shards > 1:
+            # Cache of a shard of the file (see ComprenoUDDatasetReader sharding).
+            base_name += f".shard-{shard_index}-of-{num_shards}"
+        self.data_path = os.path.join(cache_directory, f"{base_name}.data")
+        self.index_path = os.path.join(cache_directory, f"{base_name}.index")
+        self._cache_directory = cache_directory
+        self._offsets: Optional[array] = None
+
+    def for_shard(self, shard_index: int, num_shards: int) -> "InstanceCache":
+        """
+        Return cache of a shard of the same file, without hashing the file again.
+        """
+        return InstanceCache(self._cache_directory, self._file_path, self._token_indexers, shard_index, num_shards, self._key)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.index_path) and os.path.exists(self.data_path)
+
+    @property
+    def offsets(self) -> array:
+        if self._offsets is None:
+            self._offsets = array('Q')
+            with open(self.index_path, 'rb') as file:
+                self._offsets.frombytes(file.read())
+        return self._offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def read(self, record_indexes: Iterable[int] = None) -> Iterator[Dict]:
+        """
+        Lazily read all the records or the ones with given indexes (in ascending order).
+        """
+        with open(self.data_path, 'rb') as file:
+            if record_indexes is None:
+                for _ in range(len(self)):
+                    yield pickle.load(file)
+            else:
+                for record_index in record_indexes:
+                    file.seek(self.offsets[record_index])
+                    yield pickle.load(file)
+
+    def write(self, records: Iterable[Dict]) -> Iterator[Dict]:
+        """
+        Write records into the cache while passing them through.
+        The cache is only created if all records are consumed.
+        """
+        os.makedirs(self._cache_directory, exist_ok=True)
+        temp_data_path = f"{self.data_path}.{os.getpid()}.tmp"
+        offsets = array('Q')
+        try:
+            with open(temp_data_path, 'wb') as file:
+                for record in records:
+                    offsets.append(file.tell())
+                    pickle.dump(record, file, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield record
+            os.replace(temp_data_path, self.data_path)
+            self._write_index(offsets)
+        finally:
+            if os.path.exists(temp_data_path):
+                os.remove(temp_data_path)
+
+    def _write_index(self, offsets: array) -> None:
+        temp_index_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_index_path, 'wb') as file:
+            file.write(offsets.tobytes())
+        os.replace(temp_index_path, self.index_path)
+        self._offsets = offsets
@@ -0,0 +1,192 @@
+"""
+Compiled lemma dictionary: a sorted array of normalized lemmas stored in a binary file.
+
+The file is memory-mapped read-only, so loading it is instant and its pages are shared
+by all processes (e.g. predictor workers) that use the same file.
+
+File layout (little-endian):
+* header: magic, format version, number of lemmas, fingerprint of dictionary sources;
+* offsets: (number of lemmas + 1) uint64 offsets of lemmas in the blob;
+* blob: UTF-8 encoded lemmas sorted bytewise.
+
+Usage:
+    python -m src.lemma_dictionary configs/topk-lemma.jsonnet dicts/lemmas.bin
+compiles dictionaries of the config lemma classifier into dicts/lemmas.bin.
+"""
+
+import os
+import re
+import sys
+import mmap
+import struct
+import hashlib
+import argparse
+
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+from .lemmatize_helper import normalize
+
+
+MAGIC = b"SEMLEMMA"
+VERSION = 1
+# magic, version, number of lemmas, sha1 fingerprint of sources (+ padding, so that offsets are 8-byte aligned).
+HEADER = struct.Struct("<8sQQ20s4x")
+OFFSET = struct.Struct("<Q")
+
+
+def read_lemmas(dictionaries: List[Dict[str, str]]) -> Set[str]:
+    """
+    Read normalized lemmas from text dictionaries. Each dictionary is a dict with
+    "path" to the dictionary file and "lemma_match_pattern" regex, which group matches a lemma.
+    """
+    lemmas = set()
+    for dictionary_info in dictionaries:
+        dictionary_path = dictionary_info["path"]
+        lemma_match_pattern = dictionary_info["lemma_match_pattern"]
+        with open(dictionary_path, 'r') as f:
+            txt = f.read()
+        lemmas |= set(map(normalize, re.findall(lemma_match_pattern, txt, re.MULTILINE)))
+    return lemmas
+
+
+def sources_fingerprint(dictionaries: List[Dict[str, str]]) -> Optional[bytes]:
+    """
+    Fingerprint of dictionary sources (paths, patterns, file sizes and modification times),
+    or None if some of the source files are missing.
+    Modification time catches edits that keep the file size, while contents are not hashed,
+    so that loading a compiled dictionary stays fast.
+    """
+    sources = []
+    for dictionary_info in dictionaries:
+        path = dictionary_info["path"]
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        sources.append(f"{path}\t{dictionary_info['lemma_match_pattern']}\t{stat.st_size}\t{stat.st_mtime_ns}")
+    return hashlib.sha1('\n'.join(sources).encode()).digest()
+
+
+def compile_lemma_dictionary(lemmas: Iterable[str], output_path: str, fingerprint: bytes = None) -> None:
+    """
+    Write lemmas into a compiled dictionary file.
+    The file is replaced atomically, so that processes compiling the same dictionary do not interfere.
+    """
+    encoded_lemmas = sorted(set(lemma.encode() for lemma in lemmas))
+
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(encoded_lemmas), fingerprint or bytes(20)))
+        offset = 0
+        file.write(OFFSET.pack(offset))
+        for lemma in encoded_lemmas:
+            offset += len(lemma)
+            file.write(OFFSET.pack(offset))
+        for lemma in encoded_lemmas:
+            file.write(lemma)
+    os.replace(temp_path, output_path)
+
+
+class LemmaDictionary:
+    """
+    Read-only set of normalized lemmas backed by a compiled dictionary file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._open()
+
+    def _open(self) -> None:
+        with open(self.path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self._size, self.fingerprint = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a compiled lemma dictionary.")
+        if version != VERSION:
+            raise ValueError(f"{self.path} has format version {version}, while {VERSION} is expected. Recompile it.")
+
+        offsets_end = HEADER.size + OFFSET.size * (self._size + 1)
+        if sys.byteorder == "little":
+            # Zero-copy view of offsets.
+            self._offsets = memoryview(self._mmap)[HEADER.size:offsets_end].cast('Q')
+        else:
+            self._offsets = [
+                OFFSET.unpack_from(self._mmap, position)[0]
+                for position in range(HEADER.size, offsets_end, OFFSET.size)
+            ]
+        self._blob_start = offsets_end
+
+    def _get(self, index: int) -> bytes:
+        return self._mmap[self._blob_start + self._offsets[index]:self._blob_start + self._offsets[index + 1]]
+
+    def __contains__(self, lemma: str) -> bool:
+        # Binary search over sorted lemmas.
+        key = lemma.encode()
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            value = self._get(middle)
+            if value < key:
+                low = middle + 1
+            elif value > key:
+                high = middle
+            else:
+                return True
+        return False
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self._size):
+            yield self._get(index).decode()
+
+    def __getstate__(self) -> Dict:
+        # Memory map can't be pickled, so the file is reopened instead.
+        return {"path": self.path}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.path = state["path"]
+        self._open()
+
+
+def load_lemma_dictionary(path: str, dictionaries: List[Dict[str, str]] = []) -> LemmaDictionary:
+    """
+    Load compiled dictionary. If dictionary sources are given, the file is (re)compiled from them in case
+    it does not exist or was compiled from other sources.
+    """
+    fingerprint = sources_fingerprint(dictionaries) if dictionaries else None
+    if os.path.exists(path):
+        dictionary = LemmaDictionary(path)
+        if fingerprint is None or dictionary.fingerprint == fingerprint:
+            return dictionary
+    elif fingerprint is None:
+        raise FileNotFoundError(f"Compiled dictionary {path} does not exist, while its sources are not given or missing.")
+
+    compile_lemma_dictionary(read_lemmas(dictionaries), path, fingerprint)
+    return LemmaDictionary(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Compile lemma dictionaries of a config into a binary dictionary file.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'config',
+        type=str,
+        help='Model configuration file with "dictionaries" of lemma_rule_classifier.'
+    )
+    parser.add_argument(
+        'output_file',
+        type=str,
+        help='Compiled dictionary file to be produced.'
+    )
+    args = parser.parse_args()
+
+    from allennlp.common import Params
+    config = Params.from_file(args.config).as_dict(quiet=True)
+    dictionaries = config["model"]["lemma_rule_classifier"]["dictionaries"]
+
+    compile_lemma_dictionary(read_lemmas(dictionaries), args.output_file, sources_fingerprint(dictionaries))
+    print(f"Compiled {len(LemmaDictionary(args.output_file))} lemmas into {args.output_file}.")
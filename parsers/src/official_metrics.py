@@ -0,0 +1,453 @@
+"""
+Metrics reproducing the official evaluation scores (see evaluate/scorer/scorer.py) on validation,
+so that checkpoints are selected on the real metric without a separate evaluation pass.
+
+Scores are computed on label indexes with tables aligned with vocabularies, which are built once
+from the evaluation resources (taxonomy and weights), so that a batch is scored with a few gathers:
+* semclass: official scores of every (predicted label, gold label) pair are precomputed into a dense credit table
+  (the taxonomy is read with the official scorer's Taxonomy);
+* POS and feats: pos and weighted grammemes of every joint pos&feats label, so that feats are compared
+  grammeme-wise rather than with a [n_labels, n_labels] table (there are thousands of such labels);
+* lemma: lemma weights of gold pos, while lemmas themselves are compared as strings only where
+  predicted lemma rule differs from the gold one (different rules may still produce the same lemma).
+
+Gold labels unseen in training (OOV) lose the actual gold tags, so lemma, POS and feats of such tokens are scored
+with metadata of the sentences (the gold tokens) instead, just like the official scorer does, while OOV semclasses
+get zero credit. Tags missing from the weights get zero weight (the official scorer rejects them).
+"""
+
+import os
+import sys
+import json
+import logging
+import importlib
+
+from types import ModuleType
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import torch
+from torch import Tensor
+
+from conllu.parser import parse_dict_value
+
+from allennlp.data.vocabulary import Vocabulary, DEFAULT_OOV_TOKEN
+from allennlp.training.metrics import Metric
+from allennlp.nn.util import dist_reduce_sum
+
+from .lemmatize_helper import LemmaRule, predict_lemma_from_rule, normalize
+
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+EVALUATE_DIR = os.path.join(ROOT_DIR, "evaluate")
+# The same resources evaluate.py uses by default.
+DEFAULT_TAXONOMY_FILE = os.path.join(ROOT_DIR, "tagsets", "semantic_hierarchy.csv")
+DEFAULT_LEMMA_WEIGHTS_FILE = os.path.join(ROOT_DIR, "evaluate", "scorer", "weights_estimator", "weights", "lemma_weights.json")
+DEFAULT_FEATS_WEIGHTS_FILE = os.path.join(ROOT_DIR, "evaluate", "scorer", "weights_estimator", "weights", "feats_weights.json")
+
+DEFAULT_RESOURCE_FILES = {DEFAULT_TAXONOMY_FILE, DEFAULT_LEMMA_WEIGHTS_FILE, DEFAULT_FEATS_WEIGHTS_FILE}
+
+# Semclasses scored by exact match (`semclasses_out_of_taxonomy` of evaluate.py).
+SEMCLASSES_OUT_OF_TAXONOMY = {'_'}
+
+def load_weights(weights_file: str) -> Dict[str, float]:
+    with open(weights_file, 'r') as file:
+        return json.load(file)
+
+
+def parse_feats(feats: str) -> Dict[str, str]:
+    """
+    Parse feats tag (e.g. "Case=Nom|Number=Sing") into a dict, the way evaluate.py does.
+    """
+    feats = parse_dict_value(feats) if feats is not None else None
+    return feats if feats is not None else {}
+
+
+def score_feats(test_feats: Dict[str, str], gold_feats: Dict[str, str], feats_weights: Dict[str, float]) -> float:
+    """
+    Official feats score: weighted share of gold grammatical categories with correct values,
+    penalized for extra categories of test.
+    """
+    if not gold_feats:
+        return float(not test_feats)
+    gold_weight = sum(feats_weights.get(category, 0.) for category in gold_feats)
+    correct_weight = sum(
+        feats_weights.get(category, 0.)
+        for category, value in gold_feats.items()
+        if category in test_feats and test_feats[category] == value
+    )
+    penalty = 1 / (1 + max(len(test_feats) - len(gold_feats), 0))
+    return penalty * correct_weight / gold_weight if gold_weight > 0 else 0.
+
+
+def import_evaluate_module(name: str) -> ModuleType:
+    """
+    Import a module of the evaluation scripts (e.g. "scorer.taxonomy" or "evaluate").
+
+    Evaluation scripts are not a package and import each other as top-level modules (scorer, semarkup, profiler, ...),
+    so EVALUATE_DIR is put on sys.path for the import only. Top-level modules of the scripts are removed from sys.modules
+    afterwards (and the ones of the same names imported before are restored), so that they don't shadow other modules.
+    """
+    top_level_names = {os.path.splitext(file_name)[0] for file_name in os.listdir(EVALUATE_DIR)}
+
+    def is_shadowing(module_name: str) -> bool:
+        return module_name.split('.')[0] in top_level_names
+
+    shadowed_modules = {module_name: module for module_name, module in sys.modules.items() if is_shadowing(module_name)}
+    for module_name in shadowed_modules:
+        del sys.modules[module_name]
+    sys_path = list(sys.path)
+    sys.path.insert(0, EVALUATE_DIR)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path[:] = sys_path
+        for module_name in [module_name for module_name in sys.modules if is_shadowing(module_name)]:
+            del sys.modules[module_name]
+        sys.modules.update(shadowed_modules)
+
+
+def build_semclass_credit_table(semclasses: List[str], taxonomy) -> np.ndarray:
+    """
+    Return [n_labels, n_labels] table, such that table[test, gold] is the official score of test semclass
+    against gold one: 1 / (1 + distance) for semclasses of the same taxonomy tree, 0 for different trees
+    and exact match for semclasses out of taxonomy.
+    Gold semclasses missing from the taxonomy (which the official scorer rejects) are scored by exact match as well.
+
+    Distances are those of taxonomy.calc_path_length, computed for all pairs at once over the same forest
+    (taxonomy.parents and taxonomy.depths).
+    """
+    n_labels = len(semclasses)
+
+    # ancestors[i, d] = ancestor of i-th semclass at depth d (the semclass itself at its own depth), -1 if none.
+    # Paths of the same tree coincide from the root down to the lowest common ancestor, so
+    # the number of shared ancestors is the depth of the LCA plus one.
+    in_taxonomy = np.array([taxonomy.has_semclass(semclass) for semclass in semclasses], dtype=bool)
+    depths = np.zeros(n_labels, dtype=np.int64)
+    max_depth = max(taxonomy.depths, default=0)
+    ancestors = np.full((n_labels, max_depth + 1), -1, dtype=np.int64)
+    for i, semclass in enumerate(semclasses):
+        if not in_taxonomy[i]:
+            continue
+        node = taxonomy.semclass_to_idx[semclass]
+        depths[i] = taxonomy.depths[node]
+        while node != -1:
+            ancestors[i, taxonomy.depths[node]] = node
+            node = taxonomy.parents[node]
+
+    # [n_labels, n_labels]
+    n_shared_ancestors = np.zeros((n_labels, n_labels), dtype=np.int64)
+    for depth in range(max_depth + 1):
+        column = ancestors[:, depth]
+        n_shared_ancestors += (column[:, None] == column[None, :]) & (column[:, None] != -1)
+    distances = depths[:, None] + depths[None, :] - 2 * (n_shared_ancestors - 1)
+    credit = np.where(n_shared_ancestors > 0, 1 / (1 + distances), 0.)
+    credit[~in_taxonomy, :] = 0.
+
+    # Gold semclasses scored by exact match.
+    exact_match = np.array([
+        semclass in SEMCLASSES_OUT_OF_TAXONOMY or not in_taxonomy[i]
+        for i, semclass in enumerate(semclasses)
+    ], dtype=bool)
+    semclasses = np.array(semclasses, dtype=object)
+    credit[:, exact_match] = semclasses[:, None] == semclasses[None, exact_match]
+    return credit.astype(np.float32)
+
+
+class OfficialScore(Metric):
+    """
+    Base class of official scores computed with tables built from an evaluation resource file.
+
+    Tables are built on the first scored batch (so that the resources are not read at inference)
+    and moved to the device of the labels. If the resources are missing, the metric is disabled
+    (`is_enabled` is False) with a warning at construction, so that it is not mistaken for an unconfigured one.
+    """
+
+    _warned_missing_files = set()
+
+    def __init__(self, resource_file: str) -> None:
+        self.resource_file = resource_file
+        self._tables: Optional[Dict[str, Tensor]] = None
+        missing_file = self._find_missing_resource()
+        self.is_enabled = missing_file is None
+        if not self.is_enabled:
+            self._warn_missing(missing_file)
+        self.reset()
+
+    def _warn_missing(self, missing_file: str) -> None:
+        # Warn once per process, as a model may be constructed several times (e.g. when loaded from an archive).
+        if missing_file in OfficialScore._warned_missing_files:
+            return
+        OfficialScore._warned_missing_files.add(missing_file)
+        if self.resource_file in DEFAULT_RESOURCE_FILES:
+            logger.warning(
+                f"Default resource {missing_file} is not found, {type(self).__name__} is not computed. "
+                f"Set the resource file of the model explicitly (or to null to disable the score)."
+            )
+        else:
+            logger.warning(f"{missing_file} is not found, {type(self).__name__} is not computed.")
+
+    def _find_missing_resource(self) -> Optional[str]:
+        return self.resource_file if not os.path.exists(self.resource_file) else None
+
+    def _build_tables(self) -> Dict[str, np.ndarray]:
+        raise NotImplementedError
+
+    def _get_tables(self, device: torch.device) -> Optional[Dict[str, Tensor]]:
+        if not self.is_enabled:
+            return None
+        if self._tables is None:
+            self._tables = {name: torch.from_numpy(table) for name, table in self._build_tables().items()}
+        if next(iter(self._tables.values())).device != device:
+            self._tables = {name: table.to(device) for name, table in self._tables.items()}
+        return self._tables
+
+    @staticmethod
+    def _get_labels(vocab: Vocabulary, namespace: str) -> List[str]:
+        index_to_label = vocab.get_index_to_token_vocabulary(namespace)
+        return [index_to_label[index] for index in range(len(index_to_label))]
+
+    @staticmethod
+    def _get_oov_index(labels: List[str]) -> int:
+        # Label namespaces have no OOV label, unless it is added explicitly.
+        return labels.index(DEFAULT_OOV_TOKEN) if DEFAULT_OOV_TOKEN in labels else -1
+
+
+class SemclassScore(OfficialScore):
+    """
+    Official semclass score: partial credit 1 / (1 + distance) of predicted semclass to gold one in the taxonomy.
+
+    The credit table is built over `semclass_labels` vocabulary. Predicted OOV labels are scored as '_'
+    (as they are decoded), while gold OOV labels get zero credit.
+    """
+
+    def __init__(self, vocab: Vocabulary, taxonomy_file: str = DEFAULT_TAXONOMY_FILE) -> None:
+        self._semclasses = self._get_labels(vocab, "semclass_labels")
+        super().__init__(taxonomy_file)
+
+    def _find_missing_resource(self) -> Optional[str]:
+        taxonomy_module = os.path.join(EVALUATE_DIR, "scorer", "taxonomy.py")
+        if not os.path.exists(taxonomy_module):
+            return taxonomy_module
+        return super()._find_missing_resource()
+
+    def _build_tables(self) -> Dict[str, np.ndarray]:
+        # Predicted OOV labels are decoded as '_'.
+        is_oov = [semclass == DEFAULT_OOV_TOKEN for semclass in self._semclasses]
+        decoded_semclasses = ['_' if oov else semclass for oov, semclass in zip(is_oov, self._semclasses)]
+        Taxonomy = import_evaluate_module("scorer.taxonomy").Taxonomy
+        credit = build_semclass_credit_table(decoded_semclasses, Taxonomy(self.resource_file))
+        # The actual gold semclass of OOV label is unknown (it is unseen in training), so it gets zero credit.
+        credit[:, is_oov] = 0.
+        return {"credit": credit}
+
+    def __call__(self, predictions: Tensor, gold_labels: Tensor, mask: Optional[Tensor] = None) -> None:
+        """
+        predictions and gold_labels are [batch_size, seq_len] label indexes.
+        """
+        predictions, gold_labels, mask = self.detach_tensors(predictions, gold_labels, mask)
+        tables = self._get_tables(gold_labels.device)
+        if tables is None:
+            return
+        if mask is None:
+            mask = torch.ones_like(gold_labels, dtype=torch.bool)
+
+        credit = tables["credit"][predictions[mask], gold_labels[mask]]
+        self.total_credit += dist_reduce_sum(credit.sum()).item()
+        self.total_count += dist_reduce_sum(mask.sum()).item()
+
+    def get_metric(self, reset: bool = False) -> float:
+        score = self.total_credit / self.total_count if self.total_count > 0 else 0.0
+        if reset:
+            self.reset()
+        return score
+
+    def reset(self) -> None:
+        self.total_credit = 0.0
+        self.total_count = 0
+
+
+class LemmaScore(OfficialScore):
+    """
+    Official lemma score: lemma matches (ignoring case and 'ё') weighted by lemma weight of gold POS,
+    normalized by the total weight of gold tokens.
+
+    Tokens with the same predicted and gold lemma rules are correct, others are checked by comparing lemmas.
+    """
+
+    def __init__(self, vocab: Vocabulary, lemma_weights_file: str = DEFAULT_LEMMA_WEIGHTS_FILE) -> None:
+        lemma_rule_labels = self._get_labels(vocab, "lemma_rule_labels")
+        # Lemma rules parsed in advance (None for OOV, which is decoded as '_').
+        self._lemma_rules = [
+            LemmaRule.from_str(label) if label != DEFAULT_OOV_TOKEN else None
+            for label in lemma_rule_labels
+        ]
+        self._lemma_rule_oov_index = self._get_oov_index(lemma_rule_labels)
+        self._pos_feats = self._get_labels(vocab, "pos_feats_labels")
+        self._lemma_weights: Dict[str, float] = {}
+        super().__init__(lemma_weights_file)
+
+    def _build_tables(self) -> Dict[str, np.ndarray]:
+        self._lemma_weights = load_weights(self.resource_file)
+        # Weights of gold pos&feats labels (nan for OOV, whose actual pos is unknown).
+        weights = np.array([
+            self._lemma_weights.get(label.split('#')[0], 0.) if label != DEFAULT_OOV_TOKEN else np.nan
+            for label in self._pos_feats
+        ], dtype=np.float64)
+        return {"weights": weights}
+
+    def __call__(self,
+                 predictions: Tensor,
+                 gold_labels: Tensor,
+                 gold_pos_feats_labels: Tensor,
+                 mask: Tensor,
+                 metadata: List) -> None:
+        """
+        predictions and gold_labels are [batch_size, seq_len] lemma rule indexes,
+        gold_pos_feats_labels are gold pos&feats label indexes and metadata are the gold sentences.
+        """
+        predictions, gold_labels, gold_pos_feats_labels, mask = self.detach_tensors(
+            predictions, gold_labels, gold_pos_feats_labels, mask
+        )
+        tables = self._get_tables(gold_labels.device)
+        if tables is None:
+            return
+
+        # [batch_size, seq_len]
+        weights = tables["weights"][gold_pos_feats_labels]
+        is_correct = (predictions == gold_labels) & (gold_labels != self._lemma_rule_oov_index)
+        to_check = mask & (~is_correct | weights.isnan())
+        if to_check.any():
+            weights, is_correct = weights.cpu().numpy(), is_correct.cpu().numpy()
+            lemma_rule_ids = predictions.cpu().numpy()
+            for i, j in to_check.nonzero().tolist():
+                token = metadata[i][j]
+                if np.isnan(weights[i, j]):
+                    weights[i, j] = self._lemma_weights.get(token["upos"], 0.)
+                lemma_rule = self._lemma_rules[lemma_rule_ids[i, j]]
+                lemma = predict_lemma_from_rule(token["form"], lemma_rule) if lemma_rule is not None else '_'
+                is_correct[i, j] = normalize(lemma) == normalize(token["lemma"])
+            weights, is_correct = torch.from_numpy(weights).to(mask.device), torch.from_numpy(is_correct).to(mask.device)
+
+        self.total_score += dist_reduce_sum((weights * is_correct)[mask].sum()).item()
+        self.total_weight += dist_reduce_sum(weights[mask].sum()).item()
+
+    def get_metric(self, reset: bool = False) -> float:
+        score = self.total_score / self.total_weight if self.total_weight > 0 else 0.0
+        if reset:
+            self.reset()
+        return score
+
+    def reset(self) -> None:
+        self.total_score = 0.0
+        self.total_weight = 0.0
+
+
+class PosFeatsScore(OfficialScore):
+    """
+    Official POS score (exact match) and feats score (see `score_feats`) of joint pos&feats labels.
+
+    Feats of labels are represented with grammemes, i.e. (category, value) pairs, so the weight of correct categories
+    of a token is the weighted sum of grammemes shared by predicted and gold labels.
+    """
+
+    def __init__(self, vocab: Vocabulary, feats_weights_file: str = DEFAULT_FEATS_WEIGHTS_FILE) -> None:
+        self._pos_feats = self._get_labels(vocab, "pos_feats_labels")
+        self._oov_index = self._get_oov_index(self._pos_feats)
+        self._feats_weights: Dict[str, float] = {}
+        super().__init__(feats_weights_file)
+
+    def _decode(self, label: str) -> Tuple[str, Dict[str, str]]:
+        # OOV labels are decoded as '_'.
+        if label == DEFAULT_OOV_TOKEN:
+            return '_', {}
+        pos, feats = label.split('#')
+        return pos, parse_feats(feats)
+
+    def _build_tables(self) -> Dict[str, np.ndarray]:
+        self._feats_weights = load_weights(self.resource_file)
+        labels = [self._decode(label) for label in self._pos_feats]
+
+        pos_to_index = {}
+        grammeme_to_index = {}
+        for pos, feats in labels:
+            pos_to_index.setdefault(pos, len(pos_to_index))
+            for grammeme in feats.items():
+                grammeme_to_index.setdefault(grammeme, len(grammeme_to_index))
+
+        # grammemes[label, grammeme] = whether the label has the grammeme,
+        # grammeme_weights[label, grammeme] = weight of the grammeme category if so.
+        grammemes = np.zeros((len(labels), len(grammeme_to_index)), dtype=bool)
+        grammeme_weights = np.zeros((len(labels), len(grammeme_to_index)), dtype=np.float64)
+        for i, (_, feats) in enumerate(labels):
+            for category, value in feats.items():
+                grammemes[i, grammeme_to_index[category, value]] = True
+                grammeme_weights[i, grammeme_to_index[category, value]] = self._feats_weights.get(category, 0.)
+
+        return {
+            "pos": np.array([pos_to_index[pos] for pos, _ in labels], dtype=np.int64),
+            "grammemes": grammemes,
+            "grammeme_weights": grammeme_weights,
+            "n_feats": np.array([len(feats) for _, feats in labels], dtype=np.int64),
+        }
+
+    def __call__(self, predictions: Tensor, gold_labels: Tensor, mask: Tensor, metadata: List) -> None:
+        """
+        predictions and gold_labels are [batch_size, seq_len] pos&feats label indexes, metadata are the gold sentences.
+        """
+        predictions, gold_labels, mask = self.detach_tensors(predictions, gold_labels, mask)
+        tables = self._get_tables(gold_labels.device)
+        if tables is None:
+            return
+
+        # [n_tokens]
+        test, gold = predictions[mask], gold_labels[mask]
+        pos_scores = (tables["pos"][test] == tables["pos"][gold]).double()
+
+        # [n_tokens, n_grammemes]
+        gold_weights = tables["grammeme_weights"][gold]
+        correct_weight = (gold_weights * tables["grammemes"][test]).sum(-1)
+        gold_weight = gold_weights.sum(-1)
+        test_n_feats, gold_n_feats = tables["n_feats"][test], tables["n_feats"][gold]
+        penalty = 1 / (1 + (test_n_feats - gold_n_feats).clamp(min=0))
+        feats_scores = torch.where(
+            gold_n_feats == 0,
+            (test_n_feats == 0).double(),
+            penalty * correct_weight / gold_weight.clamp(min=1e-12)
+        )
+
+        # Tokens with OOV gold labels are scored with the gold tokens.
+        # Masked tokens are ordered the same way as their (i, j) positions.
+        is_oov = gold == self._oov_index
+        if is_oov.any():
+            pos_scores, feats_scores = pos_scores.cpu().numpy(), feats_scores.cpu().numpy()
+            oov_indexes = is_oov.nonzero().flatten().tolist()
+            oov_positions = (mask & (gold_labels == self._oov_index)).nonzero().tolist()
+            test_labels = test.cpu().numpy()
+            for k, (i, j) in zip(oov_indexes, oov_positions):
+                token = metadata[i][j]
+                test_pos, test_feats = self._decode(self._pos_feats[test_labels[k]])
+                pos_scores[k] = test_pos == token["upos"]
+                feats_scores[k] = score_feats(test_feats, parse_feats(token["feats"]), self._feats_weights)
+            pos_scores, feats_scores = torch.from_numpy(pos_scores), torch.from_numpy(feats_scores)
+
+        self.total_pos_score += dist_reduce_sum(pos_scores.sum()).item()
+        self.total_feats_score += dist_reduce_sum(feats_scores.sum()).item()
+        self.total_count += dist_reduce_sum(mask.sum()).item()
+
+    def get_metric(self, reset: bool = False) -> Dict[str, float]:
+        scores = {
+            "POS": self.total_pos_score / self.total_count if self.total_count > 0 else 0.0,
+            "Feats": self.total_feats_score / self.total_count if self.total_count > 0 else 0.0,
+        }
+        if reset:
+            self.reset()
+        return scores
+
+    def reset(self) -> None:
+        self.total_pos_score = 0.0
+        self.total_feats_score = 0.0
+        self.total_count = 0
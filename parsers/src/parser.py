@@ -1,12 +1,15 @@
 from overrides import override
 
-from typing import Dict
+from typing import Any, Callable, Dict, List
+from collections import OrderedDict
 
 import numpy as np
+import torch
 from torch import Tensor
 
 from allennlp.nn.util import get_text_field_mask
 from allennlp.common import Lazy
+from allennlp.common.checks import ConfigurationError
 from allennlp.data import TextFieldTensors
 from allennlp.data.vocabulary import Vocabulary, DEFAULT_OOV_TOKEN
 from allennlp.models import Model
@@ -15,6 +18,17 @@ from allennlp.modules.token_embedders.token_embedder import TokenEmbedder
 from .feedforward_classifier import FeedForwardClassifier, LemmaClassifier
 from .dependency_classifier import DependencyClassifier
 from .lemmatize_helper import LemmaRule, predict_lemma_from_rule
+from .quantization import quantize_model
+from .embedding_cache import EmbeddingCache
+from .fused_projection import FusedProjections
+from .official_metrics import (
+    LemmaScore,
+    PosFeatsScore,
+    SemclassScore,
+    DEFAULT_LEMMA_WEIGHTS_FILE,
+    DEFAULT_FEATS_WEIGHTS_FILE,
+    DEFAULT_TAXONOMY_FILE
+)
 
 
 @Model.register('morpho_syntax_semantic_parser')
@@ -22,6 +36,19 @@ class MorphoSyntaxSemanticParser(Model):
     """
     Joint Morpho-Syntax-Semantic Parser.
     See https://guide.allennlp.org/your-first-model for guidance.
+
+    If quantize is set, Linear layers are replaced with int8 dynamically quantized ones
+    (see quantization.py). Such a model is for CPU inference only and can't be trained.
+
+    If embedding_cache directory is set, embeddings of sentences are cached there while the embedder is frozen
+    (no embedder parameter requires grad), so that they are computed once (see embedding_cache.py).
+
+    If fuse_projections is set, input projections of all classifiers are computed with a single matmul
+    at inference (see fused_projection.py). Predictions are the same, while small batches are processed faster.
+
+    Official scores of evaluate.py are reported along with accuracies (see official_metrics.py):
+    lemma score if lemma_weights_file is set, POS and feats scores if feats_weights_file is set and
+    semclass score (partial credit for semclasses close to gold ones in the taxonomy) if taxonomy_file is set.
     """
 
     # See https://guide.allennlp.org/using-config-files to find more about Lazy.
@@ -34,7 +61,13 @@ class MorphoSyntaxSemanticParser(Model):
                  pos_feats_classifier: Lazy[FeedForwardClassifier],
                  depencency_classifier: Lazy[DependencyClassifier],
                  semslot_classifier: Lazy[FeedForwardClassifier],
-                 semclass_classifier: Lazy[FeedForwardClassifier]):
+                 semclass_classifier: Lazy[FeedForwardClassifier],
+                 quantize: bool = False,
+                 embedding_cache: str = None,
+                 fuse_projections: bool = True,
+                 lemma_weights_file: str = DEFAULT_LEMMA_WEIGHTS_FILE,
+                 feats_weights_file: str = DEFAULT_FEATS_WEIGHTS_FILE,
+                 taxonomy_file: str = DEFAULT_TAXONOMY_FILE):
         super().__init__(vocab)
 
         self.embedder = embedder
@@ -61,6 +94,40 @@ class MorphoSyntaxSemanticParser(Model):
             n_classes=vocab.get_vocab_size("semclass_labels"),
         )
 
+        self._build_decoding_tables()
+
+        self.lemma_score = LemmaScore(vocab, lemma_weights_file) if lemma_weights_file is not None else None
+        self.pos_feats_score = PosFeatsScore(vocab, feats_weights_file) if feats_weights_file is not None else None
+        self.semclass_score = SemclassScore(vocab, taxonomy_file) if taxonomy_file is not None else None
+
+        self.embedding_cache = EmbeddingCache(embedding_cache) if embedding_cache is not None else None
+
+        self.quantize = quantize
+        if self.quantize:
+            quantize_model(self)
+
+        # Quantized projections are not fused.
+        classifiers = self._get_classifiers()
+        if fuse_projections and FusedProjections.can_fuse(classifiers):
+            self.fused_projections = FusedProjections(classifiers)
+        else:
+            self.fused_projections = None
+
+    @override(check_signature=False)
+    def load_state_dict(self, state_dict: Dict[str, Any], *args, **kwargs):
+        if self.quantize and getattr(state_dict, "_metadata", None) is None:
+            # Quantized layers read their weights according to their versions stored in state dict metadata,
+            # which is lost when allennlp reads the state dict from an archive, so restore it.
+            state_dict = OrderedDict(state_dict)
+            state_dict._metadata = self.state_dict()._metadata
+        return super().load_state_dict(state_dict, *args, **kwargs)
+
+    @override
+    def train(self, mode: bool = True) -> "MorphoSyntaxSemanticParser":
+        if mode and self.quantize:
+            raise ConfigurationError("Quantized model can't be trained.")
+        return super().train(mode)
+
     @override(check_signature=False)
     def forward(self,
                 words: TextFieldTensors,
@@ -74,15 +141,26 @@ class MorphoSyntaxSemanticParser(Model):
                 ) -> Dict[str, Tensor]:
 
         # [batch_size, seq_len, embedding_dim]
-        embeddings = self.embedder(**words['tokens'])
+        embeddings = self.embed(words, metadata)
         # [batch_size, seq_len]
         mask = get_text_field_mask(words)
 
-        lemma_rule = self.lemma_rule_classifier(embeddings, lemma_rule_labels, mask, metadata)
-        pos_feats = self.pos_feats_classifier(embeddings, pos_feats_labels, mask)
-        syntax = self.dependency_classifier(embeddings, head_labels, deprel_labels, mask)
-        semslot = self.semslot_classifier(embeddings, semslot_labels, mask)
-        semclass = self.semclass_classifier(embeddings, semclass_labels, mask)
+        projections = self.project(embeddings)
+
+        lemma_rule = self.lemma_rule_classifier(embeddings, lemma_rule_labels, mask, metadata, projections.get('lemma_rule'))
+        pos_feats = self.pos_feats_classifier(embeddings, pos_feats_labels, mask, projections.get('pos_feats'))
+        syntax = self.dependency_classifier(embeddings, head_labels, deprel_labels, mask, projections.get('dependency'))
+        semslot = self.semslot_classifier(embeddings, semslot_labels, mask, projections.get('semslot'))
+        semclass = self.semclass_classifier(embeddings, semclass_labels, mask, projections.get('semclass'))
+
+        # Official scores are computed in evaluation only (e.g. on validation), as lemmas are compared as strings.
+        if not self.training:
+            if lemma_rule_labels is not None and pos_feats_labels is not None and self.lemma_score is not None:
+                self.lemma_score(lemma_rule['preds'], lemma_rule_labels, pos_feats_labels, mask, metadata)
+            if pos_feats_labels is not None and self.pos_feats_score is not None:
+                self.pos_feats_score(pos_feats['preds'], pos_feats_labels, mask, metadata)
+            if semclass_labels is not None and self.semclass_score is not None:
+                self.semclass_score(semclass['preds'], semclass_labels, mask)
 
         loss = lemma_rule['loss'] + \
                pos_feats['loss'] + \
@@ -102,6 +180,34 @@ class MorphoSyntaxSemanticParser(Model):
             'metadata': metadata,
         }
 
+    def embed(self, words: TextFieldTensors, metadata: List = None) -> Tensor:
+        if self.embedding_cache is None or metadata is None:
+            return self.embedder(**words['tokens'])
+        if any(parameter.requires_grad for parameter in self.embedder.parameters()):
+            # Embedder is being trained, so its weights (and the store they key) are about to change.
+            self.embedding_cache.reset()
+            return self.embedder(**words['tokens'])
+        sentences_words = [[token["form"] for token in sentence if token["form"] is not None] for sentence in metadata]
+        return self.embedding_cache.embed(self.embedder, words['tokens'], sentences_words)
+
+    def project(self, embeddings: Tensor) -> Dict[str, Dict[str, Tensor]]:
+        """
+        Compute activated input projections of all classifiers at once (at inference only, as fused weights are not trained).
+        Return empty dict if projections are computed by classifiers themselves.
+        """
+        if self.fused_projections is None or self.training or torch.is_grad_enabled():
+            return {}
+        return self.fused_projections(embeddings)
+
+    def _get_classifiers(self) -> Dict[str, Model]:
+        return {
+            'lemma_rule': self.lemma_rule_classifier,
+            'pos_feats': self.pos_feats_classifier,
+            'dependency': self.dependency_classifier,
+            'semslot': self.semslot_classifier,
+            'semclass': self.semclass_classifier,
+        }
+
     @override
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         # Morphology.
@@ -124,7 +230,7 @@ class MorphoSyntaxSemanticParser(Model):
             semclass_accuracy
         ])
 
-        return {
+        metrics = {
             'Lemma': lemma_accuracy,
             'PosFeats': pos_feats_accuracy,
             'UAS': uas,
@@ -133,92 +239,120 @@ class MorphoSyntaxSemanticParser(Model):
             'SC': semclass_accuracy,
             'Avg': mean_accuracy,
         }
+        # Official scores (evaluation only).
+        if self.training:
+            return metrics
+        if self.lemma_score is not None and self.lemma_score.is_enabled:
+            metrics['LemmaScore'] = self.lemma_score.get_metric(reset)
+        if self.pos_feats_score is not None and self.pos_feats_score.is_enabled:
+            pos_feats_scores = self.pos_feats_score.get_metric(reset)
+            metrics['POSScore'] = pos_feats_scores['POS']
+            metrics['FeatsScore'] = pos_feats_scores['Feats']
+        if self.semclass_score is not None and self.semclass_score.is_enabled:
+            metrics['SCScore'] = self.semclass_score.get_metric(reset)
+        # The total score of evaluate.py (its head and deprel scores are UAS and LAS).
+        total_score_names = ['LemmaScore', 'POSScore', 'FeatsScore', 'UAS', 'LAS', 'SS', 'SCScore']
+        if all(name in metrics for name in total_score_names):
+            metrics['TotalScore'] = np.mean([metrics[name] for name in total_score_names])
+        return metrics
 
     @override(check_signature=False)
     def make_output_human_readable(self, output: Dict[str, Tensor]) -> Dict[str, list]:
         sentences = output["metadata"]
-        # Make sure batch_size is 1 during prediction.
-        assert len(sentences) == 1
-        sentence = sentences[0]
-        metadata = sentence.metadata
-
-        # Restore ids.
-        ids = []
-        for token in sentence:
-            ids.append(token["id"])
-
-        # Restore forms.
-        forms = []
-        for token in sentence:
-            forms.append(token["form"])
-
-        # Restore lemmas.
-        lemmas = []
-        lemma_rule_preds = output["lemma_rule_preds"].tolist()[0]
-        for token, lemma_rule_pred in zip(sentence, lemma_rule_preds):
-            word = token["form"]
-            lemma_rule_str = self.vocab.get_token_from_index(lemma_rule_pred, "lemma_rule_labels")
-            if lemma_rule_str == DEFAULT_OOV_TOKEN:
-                lemma = '_'
-            else:
-                lemma_rule = LemmaRule.from_str(lemma_rule_str)
-                lemma = predict_lemma_from_rule(word, lemma_rule)
-            lemmas.append(lemma)
-
-        # Restore "glued" pos and feats tags.
-        pos_tags = []
-        feats_tags = []
-        pos_feats_preds = output["pos_feats_preds"].tolist()[0]
-        for pos_feats_pred in pos_feats_preds:
-            pos_feats_str = self.vocab.get_token_from_index(pos_feats_pred, "pos_feats_labels")
-            if pos_feats_str == DEFAULT_OOV_TOKEN:
-                pos_tag, feats_tag = '_', '_'
-            else:
-                pos_tag, feats_tag = pos_feats_str.split('#')
-            pos_tags.append(pos_tag)
-            feats_tags.append(feats_tag)
-
-        # Restore heads.
-        # Heads are integers, so simply convert them to strings.
-        heads = list(map(str, output["head_preds"].tolist()[0]))
-
-        # Restore deprels.
-        deprels = []
-        deprel_preds = output["deprel_preds"].tolist()[0]
-        for deprel_pred in deprel_preds:
-            deprel = self.vocab.get_token_from_index(deprel_pred, "deprel_labels")
-            if deprel == DEFAULT_OOV_TOKEN:
-                deprel = '_'
-            deprels.append(deprel)
-
-        # Restore semslots.
-        semslots = []
-        semslot_preds = output["semslot_preds"].tolist()[0]
-        for semslot_pred in semslot_preds:
-            semslot = self.vocab.get_token_from_index(semslot_pred, "semslot_labels")
-            if semslot == DEFAULT_OOV_TOKEN:
-                semslots = '_'
-            semslots.append(semslot)
-
-        # Restore semclasses.
-        semclasses = []
-        semclass_preds = output["semclass_preds"].tolist()[0]
-        for semclass_pred in semclass_preds:
-            semclass = self.vocab.get_token_from_index(semclass_pred, "semclass_labels")
-            if semclass == DEFAULT_OOV_TOKEN:
-                semclasss = '_'
-            semclasses.append(semclass)
+
+        # Decode whole batch at once with decoding tables.
+        # [batch_size, seq_len]
+        lemma_rules = self.lemma_rule_table[output["lemma_rule_preds"].cpu().numpy()]
+        pos_feats_preds = output["pos_feats_preds"].cpu().numpy()
+        pos_tags = self.pos_table[pos_feats_preds]
+        feats_tags = self.feats_table[pos_feats_preds]
+        heads = output["head_preds"].cpu().numpy()
+        deprels = self.deprel_table[output["deprel_preds"].cpu().numpy()]
+        semslots = self.semslot_table[output["semslot_preds"].cpu().numpy()]
+        semclasses = self.semclass_table[output["semclass_preds"].cpu().numpy()]
+
+        metadatas = []
+        ids_batch = []
+        forms_batch = []
+        lemmas_batch = []
+        pos_tags_batch = []
+        feats_tags_batch = []
+        heads_batch = []
+        deprels_batch = []
+        semslots_batch = []
+        semclasses_batch = []
+
+        for i, sentence in enumerate(sentences):
+            # Sentences are padded to the longest one in a batch, so cut predictions to the sentence length.
+            length = len(sentence)
+            metadatas.append(sentence.metadata)
+
+            # Restore ids.
+            ids_batch.append([token["id"] for token in sentence])
+
+            # Restore forms.
+            forms = [token["form"] for token in sentence]
+            forms_batch.append(forms)
+
+            # Restore lemmas.
+            lemmas_batch.append([
+                predict_lemma_from_rule(word, lemma_rule) if lemma_rule is not None else '_'
+                for word, lemma_rule in zip(forms, lemma_rules[i, :length])
+            ])
+
+            # Restore "glued" pos and feats tags.
+            pos_tags_batch.append(pos_tags[i, :length].tolist())
+            feats_tags_batch.append(feats_tags[i, :length].tolist())
+
+            # Restore heads.
+            # Heads are integers, so simply convert them to strings.
+            heads_batch.append(list(map(str, heads[i, :length].tolist())))
+
+            # Restore deprels, semslots and semclasses.
+            deprels_batch.append(deprels[i, :length].tolist())
+            semslots_batch.append(semslots[i, :length].tolist())
+            semclasses_batch.append(semclasses[i, :length].tolist())
 
         return {
-            "metadata": [metadata],
-            "ids": [ids],
-            "forms": [forms],
-            "lemmas": [lemmas],
-            "pos": [pos_tags],
-            "feats": [feats_tags],
-            "heads": [heads],
-            "deprels": [deprels],
-            "semslots": [semslots],
-            "semclasses": [semclasses],
+            "metadata": metadatas,
+            "ids": ids_batch,
+            "forms": forms_batch,
+            "lemmas": lemmas_batch,
+            "pos": pos_tags_batch,
+            "feats": feats_tags_batch,
+            "heads": heads_batch,
+            "deprels": deprels_batch,
+            "semslots": semslots_batch,
+            "semclasses": semclasses_batch,
         }
 
+    def _build_decoding_tables(self) -> None:
+        """
+        Build decoding tables aligned with vocabulary indexes, so that predictions are decoded with
+        array lookups rather than per-token vocabulary queries and string parsing.
+        Unknown (OOV) labels are decoded as '_' (lemma rule table holds None for them).
+        """
+        # Lemma rules are parsed beforehand.
+        self.lemma_rule_table = self._build_decoding_table("lemma_rule_labels", LemmaRule.from_str, oov_value=None)
+        # "Glued" pos and feats tags are split beforehand.
+        self.pos_table = self._build_decoding_table("pos_feats_labels", lambda label: label.split('#')[0])
+        self.feats_table = self._build_decoding_table("pos_feats_labels", lambda label: label.split('#')[1])
+        self.deprel_table = self._build_decoding_table("deprel_labels")
+        self.semslot_table = self._build_decoding_table("semslot_labels")
+        self.semclass_table = self._build_decoding_table("semclass_labels")
+
+    def _build_decoding_table(self,
+                              namespace: str,
+                              decode: Callable[[str], Any] = None,
+                              oov_value: Any = '_') -> np.ndarray:
+        """
+        Return object array, such that array[label_index] = decode(label).
+        """
+        index_to_label = self.vocab.get_index_to_token_vocabulary(namespace)
+        table = np.empty(len(index_to_label), dtype=object)
+        for index, label in index_to_label.items():
+            if label == DEFAULT_OOV_TOKEN:
+                table[index] = oov_value
+            else:
+                table[index] = decode(label) if decode is not None else label
+        return table
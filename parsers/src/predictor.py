@@ -1,51 +1,74 @@
-from conllu.models import Token, TokenList
-
 from overrides import override
-from typing import Dict
+from typing import Dict, List
+
+import torch
 
 from allennlp.predictors.predictor import Predictor
-from allennlp.common.util import JsonDict
-from allennlp.data import Instance
+from allennlp.common.util import JsonDict, sanitize
+from allennlp.data import Batch, Instance, DatasetReader
+from allennlp.models import Model
+from allennlp.nn.util import move_to_device
+
+from .serialization import serialize_prediction
 
 
 @Predictor.register("morpho_syntax_semantic_predictor")
 class MorphoSyntaxSemanticPredictor(Predictor):
     """
     See https://guide.allennlp.org/training-and-prediction#4 for guidance.
+
+    Batches (see `--batch-size` option of `allennlp predict`) are sorted by sentence length
+    and split into sub-batches of at most `max_batch_size` sentences, so that short sentences
+    are not padded to the longest one. Predictions are returned in the original order.
     """
 
+    def __init__(self, model: Model, dataset_reader: DatasetReader, frozen: bool = True, max_batch_size: int = 32):
+        super().__init__(model, dataset_reader, frozen)
+        assert max_batch_size >= 1
+        self.max_batch_size = max_batch_size
+
+    @override
+    def predict_batch_instance(self, instances: List[Instance]) -> List[JsonDict]:
+        return sanitize(self.predict_batch_instance_raw(instances))
+
+    def predict_batch_instance_raw(self, instances: List[Instance]) -> List[Dict[str, list]]:
+        """
+        Same as predict_batch_instance, but outputs are not sanitized,
+        which is not needed for serialization with dump_line.
+        """
+        for instance in instances:
+            self._dataset_reader.apply_token_indexers(instance)
+
+        # Group sentences of similar length together.
+        order = sorted(range(len(instances)), key=lambda index: len(instances[index]["words"]))
+
+        outputs = [None] * len(instances)
+        for start in range(0, len(order), self.max_batch_size):
+            batch_order = order[start:start + self.max_batch_size]
+            batch_outputs = self._forward_on_instances([instances[index] for index in batch_order])
+            # Restore the original order.
+            for index, output in zip(batch_order, batch_outputs):
+                outputs[index] = output
+
+        return outputs
+
+    def _forward_on_instances(self, instances: List[Instance]) -> List[Dict[str, list]]:
+        """
+        Same as Model.forward_on_instances, but metadata (i.e. sentences) is not traversed
+        token by token when moving the batch to device, as it contains no tensors.
+        """
+        with torch.no_grad():
+            cuda_device = self._model._get_prediction_device()
+            batch = Batch(instances)
+            batch.index_instances(self._model.vocab)
+            model_input = batch.as_tensor_dict()
+            metadata = model_input.pop("metadata", None)
+            model_input = move_to_device(model_input, cuda_device)
+            outputs = self._model.make_output_human_readable(self._model(**model_input, metadata=metadata))
+
+        # All the outputs are lists of per-sentence values, so split them into per-sentence dicts.
+        return [dict(zip(outputs.keys(), values)) for values in zip(*outputs.values())]
+
     @override(check_signature=False)
     def dump_line(self, output: Dict[str, list]) -> str:
-        metadata = output["metadata"]
-
-        tags_iterator = zip(
-            output["ids"],
-            output["forms"],
-            output["lemmas"],
-            output["pos"],
-            output["feats"],
-            output["heads"],
-            output["deprels"],
-            output["semslots"],
-            output["semclasses"],
-        )
-
-        tokens = []
-        for tok_id, form, lemma, pos, feats, head, deprel, semslot, semclass in tags_iterator:
-            token = Token()
-            token["id"] = tok_id
-            token["form"] = form
-            token["lemma"] = lemma
-            token["upos"] = pos
-            token["xpos"] = '_'
-            token["feats"] = feats
-            token["head"] = head
-            token["deprel"] = deprel
-            token["semslot"] = semslot
-            token["semclass"] = semclass
-            tokens.append(token)
-
-        sentence = TokenList(tokens, metadata)
-        serialized_sentence = sentence.serialize()
-        return serialized_sentence
-
+        return serialize_prediction(output)
@@ -0,0 +1,233 @@
+"""
+Training profiler: a trainer callback that measures where training time goes.
+
+For training and validation of each epoch, it records
+* throughput (tokens per second),
+* data loading wait (time between batches the model doesn't run),
+* forward time of the embedder and each classifier, and tree decoding time,
+* backward time of the embedder and each classifier (training only),
+* peak memory (allocated GPU memory, or resident memory of the process on CPU),
+and writes them into tensorboard logs (`log/profile` of the serialization directory) and `profile.json`.
+
+Add it to "callbacks" of a trainer in a config:
+    { "type": "training_profiler" }
+"""
+
+import os
+import json
+import time
+import resource
+from collections import defaultdict
+
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from torch import nn
+from tensorboardX import SummaryWriter
+
+from allennlp.data import TensorDict
+from allennlp.nn.util import get_text_field_mask
+from allennlp.training.callbacks.callback import TrainerCallback
+
+
+PROFILE_FILE_NAME = "profile.json"
+
+
+@TrainerCallback.register("training_profiler")
+class TrainingProfiler(TrainerCallback):
+    """
+    Trainer callback measuring throughput, time of model parts and peak memory (see the module docstring).
+
+    Forward time is measured with forward hooks of the model parts. Backward runs the model parts one after another
+    (in the reverse order), so the time between consecutive gradients of parameters is attributed to the part
+    the later parameter belongs to. Parameters are hooked once they are trainable: schedulers with gradual unfreezing
+    (e.g. slanted_triangular) freeze the embedder before training starts and unfreeze it between epochs,
+    so newly trainable parameters are hooked at the start of every training epoch. Parts that stay frozen
+    have no gradients, so their backward time is zero.
+    On GPU, every measurement synchronizes the device, which slows training down a bit.
+    """
+
+    def __init__(self, serialization_dir: str) -> None:
+        super().__init__(serialization_dir)
+        self._writer: Optional[SummaryWriter] = None
+        self._cuda = False
+        self._hooks = []
+        self._parts: Dict[str, nn.Module] = {}
+        # Ids of parameters with gradient hooks.
+        self._hooked_parameters = set()
+        self._decode = None
+        self._epochs: List[Dict[str, Any]] = []
+        self._reset()
+
+    def _reset(self) -> None:
+        # Phase ("training" or "validation") -> measure name -> value.
+        self._stats = defaultdict(lambda: defaultdict(float))
+        self._phase = None
+        self._last_event = self._now()
+        self._batch_forward_start = None
+        self._part_starts: Dict[str, float] = {}
+        self._last_grad = None
+
+    def _now(self) -> float:
+        if self._cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def on_start(self, trainer, is_primary: bool = True, **kwargs) -> None:
+        super().on_start(trainer, is_primary, **kwargs)
+        if not is_primary:
+            return
+        model = trainer.model
+        self._cuda = next(model.parameters()).is_cuda
+        self._writer = SummaryWriter(os.path.join(self.serialization_dir, "log", "profile"))
+
+        self._hooks.append(model.register_forward_pre_hook(self._on_model_forward))
+        self._parts = self._get_parts(model)
+        for name, part in self._parts.items():
+            self._hooks.append(part.register_forward_pre_hook(self._part_forward_pre_hook(name)))
+            self._hooks.append(part.register_forward_hook(self._part_forward_hook(name)))
+        self._hook_trainable_parameters()
+
+        # Tree decoding is a method rather than a module, so it is wrapped.
+        dependency_classifier = model.dependency_classifier
+        self._decode = dependency_classifier.decode
+        dependency_classifier.decode = self._timed("decode", self._decode)
+        self._reset()
+
+    @staticmethod
+    def _get_parts(model: nn.Module) -> Dict[str, nn.Module]:
+        return {
+            "embedder": model.embedder,
+            "lemma_rule_classifier": model.lemma_rule_classifier,
+            "pos_feats_classifier": model.pos_feats_classifier,
+            "dependency_classifier": model.dependency_classifier,
+            "semslot_classifier": model.semslot_classifier,
+            "semclass_classifier": model.semclass_classifier,
+        }
+
+    def _hook_trainable_parameters(self) -> None:
+        for name, part in self._parts.items():
+            for parameter in part.parameters():
+                if parameter.requires_grad and id(parameter) not in self._hooked_parameters:
+                    self._hooks.append(parameter.register_hook(self._grad_hook(name)))
+                    self._hooked_parameters.add(id(parameter))
+
+    def _on_model_forward(self, model: nn.Module, inputs) -> None:
+        phase = "training" if model.training else "validation"
+        if phase != self._phase:
+            self._phase = phase
+            if phase == "training":
+                # Some parameters may have been unfrozen since the previous epoch.
+                self._hook_trainable_parameters()
+            if self._cuda:
+                torch.cuda.reset_peak_memory_stats()
+        # With gradient accumulation a batch is made of several forward passes, the first one ends data loading.
+        if self._batch_forward_start is None:
+            self._batch_forward_start = self._now()
+            self._stats[phase]["data_wait"] += self._batch_forward_start - self._last_event
+
+    def _part_forward_pre_hook(self, name: str) -> Callable:
+        def hook(module: nn.Module, inputs) -> None:
+            self._part_starts[name] = self._now()
+        return hook
+
+    def _part_forward_hook(self, name: str) -> Callable:
+        def hook(module: nn.Module, inputs, outputs) -> None:
+            self._stats[self._phase][f"forward/{name}"] += self._now() - self._part_starts[name]
+        return hook
+
+    def _grad_hook(self, name: str) -> Callable:
+        def hook(grad: torch.Tensor) -> None:
+            now = self._now()
+            if self._last_grad is not None:
+                self._stats["training"][f"backward/{name}"] += now - self._last_grad
+            self._last_grad = now
+        return hook
+
+    def _timed(self, name: str, function: Callable) -> Callable:
+        def timed_function(*args, **kwargs):
+            start = self._now()
+            result = function(*args, **kwargs)
+            self._stats[self._phase][name] += self._now() - start
+            return result
+        return timed_function
+
+    def on_backward(self, trainer, batch_outputs: Dict[str, torch.Tensor], backward_called: bool, **kwargs) -> bool:
+        # Backward is called by the trainer right after this, so the time before the first gradient
+        # is attributed to the first part that gets gradients (the losses are computed by the classifiers).
+        self._last_grad = self._now()
+        return False
+
+    def on_batch(self,
+                 trainer,
+                 batch_inputs: List[TensorDict],
+                 batch_outputs: List[Dict[str, Any]],
+                 batch_metrics: Dict[str, Any],
+                 epoch: int,
+                 batch_number: int,
+                 is_training: bool,
+                 is_primary: bool = True,
+                 batch_grad_norm: Optional[float] = None,
+                 **kwargs) -> None:
+        if not is_primary:
+            return
+        now = self._now()
+        stats = self._stats["training" if is_training else "validation"]
+        stats["duration"] += now - self._last_event
+        stats["tokens"] += sum(get_text_field_mask(batch["words"]).sum().item() for batch in batch_inputs)
+        stats["batches"] += 1
+        if self._cuda:
+            stats["peak_memory_mb"] = max(stats["peak_memory_mb"], torch.cuda.max_memory_allocated() / 2**20)
+        else:
+            # ru_maxrss is in kilobytes on Linux.
+            stats["peak_memory_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+        self._last_event = self._now()
+        self._batch_forward_start = None
+
+    def on_epoch(self, trainer, metrics: Dict[str, Any], epoch: int, is_primary: bool = True, **kwargs) -> None:
+        if not is_primary:
+            return
+        epoch_profile = {"epoch": epoch}
+        for phase, stats in self._stats.items():
+            stats = dict(stats)
+            if stats.get("duration"):
+                stats["tokens_per_second"] = stats["tokens"] / stats["duration"]
+            epoch_profile[phase] = stats
+            for name, value in stats.items():
+                self._writer.add_scalar(f"{phase}/{name}", value, epoch)
+        self._writer.flush()
+        self._epochs.append(epoch_profile)
+        self._write_summary()
+        self._reset()
+
+    def on_end(self, trainer, metrics: Dict[str, Any] = None, epoch: int = None, is_primary: bool = True, **kwargs) -> None:
+        if not is_primary:
+            return
+        for hook in self._hooks:
+            hook.remove()
+        self._hooks = []
+        self._hooked_parameters = set()
+        if self._decode is not None:
+            # Remove the wrapper, so that the trained model is saved and used as is.
+            del trainer.model.dependency_classifier.decode
+            self._decode = None
+        self._writer.close()
+
+    def _write_summary(self) -> None:
+        # Totals over all the epochs so far, so that configs are compared at a glance.
+        total = defaultdict(lambda: defaultdict(float))
+        for epoch_profile in self._epochs:
+            for phase, stats in epoch_profile.items():
+                if phase == "epoch":
+                    continue
+                for name, value in stats.items():
+                    if name == "peak_memory_mb":
+                        total[phase][name] = max(total[phase][name], value)
+                    elif name != "tokens_per_second":
+                        total[phase][name] += value
+        for stats in total.values():
+            if stats.get("duration"):
+                stats["tokens_per_second"] = stats["tokens"] / stats["duration"]
+
+        with open(os.path.join(self.serialization_dir, PROFILE_FILE_NAME), "w") as file:
+            json.dump({"total": total, "epochs": self._epochs}, file, indent=2)
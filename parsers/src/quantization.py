@@ -0,0 +1,74 @@
+"""
+Int8 dynamic quantization of trained models for CPU inference.
+
+Weights of all Linear layers (transformer embedder and classifiers) are converted to int8,
+while activations are quantized on the fly, so no calibration data is needed.
+
+Usage:
+    python -m src.quantization serialization_dir/model.tar.gz serialization_dir/model-int8.tar.gz
+exports a quantized copy of the model archive. It is used like any other archive (e.g. with `allennlp predict`),
+its config has `"quantize": true` set for the model.
+"""
+
+import os
+import argparse
+import tempfile
+
+import torch
+from torch import nn
+
+from allennlp.common import Params
+from allennlp.common.meta import Meta, META_NAME
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive, archive_model, CONFIG_NAME, _DEFAULT_WEIGHTS
+
+
+def quantize_model(model: nn.Module) -> nn.Module:
+    """
+    Replace Linear layers of the model with dynamically quantized (int8) ones, in place.
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def export_quantized_archive(archive_file: str, output_file: str) -> None:
+    """
+    Quantize the model of archive_file and save it into output_file archive.
+    Int8 weights are saved, so the archive is smaller as well.
+    """
+    archive = load_archive(archive_file)
+    model = archive.model
+    quantize_model(model)
+
+    config = Params(archive.config.as_dict(quiet=True))
+    # Model with "quantize" set is quantized right after construction, so that int8 weights can be loaded into it.
+    config.params["model"]["quantize"] = True
+
+    with tempfile.TemporaryDirectory() as serialization_dir:
+        config.to_file(os.path.join(serialization_dir, CONFIG_NAME))
+        Meta.new().to_file(os.path.join(serialization_dir, META_NAME))
+        model.vocab.save_to_files(os.path.join(serialization_dir, "vocabulary"))
+        torch.save(model.state_dict(), os.path.join(serialization_dir, _DEFAULT_WEIGHTS))
+        archive_model(serialization_dir, archive_path=output_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Export int8 dynamically quantized copy of a model archive.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'model_file',
+        type=str,
+        help='Model archive (model.tar.gz).'
+    )
+    parser.add_argument(
+        'output_file',
+        type=str,
+        help='Quantized model archive to be produced.'
+    )
+    args = parser.parse_args()
+
+    # Register all the models of the package.
+    import_module_and_submodules(__package__)
+    export_quantized_archive(args.model_file, args.output_file)
+    print(f"Quantized model is saved to {args.output_file}.")
@@ -0,0 +1,340 @@
+"""
+Standalone runtime: label SEMarkup files with a model bundle (see export.py) without allennlp.
+
+The runtime depends on torch, numpy and conllu only (and transformers' tokenizers for transformer-based models),
+so it starts faster and takes less memory than `allennlp predict`. Predictions are the same as the ones
+of the original model (given the same device and torch version).
+
+Usage:
+    python -m src.runtime serialization_dir/bundle test.conllu predictions.conllu
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import torch
+from torch import Tensor
+
+from conllu.models import TokenList
+
+from .serialization import OUTPUT_BUFFER_SIZE, batched, read_sentences, serialize_prediction
+from .tree_decoding import decode_mst_batch, decode_eisner_batch
+from .lemmatize_helper import LemmaRule, predict_lemma_from_rule, normalize, is_correctable
+from .lemma_dictionary import LemmaDictionary
+
+
+# The same values as in export.py, which can't be imported without allennlp.
+BUNDLE_VERSION = 1
+BUNDLE_CONFIG_NAME = "bundle.json"
+ENCODER_NAME = "encoder.pt"
+REL_SCORER_NAME = "rel_scorer.pt"
+
+
+def _pad(sequences: List[list], padding_value, dtype: torch.dtype) -> Tensor:
+    length = max(map(len, sequences))
+    return torch.tensor([sequence + [padding_value] * (length - len(sequence)) for sequence in sequences], dtype=dtype)
+
+
+class SingleIdIndexer:
+    """
+    Counterpart of allennlp SingleIdTokenIndexer.
+    """
+
+    def __init__(self, config: Dict, bundle_dir: str):
+        self.lowercase_tokens = config["lowercase_tokens"]
+        self.oov_index = config["oov_index"]
+        self.token_to_index = {token: index for index, token in enumerate(config["vocabulary"])}
+
+    def __call__(self, words_batch: List[List[str]]) -> Dict[str, Tensor]:
+        token_to_index, oov_index = self.token_to_index, self.oov_index
+        ids_batch = [
+            [token_to_index.get(word.lower() if self.lowercase_tokens else word, oov_index) for word in words]
+            for words in words_batch
+        ]
+        return {"tokens": _pad(ids_batch, 0, torch.long)}
+
+
+class TransformerMismatchedIndexer:
+    """
+    Counterpart of allennlp PretrainedTransformerMismatchedIndexer: words are split into wordpieces one by one,
+    and offsets map words to their wordpieces spans.
+    """
+
+    # Memo of word wordpieces is cleared once it grows this large.
+    MAX_CACHE_SIZE = 1_000_000
+
+    def __init__(self, config: Dict, bundle_dir: str):
+        # Transformers are only needed for transformer-based models.
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.join(bundle_dir, config["tokenizer"]))
+        self.start_tokens = config["start_tokens"]
+        self.end_tokens = config["end_tokens"]
+        self.type_id = config["type_id"]
+        self.pad_token_id = config["pad_token_id"]
+        self._wordpieces_cache: Dict[str, List[int]] = {}
+
+    def _wordpieces(self, word: str) -> List[int]:
+        wordpieces = self._wordpieces_cache.get(word)
+        if wordpieces is None:
+            wordpieces = self.tokenizer.encode_plus(
+                word,
+                add_special_tokens=False,
+                return_tensors=None,
+                return_offsets_mapping=False,
+                return_attention_mask=False,
+            )["input_ids"]
+            if len(self._wordpieces_cache) >= self.MAX_CACHE_SIZE:
+                self._wordpieces_cache.clear()
+            self._wordpieces_cache[word] = wordpieces
+        return wordpieces
+
+    def __call__(self, words_batch: List[List[str]]) -> Dict[str, Tensor]:
+        token_ids_batch, type_ids_batch, offsets_batch, masks, wordpiece_masks = [], [], [], [], []
+        for words in words_batch:
+            token_ids = [token_id for token_id, _ in self.start_tokens]
+            type_ids = [type_id for _, type_id in self.start_tokens]
+            offsets = []
+            for word in words:
+                wordpieces = self._wordpieces(word)
+                if wordpieces:
+                    offsets.append([len(token_ids), len(token_ids) + len(wordpieces) - 1])
+                    token_ids.extend(wordpieces)
+                    type_ids.extend([self.type_id] * len(wordpieces))
+                else:
+                    # Words without wordpieces get zero embeddings.
+                    offsets.append([-1, -1])
+            token_ids.extend(token_id for token_id, _ in self.end_tokens)
+            type_ids.extend(type_id for _, type_id in self.end_tokens)
+
+            token_ids_batch.append(token_ids)
+            type_ids_batch.append(type_ids)
+            offsets_batch.append(offsets)
+            masks.append([True] * len(words))
+            wordpiece_masks.append([True] * len(token_ids))
+
+        return {
+            "token_ids": _pad(token_ids_batch, self.pad_token_id, torch.long),
+            "mask": _pad(masks, False, torch.bool),
+            "type_ids": _pad(type_ids_batch, 0, torch.long),
+            "offsets": _pad(offsets_batch, [0, 0], torch.long),
+            "wordpiece_mask": _pad(wordpiece_masks, False, torch.bool),
+        }
+
+
+INDEXERS = {
+    "single_id": SingleIdIndexer,
+    "pretrained_transformer_mismatched": TransformerMismatchedIndexer,
+}
+
+
+def _table(labels: List, decode=None) -> np.ndarray:
+    """
+    Object array of (decoded) labels, so that predictions are decoded with array lookups.
+    """
+    table = np.empty(len(labels), dtype=object)
+    for index, label in enumerate(labels):
+        table[index] = decode(label) if decode is not None and label is not None else label
+    return table
+
+
+class StandaloneParser:
+    """
+    Model bundle runner: indexes words, runs traced modules, decodes trees and labels.
+    """
+
+    # Memo of dictionary lookups is cleared once it grows this large.
+    MAX_CACHE_SIZE = 1_000_000
+
+    def __init__(self, bundle_dir: str, max_batch_size: int = 32):
+        assert max_batch_size >= 1
+        self.max_batch_size = max_batch_size
+
+        with open(os.path.join(bundle_dir, BUNDLE_CONFIG_NAME)) as file:
+            config = json.load(file)
+        if config["version"] != BUNDLE_VERSION:
+            raise ValueError(f"{bundle_dir} has bundle version {config['version']}, while {BUNDLE_VERSION} is expected. Export it again.")
+
+        indexer_config = config["indexer"]
+        self.indexer = INDEXERS[indexer_config["type"]](indexer_config, bundle_dir)
+        self.input_names = config["inputs"]
+        self.decoding = config["decoding"]
+
+        self.encoder = torch.jit.load(os.path.join(bundle_dir, ENCODER_NAME), map_location="cpu")
+        self.rel_scorer = torch.jit.load(os.path.join(bundle_dir, REL_SCORER_NAME), map_location="cpu")
+
+        labels = config["labels"]
+        self.lemma_rule_table = _table(labels["lemma_rule"], LemmaRule.from_str)
+        self.pos_table = _table(labels["pos"])
+        self.feats_table = _table(labels["feats"])
+        self.deprel_table = _table(labels["deprel"])
+        self.semslot_table = _table(labels["semslot"])
+        self.semclass_table = _table(labels["semclass"])
+
+        self.dictionary = None
+        if config["lemma_dictionary"] is not None:
+            self.dictionary = LemmaDictionary(os.path.join(bundle_dir, config["lemma_dictionary"]))
+        # (word, lemma rule id) -> whether the lemma is in the dictionary.
+        self._is_in_dictionary_cache: Dict[Tuple[str, int], bool] = {}
+
+    def predict(self, sentences: List[TokenList]) -> List[Dict[str, list]]:
+        """
+        Predict tags of sentences. Outputs are the same as the ones of MorphoSyntaxSemanticPredictor.
+        """
+        # Group sentences of similar length together (see MorphoSyntaxSemanticPredictor).
+        order = sorted(range(len(sentences)), key=lambda index: len(self._words(sentences[index])))
+
+        outputs = [None] * len(sentences)
+        for start in range(0, len(order), self.max_batch_size):
+            batch_order = order[start:start + self.max_batch_size]
+            batch_outputs = self._predict_batch([sentences[index] for index in batch_order])
+            for index, output in zip(batch_order, batch_outputs):
+                outputs[index] = output
+        return outputs
+
+    @staticmethod
+    def _words(sentence: TokenList) -> List[str]:
+        return [token["form"] for token in sentence if token["form"] is not None]
+
+    def _predict_batch(self, sentences: List[TokenList]) -> List[Dict[str, list]]:
+        tokens = self.indexer([self._words(sentence) for sentence in sentences])
+
+        with torch.no_grad():
+            outputs = self.encoder(*[tokens[name] for name in self.input_names])
+            mask = outputs["mask"]
+
+            # [batch_size, seq_len], internal format (self index for ROOT).
+            if self.decoding == "eisner":
+                arcs = decode_eisner_batch(outputs["s_arc"], mask).numpy()
+            else:
+                arcs = decode_mst_batch(outputs["s_arc"], mask).numpy()
+            deprel_preds = self.rel_scorer(outputs["h_rel_head"], outputs["h_rel_dep"], torch.from_numpy(arcs)).numpy()
+
+        # Convert arcs to CoNLL-U format.
+        heads = arcs + 1
+        heads[heads == np.arange(1, heads.shape[1] + 1)] = 0
+
+        lemma_rule_preds = outputs["lemma_rule_preds"].numpy()
+        if self.dictionary is not None:
+            self._correct_lemma_rules(lemma_rule_preds, outputs["lemma_rule_top"].tolist(), sentences)
+
+        lemma_rules = self.lemma_rule_table[lemma_rule_preds]
+        pos_feats_preds = outputs["pos_feats_preds"].numpy()
+        pos_tags = self.pos_table[pos_feats_preds]
+        feats_tags = self.feats_table[pos_feats_preds]
+        deprels = self.deprel_table[deprel_preds]
+        semslots = self.semslot_table[outputs["semslot_preds"].numpy()]
+        semclasses = self.semclass_table[outputs["semclass_preds"].numpy()]
+
+        predictions = []
+        for i, sentence in enumerate(sentences):
+            length = len(sentence)
+            forms = [token["form"] for token in sentence]
+            predictions.append({
+                "metadata": sentence.metadata,
+                "ids": [token["id"] for token in sentence],
+                "forms": forms,
+                "lemmas": [
+                    predict_lemma_from_rule(word, lemma_rule) if lemma_rule is not None else '_'
+                    for word, lemma_rule in zip(forms, lemma_rules[i, :length])
+                ],
+                "pos": pos_tags[i, :length].tolist(),
+                "feats": feats_tags[i, :length].tolist(),
+                "heads": list(map(str, heads[i, :length].tolist())),
+                "deprels": deprels[i, :length].tolist(),
+                "semslots": semslots[i, :length].tolist(),
+                "semclasses": semclasses[i, :length].tolist(),
+            })
+        return predictions
+
+    def _correct_lemma_rules(self, lemma_rule_preds: np.ndarray, top_rules: List, sentences: List[TokenList]) -> None:
+        """
+        Replace predicted lemma rules with the most probable of top-k rules that produce a lemma from the dictionary,
+        as LemmaClassifier._correct_predictions does.
+        NB: Inplace operation.
+        """
+        for i, (tokens, tokens_top_rules) in enumerate(zip(sentences, top_rules)):
+            for j, (token, token_top_rules) in enumerate(zip(tokens, tokens_top_rules)):
+                form = token["form"]
+                if not is_correctable(form):
+                    continue
+                for lemma_rule_id in token_top_rules:
+                    if self._is_in_dictionary(form, lemma_rule_id):
+                        lemma_rule_preds[i, j] = lemma_rule_id
+                        break
+
+    def _is_in_dictionary(self, word: str, lemma_rule_id: int) -> bool:
+        key = (word, lemma_rule_id)
+        in_dictionary = self._is_in_dictionary_cache.get(key)
+        if in_dictionary is None:
+            lemma_rule = self.lemma_rule_table[lemma_rule_id]
+            in_dictionary = lemma_rule is not None and normalize(predict_lemma_from_rule(word, lemma_rule)) in self.dictionary
+            if len(self._is_in_dictionary_cache) >= self.MAX_CACHE_SIZE:
+                self._is_in_dictionary_cache.clear()
+            self._is_in_dictionary_cache[key] = in_dictionary
+        return in_dictionary
+
+
+def predict_file(parser: StandaloneParser, input_file: str, output_file: str, batch_size: int) -> int:
+    """
+    Label input_file sentences and write them into output_file (see bulk_predict.py). Return the number of sentences.
+    """
+    n_sentences = 0
+    with open(input_file) as input, open(output_file, 'w', buffering=OUTPUT_BUFFER_SIZE) as output:
+        for batch in batched(read_sentences(input), batch_size):
+            output.write(''.join(map(serialize_prediction, parser.predict(batch))))
+            n_sentences += len(batch)
+    return n_sentences
+
+
+def main(bundle_dir: str, input_file: str, output_file: str, batch_size: int, max_batch_size: int) -> None:
+    parser = StandaloneParser(bundle_dir, max_batch_size)
+    start = time.perf_counter()
+    n_sentences = predict_file(parser, input_file, output_file, batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"Predicted {n_sentences} sentences in {elapsed:.1f}s ({n_sentences / elapsed:.1f} sentences/s).", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Label a (tag-erased) SEMarkup file with an exported model bundle, without allennlp.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'bundle_dir',
+        type=str,
+        help='Model bundle directory (see export.py).'
+    )
+    parser.add_argument(
+        'input_file',
+        type=str,
+        help='File in SEMarkup format to be labeled.'
+    )
+    parser.add_argument(
+        'output_file',
+        type=str,
+        help='File to write predictions to.'
+    )
+    parser.add_argument(
+        '-batch_size',
+        type=int,
+        default=1024,
+        help='Number of sentences read at once. Each batch is sorted by length and split into sub-batches of similar-length sentences.\n'
+        'Default is 1024.'
+    )
+    parser.add_argument(
+        '-max_batch_size',
+        type=int,
+        default=32,
+        help='Maximum number of sentences in a sub-batch the model runs on.\n'
+        'Default is 32.'
+    )
+    args = parser.parse_args()
+
+    main(args.bundle_dir, args.input_file, args.output_file, args.batch_size, args.max_batch_size)
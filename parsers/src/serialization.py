@@ -0,0 +1,99 @@
+"""
+SEMarkup (CoNLL-U with semslot and semclass columns) parsing and serialization helpers,
+including batching of streamed sentences and buffered output of bulk prediction.
+
+The module depends on conllu only (no allennlp), so that it is shared by the allennlp predictor
+and the standalone runtime (see runtime.py).
+"""
+
+import itertools
+
+from typing import Any, Dict, Iterable, Iterator, List, TextIO, TypeVar
+
+import conllu
+from conllu.serializer import serialize_field
+
+
+CONLLU_FIELDS = ["id", "form", "lemma", "upos", "xpos", "feats", "head", "deprel", "semslot", "semclass"]
+
+# Feats are kept as strings (e.g. "Animacy=Inan|Case=Nom"), since they are glued with pos tags into a single label.
+FIELD_PARSERS = {"feats": lambda line, i: line[i]}
+
+# Predictions are written into large buffered files, so that writes are not issued per sentence.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+T = TypeVar("T")
+
+
+def parse_sentence(sentence_text: str) -> conllu.models.TokenList:
+    return conllu.parse_token_and_metadata(sentence_text, fields=CONLLU_FIELDS, field_parsers=FIELD_PARSERS)
+
+
+def make_sentence(words: List[str], metadata: Dict[str, str] = None) -> conllu.models.TokenList:
+    """
+    Make an untagged sentence of tokenized words.
+    """
+    tokens = [
+        {field: None for field in CONLLU_FIELDS} | {"id": index, "form": word}
+        for index, word in enumerate(words, 1)
+    ]
+    return conllu.models.TokenList(tokens, metadata or {})
+
+
+def read_sentences(file: TextIO) -> Iterator[conllu.models.TokenList]:
+    """
+    Lazily parse sentences of a SEMarkup file.
+    """
+    for sentence_text in conllu.parse_sentences(file):
+        yield parse_sentence(sentence_text)
+
+
+def batched(items: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    """
+    Split a (lazy) sequence of sentences or instances into lists of batch_size items (the last one may be shorter).
+    """
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+def _serialize_field(value: Any) -> str:
+    # Predicted tags are mostly strings, which are serialized as is.
+    return value if value.__class__ is str else serialize_field(value)
+
+
+def serialize_prediction(output: Dict[str, list]) -> str:
+    """
+    Serialize a predicted sentence into SEMarkup (CoNLL-U) lines, the same way
+    conllu.models.TokenList.serialize does, but without building TokenList.
+    """
+    lines = []
+    for key, value in output["metadata"].items():
+        lines.append(f"# {key} = {value}" if value else f"# {key}")
+
+    tags_iterator = zip(
+        output["ids"],
+        output["forms"],
+        output["lemmas"],
+        output["pos"],
+        output["feats"],
+        output["heads"],
+        output["deprels"],
+        output["semslots"],
+        output["semclasses"],
+    )
+    for tok_id, form, lemma, pos, feats, head, deprel, semslot, semclass in tags_iterator:
+        lines.append('\t'.join((
+            _serialize_field(tok_id),
+            _serialize_field(form),
+            _serialize_field(lemma),
+            _serialize_field(pos),
+            '_',
+            _serialize_field(feats),
+            _serialize_field(head),
+            _serialize_field(deprel),
+            _serialize_field(semslot),
+            _serialize_field(semclass),
+        )))
+
+    return '\n'.join(lines) + "\n\n"
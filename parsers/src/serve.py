@@ -0,0 +1,351 @@
+"""
+Local inference server: a trained model behind an HTTP endpoint (on a TCP port or a Unix socket).
+
+Sentences of all concurrent requests are queued and grouped into micro-batches: a batch is run as soon as it has
+`batch_size` sentences or its first sentence has waited for `max_delay_ms`, so that a single request is answered
+with almost no delay, while a flood of requests is processed in large batches.
+
+Endpoints:
+* POST /predict - label sentences. The body is either SEMarkup (tags are ignored) or JSON with tokenized sentences,
+  e.g. {"sentences": [["Мама", "мыла", "раму", "."]]} (with `Content-Type: application/json`).
+  Predictions are returned in SEMarkup in the original order.
+* GET /metrics - JSON with queue depth, numbers of sentences and batches, and sentence latency percentiles (in ms).
+* GET /health - 200 OK once the model is loaded.
+
+Usage:
+    python -m src.serve serialization_dir/model.tar.gz -port 8080
+    curl -s --data-binary @test.conllu localhost:8080/predict
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import conllu
+
+from allennlp.common.util import import_module_and_submodules
+from allennlp.data import Instance
+from allennlp.models.archival import load_archive
+from allennlp.predictors import Predictor
+
+from .dataset_reader import Sentence
+from .predictor import MorphoSyntaxSemanticPredictor
+from .serialization import parse_sentence, make_sentence, serialize_prediction
+
+
+class MicroBatcher:
+    """
+    Queue of sentences to be labeled, processed in batches by a worker thread.
+    A batch is formed once it has batch_size sentences or its oldest sentence has waited for max_delay seconds.
+    """
+
+    # Latencies of this many last sentences are used for percentiles.
+    LATENCY_WINDOW = 10000
+
+    def __init__(self, predictor: MorphoSyntaxSemanticPredictor, batch_size: int, max_delay: float):
+        assert batch_size >= 1 and max_delay >= 0
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        # (instance, enqueue time, future) items.
+        self._queue: queue.Queue = queue.Queue()
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self._n_sentences = 0
+        self._n_batches = 0
+        self._metrics_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, instances: List[Instance]) -> List[Future]:
+        """
+        Queue instances and return futures of their predictions.
+        """
+        futures = []
+        for instance in instances:
+            future = Future()
+            self._queue.put((instance, time.perf_counter(), future))
+            futures.append(future)
+        return futures
+
+    def predict(self, instances: List[Instance]) -> List[Dict[str, list]]:
+        return [future.result() for future in self.submit(instances)]
+
+    def _next_batch(self) -> List[Tuple[Instance, float, Future]]:
+        # Wait for the first sentence as long as it takes, and for the others until its deadline.
+        batch = [self._queue.get()]
+        deadline = batch[0][1] + self.max_delay
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            try:
+                outputs = self.predictor.predict_batch_instance_raw([instance for instance, _, _ in batch])
+            except Exception:
+                # Don't fail sentences of other requests because of a bad one, so predict them one by one.
+                outputs = [self._predict_or_exception(instance) for instance, _, _ in batch]
+
+            end = time.perf_counter()
+            with self._metrics_lock:
+                self._latencies.extend(end - enqueue_time for _, enqueue_time, _ in batch)
+                self._n_sentences += len(batch)
+                self._n_batches += 1
+            for (_, _, future), output in zip(batch, outputs):
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
+
+    def _predict_or_exception(self, instance: Instance):
+        try:
+            return self.predictor.predict_batch_instance_raw([instance])[0]
+        except Exception as exception:
+            return exception
+
+    def get_metrics(self) -> Dict[str, float]:
+        with self._metrics_lock:
+            latencies = np.array(self._latencies) * 1000
+            metrics = {
+                "queue_depth": self._queue.qsize(),
+                "sentences": self._n_sentences,
+                "batches": self._n_batches,
+                "mean_batch_size": self._n_sentences / self._n_batches if self._n_batches else 0.0,
+            }
+        for percentile in (50, 90, 99):
+            metrics[f"latency_p{percentile}_ms"] = float(np.percentile(latencies, percentile)) if len(latencies) else 0.0
+        return metrics
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler of prediction requests (see the module docstring).
+    """
+
+    server: "PredictionServer"
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            self._send(200, json.dumps(self.server.batcher.get_metrics()), "application/json")
+        elif self.path == "/health":
+            self._send(200, "OK\n")
+        else:
+            self._send(404, f"Unknown path: {self.path}\n")
+
+    def do_POST(self) -> None:
+        if self.path != "/predict":
+            self._send(404, f"Unknown path: {self.path}\n")
+            return
+
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            sentences = self._parse_sentences(body.decode(), self.headers.get("Content-Type", ""))
+            reader = self.server.batcher.predictor._dataset_reader
+            # Input tags are erased, so instances are made of words only (as in bulk prediction).
+            instances = [reader.text_to_instance(sentence.words, metadata=sentence.metadata) for sentence in sentences]
+        except (ValueError, TypeError, KeyError, conllu.exceptions.ParseException) as exception:
+            # UnicodeDecodeError is a ValueError as well.
+            self._send(400, f"Malformed request: {exception}\n")
+            return
+        except Exception as exception:
+            self._send(500, f"Failed to read sentences: {exception}\n")
+            return
+
+        try:
+            outputs = self.server.batcher.predict(instances)
+        except Exception as exception:
+            self._send(500, f"Prediction failed: {exception}\n")
+            return
+        self._send(200, ''.join(map(serialize_prediction, outputs)), "text/plain; charset=utf-8")
+
+    @staticmethod
+    def _parse_sentences(body: str, content_type: str) -> List[Sentence]:
+        if content_type.startswith("application/json"):
+            sentences = json.loads(body)["sentences"]
+            if not all(isinstance(words, list) and words and all(isinstance(word, str) for word in words) for words in sentences):
+                raise ValueError("sentences must be non-empty lists of words")
+            return [Sentence(make_sentence(words)) for words in sentences]
+        sentences = [Sentence(parse_sentence(sentence_text)) for sentence_text in conllu.parse_sentences(io.StringIO(body))]
+        if any(sentence.words is None for sentence in sentences):
+            raise ValueError("sentences must have words")
+        return sentences
+
+    def _send(self, status: int, body: str, content_type: str = "text/plain; charset=utf-8") -> None:
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """
+    Threading HTTP server holding the micro-batcher.
+    Requests are handled in separate threads, while the model runs in the batcher thread only.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batcher: MicroBatcher, verbose: bool = False):
+        self.batcher = batcher
+        self.verbose = verbose
+        super().__init__(address, PredictionRequestHandler)
+
+
+class UnixPredictionServer(PredictionServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self) -> None:
+        # Remove a socket file left by a previous run.
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = self.server_address, 0
+
+
+def main(model_file: str,
+         host: str,
+         port: int,
+         socket_path: str,
+         batch_size: int,
+         max_delay_ms: float,
+         max_batch_size: int,
+         cuda_device: int,
+         overrides: str,
+         verbose: bool) -> None:
+    # Register all the models, readers and predictors of the package.
+    import_module_and_submodules(__package__)
+    archive = load_archive(model_file, cuda_device=cuda_device, overrides=overrides)
+    predictor = Predictor.from_archive(
+        archive,
+        "morpho_syntax_semantic_predictor",
+        extra_args={"max_batch_size": max_batch_size}
+    )
+    batcher = MicroBatcher(predictor, batch_size, max_delay_ms / 1000)
+
+    if socket_path is not None:
+        server = UnixPredictionServer(socket_path, batcher, verbose)
+        print(f"Serving on unix socket {socket_path}", file=sys.stderr)
+    else:
+        server = PredictionServer((host, port), batcher, verbose)
+        print(f"Serving on http://{host}:{server.server_port}", file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Serve a trained model over HTTP with dynamic micro-batching.',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument(
+        'model_file',
+        type=str,
+        help='Model archive (model.tar.gz).'
+    )
+    parser.add_argument(
+        '-host',
+        type=str,
+        default="127.0.0.1",
+        help='Host to listen on.\n'
+        'Default is 127.0.0.1 (local connections only).'
+    )
+    parser.add_argument(
+        '-port',
+        type=int,
+        default=8080,
+        help='Port to listen on.\n'
+        'Default is 8080.'
+    )
+    parser.add_argument(
+        '-socket',
+        type=str,
+        default=None,
+        help='Unix socket to listen on instead of the host and port.'
+    )
+    parser.add_argument(
+        '-batch_size',
+        type=int,
+        default=256,
+        help='Maximum number of sentences in a micro-batch. Each micro-batch is sorted by length and split into sub-batches of similar-length sentences.\n'
+        'Default is 256.'
+    )
+    parser.add_argument(
+        '-max_delay_ms',
+        type=float,
+        default=5.0,
+        help='Maximum time a sentence waits for a micro-batch to fill, in milliseconds.\n'
+        'Default is 5.'
+    )
+    parser.add_argument(
+        '-max_batch_size',
+        type=int,
+        default=32,
+        help='Maximum number of sentences in a sub-batch the model runs on.\n'
+        'Default is 32.'
+    )
+    parser.add_argument(
+        '-cuda_device',
+        type=int,
+        default=-1,
+        help='Id of GPU to use (-1 for CPU).\n'
+        'Default is -1.'
+    )
+    parser.add_argument(
+        '-overrides',
+        type=str,
+        default="",
+        help='JSON overrides of the model configuration, e.g. \'{"model.depencency_classifier.decoding": "eisner"}\'.'
+    )
+    parser.add_argument(
+        '-verbose',
+        action='store_true',
+        help='Log every request.'
+    )
+    args = parser.parse_args()
+
+    main(
+        args.model_file,
+        args.host,
+        args.port,
+        args.socket,
+        args.batch_size,
+        args.max_delay_ms,
+        args.max_batch_size,
+        args.cuda_device,
+        args.overrides,
+        args.verbose
+    )
@@ -0,0 +1,495 @@
+"""
+Dependency tree decoding algorithms: batched Eisner and Chu-Liu-Edmonds.
+
+The module depends on numpy and torch only (no allennlp), so that it is used by the standalone runtime as well.
+decode_mst_batch and decode_eisner_batch decode arc scores of DependencyClassifier, both in the model
+and in the runtime.
+"""
+
+from multiprocessing import Pool
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+def eisner(scores: Tensor, lengths: Tensor) -> Tensor:
+    """
+    Batched Eisner algorithm: find the highest scoring projective dependency tree
+    with a single child of the root for each sentence in a batch.
+
+    scores[b, h, d] is the score of arc h -> d, where node 0 is an artificial root
+    and nodes 1..lengths[b] are tokens of b-th sentence, so scores has shape [batch_size, seq_len + 1, seq_len + 1].
+    Return heads of shape [batch_size, seq_len + 1], where heads[b, d] is the head of node d
+    (heads[b, 0] and heads of padding nodes are 0).
+
+    Dynamic programming runs over all sentences at once, span width by span width.
+    Backtracking is done on cpu, since it is linear in sentence length.
+    """
+    batch_size, n_nodes, _ = scores.shape
+    device = scores.device
+
+    # Charts are kept batch-last, i.e. [n_nodes, n_nodes, batch_size], so that selecting a set of spans
+    # copies contiguous rows of batch_size values.
+    scores = scores.permute(1, 2, 0).contiguous()
+    # Root can't be a dependent.
+    scores[:, 0] = -float("inf")
+
+    # Chart of spans [i, j]:
+    # * incomplete: i and j are connected with an arc (left_* means j -> i, right_* means i -> j),
+    # * complete: the span is a subtree headed at j (left_*) or at i (right_*).
+    incomplete_left = torch.full_like(scores, -float("inf"))
+    incomplete_right = torch.full_like(scores, -float("inf"))
+    complete_left = torch.full_like(scores, -float("inf"))
+    complete_right = torch.full_like(scores, -float("inf"))
+    complete_left.diagonal(dim1=0, dim2=1).fill_(0.)
+    complete_right.diagonal(dim1=0, dim2=1).fill_(0.)
+
+    # Split points (backpointers).
+    incomplete_split = torch.zeros(n_nodes, n_nodes, batch_size, dtype=torch.long, device=device)
+    complete_left_split = torch.zeros_like(incomplete_split)
+    complete_right_split = torch.zeros_like(incomplete_split)
+
+    for width in range(1, n_nodes):
+        n_spans = n_nodes - width
+        # Spans [i, j], j = i + width.
+        # [n_spans]
+        i = torch.arange(n_spans, device=device)
+        j = i + width
+        # Split points r = i..j-1.
+        # [n_spans, width]
+        r = i[:, None] + torch.arange(width, device=device)[None, :]
+        # [n_spans, 1]
+        i_, j_ = i[:, None], j[:, None]
+
+        # Incomplete span: two complete subtrees [i, r] and [r + 1, j] joined with an arc between i and j.
+        # [n_spans, width, batch_size]
+        joined = complete_right[i_, r] + complete_left[r + 1, j_]
+        # [n_spans, batch_size]
+        best, best_split = joined.max(1)
+        incomplete_right[i, j] = best + scores[i, j]
+        incomplete_left[i, j] = best + scores[j, i]
+        incomplete_split[i, j] = i_ + best_split
+
+        # Complete span headed at j: complete subtree [i, r] headed at r and incomplete span [r, j] (j -> r).
+        joined = complete_left[i_, r] + incomplete_left[r, j_]
+        best, best_split = joined.max(1)
+        complete_left[i, j] = best
+        complete_left_split[i, j] = i_ + best_split
+
+        # Complete span headed at i: incomplete span [i, r] (i -> r) and complete subtree [r, j] headed at r,
+        # now with r = i+1..j.
+        joined = incomplete_right[i_, r + 1] + complete_right[r + 1, j_]
+        best, best_split = joined.max(1)
+        complete_right[i, j] = best
+        complete_right_split[i, j] = i_ + 1 + best_split
+
+        # Root may have a single child only, so root's complete span must cover the whole sentence at once.
+        complete_right[0, width, lengths != width] = -float("inf")
+
+    # Backtracking visits 2 * length spans per sentence only, so split points are read elementwise from numpy arrays
+    # (converting the whole charts to lists would take longer).
+    # [batch_size, n_nodes, n_nodes]
+    incomplete_split = incomplete_split.permute(2, 0, 1).cpu().numpy()
+    complete_left_split = complete_left_split.permute(2, 0, 1).cpu().numpy()
+    complete_right_split = complete_right_split.permute(2, 0, 1).cpu().numpy()
+
+    heads = [
+        _backtrack(
+            incomplete_split[batch_idx],
+            complete_left_split[batch_idx],
+            complete_right_split[batch_idx],
+            length,
+            n_nodes
+        )
+        for batch_idx, length in enumerate(lengths.tolist())
+    ]
+    return torch.tensor(heads, dtype=torch.long, device=device)
+
+
+def _backtrack(incomplete_split: np.ndarray,
+               complete_left_split: np.ndarray,
+               complete_right_split: np.ndarray,
+               length: int,
+               n_nodes: int) -> List[int]:
+    heads = [0] * n_nodes
+    # Stack of (i, j, is_complete, is_right) spans.
+    stack = [(0, length, True, True)]
+    while stack:
+        i, j, is_complete, is_right = stack.pop()
+        if i == j:
+            continue
+        if is_complete:
+            if is_right:
+                r = complete_right_split[i, j]
+                stack.append((i, r, False, True))
+                stack.append((r, j, True, True))
+            else:
+                r = complete_left_split[i, j]
+                stack.append((i, r, True, False))
+                stack.append((r, j, False, False))
+        else:
+            if is_right:
+                heads[j] = i
+            else:
+                heads[i] = j
+            r = incomplete_split[i, j]
+            stack.append((i, r, True, True))
+            stack.append((r + 1, j, True, False))
+    return heads
+
+
+def decode_best_arcs(energy: Tensor, mask: Tensor) -> Tuple[Tensor, Tensor]:
+    """
+    The first step of Chu-Liu-Edmonds algorithm for all sentences at once: pick the best incoming arc of each node
+    and check whether these arcs form a tree. If they do, it is the maximum spanning tree, i.e. decode_mst
+    yields the same heads (ties are broken in favor of the lower index, as in chu_liu_edmonds).
+
+    energy[b, i, j] is the score of arc i -> j in b-th sentence, node 0 is the root, mask is [batch_size, seq_len].
+    Return heads of shape [batch_size, seq_len] (heads of the root and padding nodes are 0)
+    and a [batch_size] mask of sentences whose heads form a tree.
+    """
+    batch_size, seq_len, _ = energy.shape
+    mask = mask.bool()
+    # A node can't be the head of itself, padding nodes can't be heads at all.
+    energy = energy.masked_fill(~mask[:, :, None], -float("inf"))
+    energy = energy.masked_fill(torch.eye(seq_len, dtype=torch.bool, device=energy.device), -float("inf"))
+    # argmax returns the first maximal value, i.e. the lowest index.
+    # [batch_size, seq_len]
+    heads = energy.argmax(1)
+    heads[:, 0] = 0
+    heads.masked_fill_(~mask, 0)
+
+    # Follow heads by pointer doubling: after k steps, each node is replaced with its ancestor at distance 2^k,
+    # so nodes of a tree reach the root (which is its own head), while nodes of cycles (and below them) never do.
+    ancestors = heads
+    for _ in range(max(seq_len - 1, 1).bit_length()):
+        ancestors = ancestors.gather(1, ancestors)
+    is_tree = (ancestors == 0).all(-1)
+    return heads, is_tree
+
+
+def decode_mst(energy: np.ndarray, length: int) -> np.ndarray:
+    """
+    Decode maximum spanning tree (arborescence) with Chu-Liu-Edmonds algorithm.
+
+    energy[i, j] is the score of arc i -> j, node 0 is the root.
+    Return heads of shape [energy.shape[-1]], where heads[j] is the head of node j (heads[0] is -1,
+    heads of padding nodes are 0).
+
+    It is a port of allennlp.nn.chu_liu_edmonds.decode_mst (for unlabeled graphs), which can't be imported
+    without allennlp. Ties are broken the same way, so trees are the same as well.
+    """
+    max_length = energy.shape[-1]
+    score_matrix = np.array(energy[:length, :length], copy=True)
+    # Mapping of contracted graph arcs to arcs of the original one.
+    old_input = np.zeros([length, length], dtype=np.int32)
+    old_output = np.zeros([length, length], dtype=np.int32)
+    current_nodes = [True] * length
+    representatives: List[Set[int]] = []
+
+    for node1 in range(length):
+        score_matrix[node1, node1] = 0.0
+        representatives.append({node1})
+        for node2 in range(node1 + 1, length):
+            old_input[node1, node2] = node1
+            old_output[node1, node2] = node2
+            old_input[node2, node1] = node2
+            old_output[node2, node1] = node1
+
+    final_edges: Dict[int, int] = {}
+    chu_liu_edmonds(length, score_matrix, current_nodes, final_edges, old_input, old_output, representatives)
+
+    heads = np.zeros([max_length], np.int32)
+    for child, parent in final_edges.items():
+        heads[child] = parent
+    return heads
+
+
+def chu_liu_edmonds(length: int,
+                    score_matrix: np.ndarray,
+                    current_nodes: List[bool],
+                    final_edges: Dict[int, int],
+                    old_input: np.ndarray,
+                    old_output: np.ndarray,
+                    representatives: List[Set[int]]) -> None:
+    """
+    Find maximum spanning arborescence of the graph of current_nodes (cycles contracted so far are represented
+    by a single node) and write its arcs into final_edges (child -> parent).
+    NB: Inplace operation on all the arguments.
+    """
+    # Pick the best incoming arc of each node.
+    parents = [-1]
+    for node1 in range(1, length):
+        parents.append(0)
+        if current_nodes[node1]:
+            max_score = score_matrix[0, node1]
+            for node2 in range(1, length):
+                if node2 == node1 or not current_nodes[node2]:
+                    continue
+                new_score = score_matrix[node2, node1]
+                if new_score > max_score:
+                    max_score = new_score
+                    parents[node1] = node2
+
+    has_cycle, cycle = _find_cycle(parents, length, current_nodes)
+    if not has_cycle:
+        final_edges[0] = -1
+        for node in range(1, length):
+            if not current_nodes[node]:
+                continue
+            parent = old_input[parents[node], node]
+            child = old_output[parents[node], node]
+            final_edges[child] = parent
+        return
+
+    # Contract the cycle into its first node.
+    cycle_weight = 0.0
+    for node in cycle:
+        cycle_weight += score_matrix[parents[node], node]
+    cycle_representative = cycle[0]
+
+    for node in range(length):
+        if not current_nodes[node] or node in cycle:
+            continue
+
+        in_edge_weight = float("-inf")
+        in_edge = -1
+        out_edge_weight = float("-inf")
+        out_edge = -1
+
+        for node_in_cycle in cycle:
+            if score_matrix[node_in_cycle, node] > in_edge_weight:
+                in_edge_weight = score_matrix[node_in_cycle, node]
+                in_edge = node_in_cycle
+
+            # Score of the cycle broken at node_in_cycle by node -> node_in_cycle arc.
+            score = cycle_weight + score_matrix[node, node_in_cycle] - score_matrix[parents[node_in_cycle], node_in_cycle]
+            if score > out_edge_weight:
+                out_edge_weight = score
+                out_edge = node_in_cycle
+
+        score_matrix[cycle_representative, node] = in_edge_weight
+        old_input[cycle_representative, node] = old_input[in_edge, node]
+        old_output[cycle_representative, node] = old_output[in_edge, node]
+
+        score_matrix[node, cycle_representative] = out_edge_weight
+        old_output[node, cycle_representative] = old_output[node, out_edge]
+        old_input[node, cycle_representative] = old_input[node, out_edge]
+
+    # Nodes (of the original graph) each cycle node represents.
+    considered_representatives: List[Set[int]] = []
+    for i, node_in_cycle in enumerate(cycle):
+        considered_representatives.append(set())
+        if i > 0:
+            # Cycle nodes are represented by the cycle representative from now on.
+            current_nodes[node_in_cycle] = False
+        for node in representatives[node_in_cycle]:
+            considered_representatives[i].add(node)
+            if i > 0:
+                representatives[cycle_representative].add(node)
+
+    chu_liu_edmonds(length, score_matrix, current_nodes, final_edges, old_input, old_output, representatives)
+
+    # Expand the cycle: find the cycle node the tree enters the cycle at and keep all the other cycle arcs.
+    found = False
+    key_node = -1
+    for i, node in enumerate(cycle):
+        for cycle_rep in considered_representatives[i]:
+            if cycle_rep in final_edges:
+                key_node = node
+                found = True
+                break
+        if found:
+            break
+
+    previous = parents[key_node]
+    while previous != key_node:
+        child = old_output[parents[previous], previous]
+        parent = old_input[parents[previous], previous]
+        final_edges[child] = parent
+        previous = parents[previous]
+
+
+def _find_cycle(parents: List[int], length: int, current_nodes: List[bool]) -> Tuple[bool, List[int]]:
+    """
+    Find a cycle of the graph given by parents (of current nodes), if there is any.
+    """
+    added = [False] * length
+    added[0] = True
+    cycle = set()
+    has_cycle = False
+    for i in range(1, length):
+        if has_cycle:
+            break
+        # Don't revisit nodes which have already been visited.
+        if added[i] or not current_nodes[i]:
+            continue
+        # Follow parents from i.
+        this_cycle = set()
+        this_cycle.add(i)
+        added[i] = True
+        has_cycle = True
+        next_node = i
+        while parents[next_node] not in this_cycle:
+            next_node = parents[next_node]
+            # A visited node means the path leads to the root or to an already checked path.
+            if added[next_node]:
+                has_cycle = False
+                break
+            added[next_node] = True
+            this_cycle.add(next_node)
+
+        if has_cycle:
+            original = next_node
+            cycle.add(original)
+            next_node = parents[original]
+            while next_node != original:
+                cycle.add(next_node)
+                next_node = parents[next_node]
+            break
+
+    # Cycle nodes are listed in set order, which determines the cycle representative.
+    return has_cycle, list(cycle)
+
+
+def decode_mst_heads(energy: np.ndarray, root_idx: int, length: int) -> np.ndarray:
+    """
+    Decode maximum spanning tree of a single sentence given its [length, length] energy matrix.
+    Module-level function, so that it can be sent to worker processes.
+    """
+    # Zero energy[i, root_idx] = "Probability that i is the head of root_idx" out.
+    energy = energy.copy()
+    energy[:, root_idx] = 0.0
+    # Finally, we are ready to call decode_mst.
+    return decode_mst(energy, length)
+
+
+def fill_heads(arcs: np.ndarray, heads: np.ndarray) -> None:
+    """
+    Write decoded heads into greedily predicted arcs, except for isolated vertices.
+    NB: Inplace operation.
+    """
+    length = len(heads)
+    arcs[:length] = np.where(heads > 0, heads, arcs[:length])
+
+
+def decode_mst_batch(s_arc: Tensor,
+                     mask: Tensor,
+                     get_pool: Optional[Callable[[], Pool]] = None,
+                     pool_min_length: int = 0) -> Tensor:
+    """
+    Decode maximum spanning trees of a batch given arc scores s_arc of shape [batch_size, seq_len, seq_len],
+    where s_arc[b, i, j] is the score that j is the head of i (i != j) or that i is ROOT (i == j).
+    Return heads of shape [batch_size, seq_len] in the same format (self index for ROOT).
+
+    If get_pool is set, sentences of at least pool_min_length tokens are decoded in processes of the pool it returns
+    (it is called only if there are such sentences).
+    """
+    # It is the most tricky part of dependency classifier.
+    # If you want to get into it, first visit
+    # https://docs.allennlp.org/main/api/nn/chu_liu_edmonds
+    # It is not that detailed, so you better look into the source.
+
+    # First, normalize values, as decode_mst expects values to be non-negative.
+    s_arc_probs = torch.nn.functional.softmax(s_arc, dim=-1)
+
+    # Next, recall the hack: we use diagonal to store ROOT relation, so
+    #
+    # s_arc[i,j] = "Probability that j is the head of i" if i != j else "Probability that i is ROOT".
+    #
+    # However, decode_mst defines 'energy' matrix as follows:
+    #
+    # energy[i,j] = "Score that i is the head of j",
+    #
+    # which means we have to transpose s_arc at first, so that:
+    #
+    # s_arc[i,j] = "Score that i is the head of j" if i != j else "Score that i is ROOT".
+    #
+    s_arc_probs_inv = s_arc_probs.transpose(1, 2)
+
+    # Also note that decode_mst can't handle loops, as it zeroes diagonal out.
+    # So, s_arc now:
+    #
+    # s_arc[i,j] = "Score that i is the head of j".
+    #
+    # However, decode_mst can produce a tree where root node
+    # has a parent, since it knows nothing about root yet.
+    # That is, we have to chose the latter explicitly.
+    # [batch_size]
+    root_idxs = s_arc_probs_inv.diagonal(dim1=1, dim2=2).argmax(dim=-1)
+
+    # Some vertices may be isolated, their heads are picked greedily.
+    # [batch_size, seq_len]
+    greedy_arcs = s_arc.argmax(-1)
+
+    # For most sentences, the best incoming arcs already form a tree, which is the MST then,
+    # so decode_mst is run only for sentences where they don't.
+    # [batch_size, seq_len, seq_len]
+    energies = s_arc_probs_inv.clone()
+    energies[torch.arange(len(root_idxs), device=energies.device), :, root_idxs] = 0.0
+    # [batch_size, seq_len], [batch_size]
+    best_arcs, is_tree = decode_best_arcs(energies, mask)
+    greedy_arcs = torch.where(is_tree[:, None] & (best_arcs > 0), best_arcs, greedy_arcs)
+
+    # Everything else is done on device, so transfer only what decode_mst needs.
+    energies = s_arc_probs_inv.detach().cpu().numpy()
+    root_idxs = root_idxs.tolist()
+    lengths = mask.sum(-1).tolist()
+    is_tree = is_tree.tolist()
+    predicted_arcs = greedy_arcs.cpu().numpy()
+
+    # Short sentences are decoded in place, while long ones are sent to worker processes (if enabled),
+    # as decode_mst is cubic in sentence length.
+    pooled_sentences = []
+    for batch_idx, (root_idx, length) in enumerate(zip(root_idxs, lengths)):
+        if is_tree[batch_idx]:
+            continue
+        energy = energies[batch_idx, :length, :length]
+        if get_pool is not None and length >= pool_min_length:
+            pooled_sentences.append((batch_idx, energy, root_idx, length))
+        else:
+            heads = decode_mst_heads(energy, root_idx, length)
+            fill_heads(predicted_arcs[batch_idx], heads)
+
+    if pooled_sentences:
+        pooled_heads = get_pool().starmap(
+            decode_mst_heads,
+            [(energy, root_idx, length) for _, energy, root_idx, length in pooled_sentences]
+        )
+        for (batch_idx, _, _, _), heads in zip(pooled_sentences, pooled_heads):
+            fill_heads(predicted_arcs[batch_idx], heads)
+
+    # [batch_size, seq_len]
+    return torch.from_numpy(predicted_arcs).to(device=s_arc.device, dtype=torch.int64)
+
+
+def decode_eisner_batch(s_arc: Tensor, mask: Tensor) -> Tensor:
+    """
+    Decode the highest scoring projective tree with a single root for all sentences at once.
+    Arc scores and heads are in the same format as of decode_mst_batch.
+    """
+    batch_size, seq_len, _ = s_arc.shape
+
+    # [batch_size, seq_len, seq_len]
+    s_arc_log_probs = torch.nn.functional.log_softmax(s_arc, dim=-1)
+
+    # Eisner's algorithm expects an explicit root node 0 and scores of 'head -> dependent' arcs, so
+    #
+    # scores[0,j+1] = "Score that j is ROOT",
+    # scores[i+1,j+1] = "Score that i is the head of j".
+    #
+    # [batch_size, seq_len + 1, seq_len + 1]
+    scores = s_arc.new_full((batch_size, seq_len + 1, seq_len + 1), -float("inf"))
+    scores[:, 1:, 1:] = s_arc_log_probs.transpose(1, 2)
+    scores[:, 1:, 1:].diagonal(dim1=1, dim2=2).fill_(-float("inf"))
+    scores[:, 0, 1:] = s_arc_log_probs.diagonal(dim1=1, dim2=2)
+
+    # [batch_size, seq_len]
+    heads = eisner(scores, mask.sum(-1))[:, 1:]
+
+    # Convert heads back to internal format (self index for ROOT).
+    # [batch_size, seq_len]
+    self_idxs = torch.arange(seq_len, device=heads.device).expand(batch_size, -1)
+    return torch.where(heads == 0, self_idxs, heads - 1)